@@ -1,16 +1,23 @@
 from asyncio import futures
 from concurrent.futures import ThreadPoolExecutor
 import gzip
+import hashlib
 import json
 import os
+import shutil
 import subprocess
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import timedelta
 from glob import glob
+from itertools import islice
 from time import time
-from typing import List, Tuple
+from typing import List, Set, Tuple
 
 import requests
 from grobid_client.grobid_client import GrobidClient
+from rq import Queue, get_current_job
 from softdata_mentions_client.client import softdata_mentions_client
 
 from application.server.main.logger import get_logger
@@ -19,43 +26,206 @@ from config.harvester_config import config_harvester
 from config.logger_config import LOGGER_LEVEL
 from config.path_config import DESTINATION_DIR_METADATA
 from config.processing_service_namespaces import ServiceNamespace, grobid_ns, softcite_ns, datastet_ns
-from harvester.OAHarvester import OAHarvester
+from harvester.OAHarvester import OAHarvester, _count_entries, get_work_item, is_eligible
 from infrastructure.database.db_handler import DBHandler
 from infrastructure.storage.swift import Swift
-from load_metadata import load_metadata
+from load_metadata import load_metadata, load_metadata_columnar_cache, load_metadata_index, load_metadata_range
 from ovh_handler import download_files, upload_and_clean_up
 from run_grobid import run_grobid
 from run_softcite import run_softcite
 from run_datastet import run_datastet
+from domain.ovh_path import OvhPath
 from domain.processed_entry import ProcessedEntry
+from domain.work_item import WORK_ITEMS_EXT, WorkItem
+from utils.columnar_cache import (build_columnar_cache, get_columnar_cache_name, is_columnar_cache_available,
+                                  select_publications_to_harvest)
+from utils.seekable_gzip import build_seekable_gzip, get_index_name, get_seekable_name, read_lines
 
 METADATA_DUMP = config_harvester['metadata_dump']
+PARTITIONS_PREFIX = 'partitions'
+# contiguous: partitions are ranges of the dump, doi_hash: partitions are shards of the hash of the dois
+CONTIGUOUS_PARTITIONING = 'contiguous'
+DOI_HASH_PARTITIONING = 'doi_hash'
+RETRIES_PREFIX = 'retries'
+# The publications whose download failed for a transient reason are harvested again by a retry job,
+# RETRY_BASE_DELAY seconds after the harvest then twice as long after each retry
+MAX_RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 15 * 60
+# Objects bigger than 5GB have to be uploaded by segments
+LARGE_OBJECT_UPLOAD_OPTIONS = {'segment_size': 1024 * 1024 * 1024, 'use_slo': True}
 logger_console = get_logger(__name__, level=LOGGER_LEVEL)
 
 
 def create_task_harvest_partition(source_metadata_file, partition_index, total_partition_number, doi_list,
-                                  wiley_client, elsevier_client):
+                                  wiley_client, elsevier_client, partitioning_mode=CONTIGUOUS_PARTITIONING):
     swift_handler = Swift(config_harvester)
     db_handler = DBHandler(engine=engine, table_name='harvested_status_table', swift_handler=swift_handler)
 
-    source_metadata_file = load_metadata(metadata_container=METADATA_DUMP,
-                                         metadata_file=source_metadata_file,
-                                         destination_dir=DESTINATION_DIR_METADATA)
-    partition_size = get_partition_size(source_metadata_file, total_partition_number)
+    index = None
+    if partitioning_mode == CONTIGUOUS_PARTITIONING:
+        index = load_metadata_index(metadata_container=METADATA_DUMP,
+                                    metadata_file=source_metadata_file,
+                                    destination_dir=DESTINATION_DIR_METADATA)
+    if index is not None:
+        # Only the part of the dump covering the partition is downloaded
+        partition_size = get_partition_size(source_metadata_file, total_partition_number, index)
+        source_metadata_file, index = load_metadata_range(metadata_container=METADATA_DUMP,
+                                                          metadata_file=get_seekable_name(source_metadata_file),
+                                                          destination_dir=DESTINATION_DIR_METADATA,
+                                                          index=index,
+                                                          start=partition_index * partition_size,
+                                                          stop=(partition_index + 1) * partition_size)
+    else:
+        source_metadata_file = load_metadata(metadata_container=METADATA_DUMP,
+                                             metadata_file=source_metadata_file,
+                                             destination_dir=DESTINATION_DIR_METADATA)
     filtered_metadata_filename = os.path.join(os.path.dirname(source_metadata_file),
                                               'filtered_' + os.path.basename(source_metadata_file))
-    write_partitioned_metadata_file(source_metadata_file, filtered_metadata_filename, partition_size, partition_index)
+    if partitioning_mode == DOI_HASH_PARTITIONING:
+        write_doi_hash_partitioned_metadata_file(source_metadata_file, filtered_metadata_filename,
+                                                 total_partition_number, partition_index)
+    else:
+        if index is None:
+            partition_size = get_partition_size(source_metadata_file, total_partition_number)
+        write_partitioned_metadata_file(source_metadata_file, filtered_metadata_filename, partition_size,
+                                        partition_index, index)
     write_partitioned_filtered_metadata_file(db_handler, filtered_metadata_filename, filtered_metadata_filename,
                                              doi_list)
+    harvest_metadata_file(db_handler, filtered_metadata_filename, wiley_client, elsevier_client)
+
+
+def create_task_split_metadata(source_metadata_file, total_partition_number, doi_list, wiley_client, elsevier_client,
+                               partition_job_timeout, partitioning_mode=CONTIGUOUS_PARTITIONING):
+    """Scan and filter the metadata dump once, store the total_partition_number + 1 filtered partitions
+    next to the dump and enqueue a harvest job for each of them. Returns the ids of the harvest jobs.
+    The partitions of each split are stored apart, under the id of the splitter job"""
+    swift_handler = Swift(config_harvester)
+    db_handler = DBHandler(engine=engine, table_name='harvested_status_table', swift_handler=swift_handler)
+    current_job = get_current_job()
+
+    local_metadata_file = load_metadata(metadata_container=METADATA_DUMP,
+                                        metadata_file=source_metadata_file,
+                                        destination_dir=DESTINATION_DIR_METADATA)
+    partition_files = [get_partition_name(source_metadata_file, current_job.id, partition_index)
+                       for partition_index in range(total_partition_number + 1)]
+    local_partition_files = [os.path.join(DESTINATION_DIR_METADATA, partition_file)
+                             for partition_file in partition_files]
+    columnar_cache = load_metadata_columnar_cache(metadata_container=METADATA_DUMP,
+                                                  metadata_file=source_metadata_file,
+                                                  destination_dir=DESTINATION_DIR_METADATA)
+    write_split_metadata_files(db_handler, local_metadata_file, local_partition_files, doi_list, partitioning_mode,
+                               columnar_cache)
+    swift_handler.upload_files_to_swift(METADATA_DUMP, [
+        (local_partition_file, OvhPath(partition_file))
+        for local_partition_file, partition_file in zip(local_partition_files, partition_files)
+    ])
+    shutil.rmtree(os.path.dirname(local_partition_files[0]))
+
+    q = Queue(name=current_job.origin, connection=current_job.connection)
+    task_ids = []
+    for partition_file in partition_files:
+        task = q.enqueue(create_task_harvest_split_partition, partition_file=partition_file,
+                         wiley_client=wiley_client, elsevier_client=elsevier_client,
+                         job_timeout=partition_job_timeout)
+        task_ids.append(task.get_id())
+    return task_ids
+
+
+def create_task_harvest_split_partition(partition_file, wiley_client, elsevier_client, retry_attempt=0):
+    """Harvest a partition written by create_task_split_metadata or a retry file written by schedule_retry,
+    the local copy of the file being removed once harvested"""
+    swift_handler = Swift(config_harvester)
+    db_handler = DBHandler(engine=engine, table_name='harvested_status_table', swift_handler=swift_handler)
+
+    local_partition_file = load_metadata(metadata_container=METADATA_DUMP,
+                                         metadata_file=partition_file,
+                                         destination_dir=DESTINATION_DIR_METADATA,
+                                         subfolder_name=os.path.dirname(partition_file))
+    try:
+        harvest_metadata_file(db_handler, local_partition_file, wiley_client, elsevier_client, retry_attempt)
+    finally:
+        os.remove(local_partition_file)
+
+
+def harvest_metadata_file(db_handler, metadata_file, wiley_client, elsevier_client, retry_attempt=0):
     harvester = OAHarvester(config_harvester, wiley_client, elsevier_client)
-    harvester.harvestUnpaywall(filtered_metadata_filename)
+    harvester.harvestUnpaywall(metadata_file)
     harvester.diagnostic()
     logger_console.debug(f'{db_handler.count()} rows in database before harvesting')
     db_handler.update_database()
     logger_console.debug(f'{db_handler.count()} rows in database after harvesting')
+    schedule_retry(harvester.get_transient_failures(), wiley_client, elsevier_client, retry_attempt)
     harvester.reset_lmdb()
 
 
+def get_retry_name(job_id: str, retry_attempt: int) -> str:
+    """job_id, 2 -> retries/job_id_2.work_items.jsonl.gz"""
+    return str(OvhPath(RETRIES_PREFIX, f'{job_id}_{retry_attempt}{WORK_ITEMS_EXT}'))
+
+
+def schedule_retry(work_items: List[WorkItem], wiley_client, elsevier_client, retry_attempt: int):
+    """Store the work items of the transient failures of a harvest next to the partitions and enqueue their
+    harvest after an exponential backoff. Returns the id of the retry job, None if there is nothing to retry"""
+    current_job = get_current_job()
+    if not work_items or current_job is None:
+        return None
+    if retry_attempt >= MAX_RETRY_ATTEMPTS:
+        logger_console.info(f'{len(work_items)} publications are not retried after {retry_attempt} retries')
+        return None
+    retry_file = get_retry_name(current_job.id, retry_attempt + 1)
+    local_retry_file = os.path.join(DESTINATION_DIR_METADATA, retry_file)
+    os.makedirs(os.path.dirname(local_retry_file), exist_ok=True)
+    with gzip.open(local_retry_file, 'wt') as f_out:
+        for work_item in work_items:
+            f_out.write(work_item.to_json() + '\n')
+    swift_handler = Swift(config_harvester)
+    swift_handler.upload_files_to_swift(METADATA_DUMP, [(local_retry_file, OvhPath(retry_file))])
+    os.remove(local_retry_file)
+
+    delay = timedelta(seconds=RETRY_BASE_DELAY * 2 ** retry_attempt)
+    q = Queue(name=current_job.origin, connection=current_job.connection)
+    task = q.enqueue_in(delay, create_task_harvest_split_partition, partition_file=retry_file,
+                        wiley_client=wiley_client, elsevier_client=elsevier_client,
+                        retry_attempt=retry_attempt + 1, job_timeout=current_job.timeout)
+    logger_console.info(f'{len(work_items)} publications will be retried in {delay}, retry file = {retry_file}')
+    return task.get_id()
+
+
+def create_task_index_metadata_dump(source_metadata_file):
+    """Build the seekable version of the metadata dump, its index and, if pyarrow is installed,
+    its columnar cache and upload them next to the dump. The index records the etag and the size of the dump so that
+    it is not used once another version of the dump has been uploaded"""
+    swift_handler = Swift(config_harvester)
+    source = swift_handler.get_object_stat(METADATA_DUMP, source_metadata_file)
+    if source is None:
+        logger_console.warning(f'The version of {source_metadata_file} is unknown, its index will not be used')
+    local_metadata_file = os.path.normpath(os.path.join(DESTINATION_DIR_METADATA, source_metadata_file))
+    if source is not None and os.path.exists(local_metadata_file) and \
+            os.path.getsize(local_metadata_file) != source['size']:
+        # Local copy of a previous version of the dump
+        os.remove(local_metadata_file)
+    local_metadata_file = load_metadata(metadata_container=METADATA_DUMP,
+                                        metadata_file=source_metadata_file,
+                                        destination_dir=DESTINATION_DIR_METADATA)
+    seekable_metadata_file = get_seekable_name(source_metadata_file)
+    index_file = get_index_name(source_metadata_file)
+    local_seekable_metadata_file = os.path.join(DESTINATION_DIR_METADATA, seekable_metadata_file)
+    local_index_file = os.path.join(DESTINATION_DIR_METADATA, index_file)
+    index = build_seekable_gzip(local_metadata_file, local_seekable_metadata_file, local_index_file, source=source)
+    logger_console.debug(f'{len(index["seek_points"])} seek points for {index["number_of_lines"]} publications')
+    files_to_upload = [
+        (local_seekable_metadata_file, OvhPath(seekable_metadata_file)),
+        (local_index_file, OvhPath(index_file)),
+    ]
+    if is_columnar_cache_available():
+        columnar_cache = get_columnar_cache_name(source_metadata_file)
+        local_columnar_cache = os.path.join(DESTINATION_DIR_METADATA, columnar_cache)
+        build_columnar_cache(local_metadata_file, local_columnar_cache)
+        files_to_upload.append((local_columnar_cache, OvhPath(columnar_cache)))
+    swift_handler.upload_files_to_swift(METADATA_DUMP, files_to_upload, options=LARGE_OBJECT_UPLOAD_OPTIONS)
+    return index
+
+
 def get_softdata_version(softdata_file_path: str) -> str:
     """Get the version of softcite or datastet used by reading from an output file"""
     with open(softdata_file_path, 'r') as f:
@@ -137,46 +307,180 @@ def create_task_process(grobid_partition_files, softcite_partition_files, datast
         db_handler.update_database_processing(entries_to_update)
 
 
-def get_partition_size(source_metadata_file, total_partition_number):
-    with gzip.open(source_metadata_file, 'rt') as f:
-        number_of_lines = len(f.readlines())
+def get_partition_size(source_metadata_file, total_partition_number, index=None):
+    """Return the number of lines of a partition. Lines are counted on raw decompressed chunks
+    so that the dump is never held in memory as a list of strings, or read from the index if there is one"""
+    if index is not None:
+        number_of_lines = index['number_of_lines']
+    else:
+        number_of_lines = _count_entries(gzip.open, source_metadata_file)
     partition_size = (number_of_lines // total_partition_number)
     return partition_size
 
 
 def write_partitioned_metadata_file(source_metadata_file: str, filtered_metadata_filename: str, partition_size: int,
-                                    partition_index: int):
-    with gzip.open(source_metadata_file, 'rt') as f_in:
-        with gzip.open(filtered_metadata_filename, 'wt') as f_out:
-            content = f_in.readlines()
-            logger_console.debug(f'Number of publications in original file: {len(content)}')
-            filtered_file_content = ''.join(
-                content[(partition_index * partition_size):((partition_index + 1) * partition_size)])
-            logger_console.debug('Number of publications in the partition file: '
-                                 + f'{len(content[(partition_index * partition_size):((partition_index + 1) * partition_size)])}')
-            f_out.write(filtered_file_content)
+                                    partition_index: int, index: dict = None):
+    """Stream the lines of the partition from the source dump to the partition file.
+    Reading stops as soon as the last line of the partition has been written.
+    With the index of a seekable source, reading starts at the seek point the closest to the partition."""
+    start, stop = partition_index * partition_size, (partition_index + 1) * partition_size
+    number_of_lines = 0
+    with gzip.open(filtered_metadata_filename, 'wb') as f_out:
+        if index is not None:
+            lines = read_lines(source_metadata_file, index, start, stop)
+        else:
+            lines = _read_lines(source_metadata_file, start, stop)
+        for line in lines:
+            f_out.write(line)
+            number_of_lines += 1
+    logger_console.debug(f'Number of publications in the partition file: {number_of_lines}')
+
+
+def get_doi_partition_index(doi: str, number_of_partitions: int) -> int:
+    """Stable partition of a doi: the same doi is always in the same partition across runs and workers"""
+    return int(hashlib.md5(doi.lower().encode('utf-8')).hexdigest(), 16) % number_of_partitions
+
+
+def write_doi_hash_partitioned_metadata_file(source_metadata_file: str, filtered_metadata_filename: str,
+                                             total_partition_number: int, partition_index: int):
+    """Stream the publications whose doi hash falls in the partition from the source dump to the partition file.
+    Publications without doi are left out as they would be filtered out anyway."""
+    number_of_lines = 0
+    with gzip.open(source_metadata_file, 'rt') as f_in, gzip.open(filtered_metadata_filename, 'wt') as f_out:
+        for line in f_in:
+            doi = json.loads(line).get('doi')
+            if doi and get_doi_partition_index(doi, total_partition_number + 1) == partition_index:
+                f_out.write(f'{line.rstrip()}\n')
+                number_of_lines += 1
+    logger_console.debug(f'Number of publications in the partition file: {number_of_lines}')
+
+
+def _read_lines(source_metadata_file: str, start: int, stop: int):
+    with gzip.open(source_metadata_file, 'rb') as f_in:
+        yield from islice(f_in, start, stop)
 
 
 def write_partitioned_filtered_metadata_file(db_handler: DBHandler,
                                              source_metadata_file: str, filtered_metadata_filename: str,
                                              doi_list: List[str]) -> None:
-    doi_already_harvested_list = [entry[0] for entry in db_handler.fetch_all()]
-
-    with gzip.open(source_metadata_file, 'rt') as f_in:
-        metadata_input_file_content_list = [json.loads(line) for line in f_in.readlines()]
+    doi_already_harvested = db_handler.fetch_all_dois()
+    doi_set = set(doi_list)
 
     # TODO if publication without doi
     # filtered_publications_metadata_json_list = [entry for entry in metadata_input_file_content_list if entry.get('doi') else {'doi': entry['id'], **entry}]
-    # instead of:
-    filtered_publications_metadata_json_list = metadata_input_file_content_list
-    if len(doi_list) > 0:
-        filtered_publications_metadata_json_list = [
-            entry for entry in filtered_publications_metadata_json_list if entry.get('doi') in doi_list
-        ]
-    filtered_publications_metadata_json_list = [
-        entry for entry in filtered_publications_metadata_json_list if (entry.get('doi') not in doi_already_harvested_list) and entry.get('doi')
-    ]
-    logger_console.debug(
-        f'Number of publications in the file after filtering: {len(filtered_publications_metadata_json_list)}')
-    with gzip.open(os.path.join(DESTINATION_DIR_METADATA, filtered_metadata_filename), 'wt') as f_out:
-        f_out.write(os.linesep.join([json.dumps(entry) for entry in filtered_publications_metadata_json_list]))
+    filtered_metadata_filepath = os.path.join(DESTINATION_DIR_METADATA, filtered_metadata_filename)
+    # The source and the destination can be the same file: write in a temporary file that replaces it at the end
+    tmp_filtered_metadata_filepath = filtered_metadata_filepath + '.tmp'
+    number_of_publications = 0
+    with gzip.open(source_metadata_file, 'rt') as f_in:
+        with gzip.open(tmp_filtered_metadata_filepath, 'wt') as f_out:
+            for line in f_in:
+                entry = json.loads(line)
+                if len(doi_set) > 0 and entry.get('doi') not in doi_set:
+                    continue
+                if (entry.get('doi') in doi_already_harvested) or not entry.get('doi'):
+                    continue
+                if number_of_publications > 0:
+                    f_out.write(os.linesep)
+                f_out.write(json.dumps(entry))
+                number_of_publications += 1
+    os.replace(tmp_filtered_metadata_filepath, filtered_metadata_filepath)
+    logger_console.debug(f'Number of publications in the file after filtering: {number_of_publications}')
+
+
+def get_partition_name(source_metadata_file: str, split_id: str, partition_index: int) -> str:
+    """bso-publications.jsonl.gz, job_id, 3 -> partitions/bso-publications/job_id/partition_3.work_items.jsonl.gz"""
+    metadata_file_basename = os.path.basename(source_metadata_file).split('.')[0]
+    return str(OvhPath(PARTITIONS_PREFIX, metadata_file_basename, split_id,
+                       f'partition_{partition_index}{WORK_ITEMS_EXT}'))
+
+
+def is_publication_to_harvest(entry: dict, doi_set: Set[str], doi_already_harvested: Set[str]) -> bool:
+    """Eligible publications (see harvest_eligibility_conditions) that have not been harvested yet"""
+    doi = entry.get('doi')
+    if not doi or doi in doi_already_harvested:
+        return False
+    if len(doi_set) > 0 and doi not in doi_set:
+        return False
+    return is_eligible(entry)
+
+
+def _read_work_items_to_harvest(source_metadata_file: str, doi_set: Set[str], doi_already_harvested: Set[str]):
+    """Yield the work items of the publications to harvest of the source dump"""
+    with gzip.open(source_metadata_file, 'rt') as f_in:
+        for line in f_in:
+            entry = json.loads(line)
+            if is_publication_to_harvest(entry, doi_set, doi_already_harvested):
+                work_item = get_work_item(entry)
+                if work_item:
+                    yield work_item
+
+
+def _read_work_items_from_columnar_cache(source_metadata_file: str, columnar_cache: str, doi_set: Set[str],
+                                         doi_already_harvested: Set[str]):
+    """Yield the rank of the publication among the publications to harvest, the number of publications to harvest
+    and the work item of the publication. Only the lines of the publications to harvest are parsed"""
+    publications_to_harvest = select_publications_to_harvest(columnar_cache, doi_set, doi_already_harvested)
+    rank = 0
+    with gzip.open(source_metadata_file, 'rt') as f_in:
+        for line_number, line in enumerate(f_in):
+            if rank == len(publications_to_harvest):
+                break
+            if line_number not in publications_to_harvest:
+                continue
+            work_item = get_work_item(json.loads(line))
+            if work_item:
+                yield rank, len(publications_to_harvest), work_item
+            rank += 1
+
+
+def write_split_metadata_files(db_handler: DBHandler, source_metadata_file: str, partition_files: List[str],
+                               doi_list: List[str], partitioning_mode: str = CONTIGUOUS_PARTITIONING,
+                               columnar_cache: str = None) -> None:
+    """Write the work items of the publications to harvest of the source dump in the partition files,
+    the dump being read only once.
+    - contiguous: partitions hold the same number of publications to harvest. The work items are first written
+    in a temporary file as their number is only known at the end of the dump.
+    - doi_hash: publications are assigned to a partition according to the hash of their doi.
+    With the columnar cache of the dump, the publications to harvest are selected beforehand and only their
+    lines of the dump are parsed."""
+    doi_already_harvested = db_handler.fetch_all_dois()
+    doi_set = set(doi_list)
+    os.makedirs(os.path.dirname(partition_files[0]), exist_ok=True)
+    number_of_publications = [0] * len(partition_files)
+    harvesters = Counter()
+
+    with ExitStack() as stack:
+        f_outs = [stack.enter_context(gzip.open(partition_file, 'wt')) for partition_file in partition_files]
+
+        def write_work_item(partition_index: int, work_item: WorkItem):
+            f_outs[partition_index].write(f'{work_item.to_json()}\n')
+            number_of_publications[partition_index] += 1
+            harvesters[work_item.harvester] += 1
+
+        if columnar_cache is not None:
+            for rank, number_of_publications_to_harvest, work_item in _read_work_items_from_columnar_cache(
+                    source_metadata_file, columnar_cache, doi_set, doi_already_harvested):
+                if partitioning_mode == DOI_HASH_PARTITIONING:
+                    partition_index = get_doi_partition_index(work_item.doi, len(partition_files))
+                else:
+                    partition_index = rank * len(partition_files) // number_of_publications_to_harvest
+                write_work_item(partition_index, work_item)
+        elif partitioning_mode == DOI_HASH_PARTITIONING:
+            for work_item in _read_work_items_to_harvest(source_metadata_file, doi_set, doi_already_harvested):
+                write_work_item(get_doi_partition_index(work_item.doi, len(partition_files)), work_item)
+        else:
+            tmp_work_items_file = os.path.join(os.path.dirname(partition_files[0]),
+                                               'to_harvest_' + os.path.basename(source_metadata_file))
+            number_of_publications_to_harvest = 0
+            with gzip.open(tmp_work_items_file, 'wt') as f_tmp:
+                for work_item in _read_work_items_to_harvest(source_metadata_file, doi_set, doi_already_harvested):
+                    f_tmp.write(f'{work_item.to_json()}\n')
+                    number_of_publications_to_harvest += 1
+            with gzip.open(tmp_work_items_file, 'rb') as f_tmp:
+                for i, line in enumerate(f_tmp):
+                    partition_index = i * len(partition_files) // number_of_publications_to_harvest
+                    write_work_item(partition_index, WorkItem.from_json(line))
+            os.remove(tmp_work_items_file)
+    logger_console.debug(f'Number of publications to harvest per partition: {number_of_publications}')
+    logger_console.debug(f'Number of publications to harvest per harvester: {dict(harvesters)}')
@@ -2,8 +2,12 @@ from typing import Callable, List
 
 import redis
 from application.server.main.logger import get_logger
-from application.server.main.tasks import (create_task_harvest_partition,
-                                           create_task_process)
+from application.server.main.tasks import (CONTIGUOUS_PARTITIONING,
+                                           DOI_HASH_PARTITIONING,
+                                           create_task_harvest_partition,
+                                           create_task_index_metadata_dump,
+                                           create_task_process,
+                                           create_task_split_metadata)
 from domain.ovh_path import OvhPath
 from domain.processed_entry import ProcessedEntry
 from flask import Blueprint, current_app, jsonify, render_template, request
@@ -89,11 +93,31 @@ def run_task_harvest_partitions():
     source_metadata_file = args.get("metadata_file")
     total_partition_number = args.get("total_partition_number")
     doi_list = args.get("doi_list", [])
+    split_metadata = args.get("split_metadata", False)
+    partitioning_mode = args.get("partitioning_mode", CONTIGUOUS_PARTITIONING)
+    if partitioning_mode not in (CONTIGUOUS_PARTITIONING, DOI_HASH_PARTITIONING):
+        response_object = {"status": "error", "message": f"Unknown partitioning_mode {partitioning_mode}, expected "
+                                                         f"{CONTIGUOUS_PARTITIONING} or {DOI_HASH_PARTITIONING}"}
+        return jsonify(response_object), 400
     response_objects = []
     wiley_client = safe_instanciation_client(WileyClient, config_harvester[WILEY])
     elsevier_client = safe_instanciation_client(ElsevierClient, config_harvester[ELSEVIER])
     with Connection(redis.from_url(current_app.config["REDIS_URL"])):
         q = Queue(name="pdf-harvester", default_timeout=default_timeout)
+        if split_metadata:
+            # The dump is filtered and split once, the split job then enqueues the harvest of each partition
+            task_kwargs = {
+                "source_metadata_file": source_metadata_file,
+                "total_partition_number": total_partition_number,
+                "doi_list": doi_list,
+                "wiley_client": wiley_client,
+                "elsevier_client": elsevier_client,
+                "partition_job_timeout": 3 * HOURS,
+                "partitioning_mode": partitioning_mode,
+            }
+            task = q.enqueue(create_task_split_metadata, **task_kwargs)
+            response_objects.append({"status": "success", "data": {"task_id": task.get_id()}})
+            return jsonify(response_objects)
         for partition_index in range(total_partition_number + 1):
             task_kwargs = {
                 "source_metadata_file": source_metadata_file,
@@ -102,13 +126,28 @@ def run_task_harvest_partitions():
                 "doi_list": doi_list,
                 "job_timeout": 3 * HOURS,
                 "wiley_client": wiley_client,
-                "elsevier_client": elsevier_client
+                "elsevier_client": elsevier_client,
+                "partitioning_mode": partitioning_mode,
             }
             task = q.enqueue(create_task_harvest_partition, **task_kwargs)
             response_objects.append({"status": "success", "data": {"task_id": task.get_id()}})
     return jsonify(response_objects)
 
 
+@main_blueprint.route("/index_metadata_dump", methods=["POST"])
+def run_task_index_metadata_dump():
+    """
+    Build the seekable version of a metadata dump and its index so harvest partitions jump straight to their slice
+    """
+    args = request.get_json(force=True)
+    source_metadata_file = args.get("metadata_file")
+    with Connection(redis.from_url(current_app.config["REDIS_URL"])):
+        q = Queue(name="pdf-harvester", default_timeout=default_timeout)
+        task = q.enqueue(create_task_index_metadata_dump, source_metadata_file=source_metadata_file)
+    response_object = {"status": "success", "data": {"task_id": task.get_id()}}
+    return jsonify(response_object)
+
+
 @main_blueprint.route("/harvester_tasks/<task_id>", methods=["GET"])
 def get_status_harvester(task_id):
     with Connection(redis.from_url(current_app.config["REDIS_URL"])):
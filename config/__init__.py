@@ -9,6 +9,9 @@ ELSEVIER_API_TOKEN_KEY = f'{ELSEVIER}_APIKEY'
 ELSEVIER_INST_TOKEN_KEY = f'{ELSEVIER}_INSTTOKEN'
 ELSEVIER_PUBLICATION_URL_KEY = f'{ELSEVIER}_PUBLICATION_URL'
 
+# Redis shared by the rq workers
+REDIS_URL_KEY = 'REDIS_URL'
+
 # Database
 DB_HARVESTED_STATUS_TABLE_NAME = "harvested_status_table"
 DB_HARVESTING_DATE_COLUMN_NAME = "harvesting_date"
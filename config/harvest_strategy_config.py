@@ -25,3 +25,38 @@ oa_harvesting_strategy = [
     # Else
     lambda oa_location: True,
 ]
+
+
+"""Conditions d'éligibilité d'une publication au harvesting
+Une publication du dump est harvestée si toutes les conditions renvoient True.
+Elles sont appliquées au moment du découpage du dump en partitions (les partitions
+sont ainsi équilibrées sur les publications à harvester) et par le harvester."""
+
+"""Éditeurs dont les publications sont harvestées via leur API, même en accès fermé"""
+
+harvest_api_publishers = ["Wiley", "Elsevier"]
+
+harvest_eligibility_conditions = [
+    # DOI
+    lambda entry: bool(entry.get("doi")),
+    # Affiliation française
+    lambda entry: isinstance(entry.get("bso_country_corrected"), list)
+    and "fr" in entry["bso_country_corrected"],
+    # Accès ouvert (dernière observation en date) ou accès fermé via les API des éditeurs
+    lambda entry: (bool(entry.get("oa_details")) and entry["oa_details"][max(entry["oa_details"])]["is_oa"])
+    or entry.get("publisher_normalized") in harvest_api_publishers,
+]
+
+
+"""Le cache colonnaire des dumps évalue une version vectorisée des conditions ci-dessus
+(voir utils/columnar_cache.eligibility_mask), qui doit les suivre.
+À mettre à False si les conditions changent sans elle : les dumps sont alors filtrés ligne à ligne."""
+
+harvest_eligibility_vectorized = True
+
+
+"""Motif présent dans la ligne du dump de toute publication éligible (condition sur bso_country_corrected).
+Le harvester écarte les lignes qui ne le contiennent pas sans les décoder.
+À mettre à None si les conditions d'éligibilité changent."""
+
+harvest_eligibility_pre_check = b'"fr"'
@@ -11,6 +11,7 @@ from config import (
     ELSEVIER_API_TOKEN_KEY,
     ELSEVIER_INST_TOKEN_KEY,
     ELSEVIER_PUBLICATION_URL_KEY,
+    REDIS_URL_KEY,
 )
 from config.path_config import CONFIG_PATH
 
@@ -53,7 +54,8 @@ def get_harvester_config(config_file_path: str) -> dict:
         "health_check_doi": "10.1111/jofi.12230",
         "throttle_parameters": {
             "max_num_requests": 1,
-            "window_size": 15
+            "window_size": 15,
+            "redis_url": os.getenv(REDIS_URL_KEY)
         }
     }
     # Elsevier config
@@ -68,7 +70,8 @@ def get_harvester_config(config_file_path: str) -> dict:
         "health_check_doi": "10.1016/j.biocon.2013.06.003",
         "throttle_parameters": {
             "max_num_requests": 1,
-            "window_size": 1
+            "window_size": 1,
+            "redis_url": os.getenv(REDIS_URL_KEY)
         }
     }
     return config_harvester
@@ -8,7 +8,7 @@ CONFIG_PATH = os.path.join(PROJECT_DIRNAME, "config.json")
 CONFIG_PATH_TEST = os.path.join(PROJECT_DIRNAME, "tests", "unit_tests", "config_test.json")
 
 # Data path
-DATA_PATH = os.path.join(PROJECT_DIRNAME, "data")
+DATA_PATH = os.getenv("DATA_PATH", os.path.join(PROJECT_DIRNAME, "data"))
 PUBLICATIONS_DOWNLOAD_DIR = os.path.join(PROJECT_DIRNAME, "downloaded_publications/")
 GROBID_DIR = os.path.join(PROJECT_DIRNAME, "grobid/")
 SOFTCITE_DIR = os.path.join(PROJECT_DIRNAME, "softcite/")
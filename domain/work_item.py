@@ -0,0 +1,37 @@
+import json
+from typing import List
+
+WORK_ITEMS_EXT = ".work_items.jsonl.gz"
+
+
+class WorkItem:
+    """What the harvester needs to download a publication, derived once from its entry in the metadata dump:
+    {"doi": ..., "domain": ..., "urls": [...], "harvester": ...}
+    urls are ordered by oa_harvesting_strategy and harvester is the expected way of downloading the publication
+    (standard, arxiv, wiley or elsevier). The id of the publication is given by the harvester at harvest time."""
+
+    def __init__(self, doi: str, domain: str, urls: List[str], harvester: str):
+        self.doi: str = doi
+        self.domain: str = domain
+        self.urls: List[str] = urls
+        self.harvester: str = harvester
+
+    def __repr__(self) -> str:
+        return self.to_json()
+
+    def __eq__(self, other):
+        if isinstance(other, WorkItem):
+            return self.to_json() == other.to_json()
+        return False
+
+    def to_json(self) -> str:
+        return json.dumps({"doi": self.doi, "domain": self.domain, "urls": self.urls, "harvester": self.harvester})
+
+    @classmethod
+    def from_json(cls, line) -> "WorkItem":
+        work_item = json.loads(line)
+        return cls(work_item["doi"], work_item["domain"], work_item["urls"], work_item["harvester"])
+
+    def to_local_entry(self) -> dict:
+        """Entry given to the harvester"""
+        return {"doi": self.doi, "domain": self.domain}
@@ -7,17 +7,35 @@ import shutil
 import uuid
 from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from math import ceil
 from multiprocessing import cpu_count
+from typing import List, Optional, Tuple
 
 import lmdb
 import urllib3
+from rq import get_current_job
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from application.server.main.logger import get_logger
-from config.harvest_strategy_config import oa_harvesting_strategy
+from config.harvest_strategy_config import (harvest_eligibility_conditions, harvest_eligibility_pre_check,
+                                            oa_harvesting_strategy)
 from config.logger_config import LOGGER_LEVEL
 from config.path_config import COMPRESSION_EXT, DATA_PATH, METADATA_PREFIX, METADATA_EXT, PUBLICATION_PREFIX, PUBLICATION_EXT
 from domain.ovh_path import OvhPath
-from harvester.download_publication_utils import _download_publication, SUCCESS_DOWNLOAD
+from domain.work_item import WORK_ITEMS_EXT, WorkItem
+from harvester.arxiv_fetcher import ArxivFetcher
+from harvester.circuit_breaker import CircuitBreaker
+from harvester.concurrency_controller import ConcurrencyController
+from harvester.host_scheduler import HostScheduler
+from harvester.pdf_stream import TransferLimits
+from harvester.pipeline import DownloadPipeline
+from harvester.download_publication_utils import (ARXIV_HARVESTER, ELSEVIER_HARVESTER, PERMANENT_FAILURE,
+                                                  STANDARD_HARVESTER, SUCCESS_DOWNLOAD, TRANSIENT_FAILURE,
+                                                  WILEY_HARVESTER, _download_publication, url_to_path)
 from infrastructure.storage import swift
 from utils.file import _is_valid_file, compress
 
@@ -29,6 +47,11 @@ logging.getLogger("keystoneclient").setLevel(logging.ERROR)
 logging.getLogger("swiftclient").setLevel(logging.ERROR)
 
 NB_THREADS = 2 * cpu_count()
+CIRCUIT_ENV = "circuit"
+DEFAULT_PUBLISHER_API_WORKERS = 2
+DEFAULT_PUBLISHER_API_HORIZON = 600  # seconds of requests to the publisher APIs queued in their lane
+# Options of the pipeline, ignored by the batches
+PIPELINE_OPTIONS = ("pipeline_queue_size", "host_scheduler", "adaptive_concurrency", "publisher_api_lane")
 
 """
 Harvester for PDF available in open access. a LMDB index is used to keep track of the harvesting process and
@@ -46,6 +69,17 @@ class Continue(Exception):
     pass
 
 
+def loads_entry(line: bytes) -> dict:
+    """Decode a line of the dump with orjson when it is installed, json being the fallback for the lines
+    orjson rejects (e.g. NaN)"""
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(line)
+
+
 def calculate_pct(i, count):
     try:
         return int(i // (count / 100))
@@ -59,11 +93,40 @@ class OAHarvester:
         self.env = None  # standard lmdb env for storing biblio entries by uuid
         self.env_doi = None  # lmdb env for storing mapping between doi/pmcid and uuid
         self.env_fail = None  # lmdb env for keeping track of failures
+        self.env_circuit = None  # lmdb env of the circuit breaker of the hosts, shared by the jobs of the worker
         self._init_lmdb()  # init db
         self.wiley_client = wiley_client
         self.elsevier_client = elsevier_client
         self.swift = None
         self.batch_size = self.config["batch_size"]
+        self.eligibility_conditions = harvest_eligibility_conditions
+        self.eligibility_pre_check = harvest_eligibility_pre_check
+        # Number of concurrent downloads
+        self.download_workers = self.config.get("download_workers", NB_THREADS)
+        # With adaptive_concurrency, download_workers threads are started and a ConcurrencyController
+        # adjusts the number of downloads in flight
+        self.adaptive_concurrency = self.config.get("adaptive_concurrency")
+        if self.adaptive_concurrency is not None:
+            self.download_workers = self.adaptive_concurrency.get("max_concurrency", self.download_workers)
+        self.hedged_download = self.config.get("hedged_download")  # {"max_urls": ..., "delay": ...}
+        self.transfer_limits = None  # deadline and minimum bandwidth of the downloads
+        if "download_limits" in self.config:
+            self.transfer_limits = TransferLimits.from_config(self.config["download_limits"])
+        # Wiley and Elsevier downloads are handed to their own download workers so that the open access downloads
+        # do not wait behind the rate limits of the publisher APIs
+        self.publisher_api_workers = None
+        self.publisher_api_horizon = DEFAULT_PUBLISHER_API_HORIZON
+        if "publisher_api_lane" in self.config:
+            publisher_api_lane = self.config["publisher_api_lane"]
+            self.publisher_api_workers = publisher_api_lane.get("workers", DEFAULT_PUBLISHER_API_WORKERS)
+            self.publisher_api_horizon = publisher_api_lane.get("horizon", DEFAULT_PUBLISHER_API_HORIZON)
+        self.circuit_breaker = None
+        if "circuit_breaker" in self.config:
+            self.circuit_breaker = CircuitBreaker.from_config(self.env_circuit, self.config["circuit_breaker"])
+        ignored_options = [option for option in PIPELINE_OPTIONS if option in self.config]
+        if ignored_options and not self.config.get("pipeline", False):
+            logger.warning(f'{ignored_options} are only used by the pipeline, they are ignored without '
+                           f'"pipeline": true')
 
         # ovh storage metadata input dump and output publications dump
         self.storage_publications = config["publications_dump"]
@@ -72,6 +135,10 @@ class OAHarvester:
         is_swift_config = ("swift" in self.config) and len(self.config["swift"]) > 0
         if is_swift_config:
             self.swift = swift.Swift(self.config)
+        # The arXiv publications of a batch are downloaded at once from the swift storage (see arxiv_fetcher)
+        self.arxiv_fetcher = None
+        if self.swift is not None and self.config.get("arxiv_prefetch", True):
+            self.arxiv_fetcher = ArxivFetcher(self.swift)
 
     def _init_lmdb(self):
         # create the data path if it does not exist
@@ -94,6 +161,9 @@ class OAHarvester:
         envFilePath = os.path.join(DATA_PATH, "fail")
         self.env_fail = lmdb.open(envFilePath, map_size=lmdb_size)
 
+        envFilePath = os.path.join(DATA_PATH, CIRCUIT_ENV)
+        self.env_circuit = lmdb.open(envFilePath, map_size=lmdb_size)
+
     def harvestUnpaywall(self, filepath, reprocess=False, destination_dir=""):
         """
         Main method, use the Unpaywall dataset for getting pdf url for Open Access resources,
@@ -101,24 +171,36 @@ class OAHarvester:
         or on OVH and update the json description of the entries
         """
         batch_size_pdf = self.config.get("batch_size", 100)
-        count = _count_entries(gzip.open, filepath)
-        batch_gen = self._get_batch_generator(
-            filepath, count, reprocess, batch_size_pdf)
+        if filepath.endswith(WORK_ITEMS_EXT):
+            batch_gen = self._get_work_item_batch_generator(filepath, reprocess, batch_size_pdf)
+        else:
+            batch_gen = self._get_batch_generator(filepath, reprocess, batch_size_pdf)
+        if self.arxiv_fetcher is not None:
+            batch_gen = self._prefetch_arxiv(batch_gen)
+        if self.config.get("pipeline", False):
+            self.processPipeline((e for batch in batch_gen for e in batch), destination_dir)
+            return
         for batch in batch_gen:
             urls = [e[0] for e in batch]
             entries = [e[1] for e in batch]
             filenames = [e[2] for e in batch]
             self.processBatch(urls, filenames, entries, destination_dir)
 
+    def _prefetch_arxiv(self, batch_gen):
+        """Prefetch the arXiv publications of each batch before handing it out"""
+        for batch in batch_gen:
+            object_names = [url_to_path(urls[0]) for urls, _, _ in batch
+                            if urls and _get_harvester(urls) == ARXIV_HARVESTER]
+            try:
+                self.arxiv_fetcher.prefetch([object_name for object_name in object_names if object_name])
+            except Exception:
+                logger.exception("The arXiv publications of the batch could not be prefetched")
+            yield batch
+
     def _process_entry(self, entry, reprocess):
-        doi = entry.get('doi')
-        if doi is None:
-            return None
-        bso_country = entry.get('bso_country_corrected')
-        if not isinstance(bso_country, list):
-            return None
-        if 'fr' not in bso_country:
-            return None
+        if not is_eligible(entry, self.eligibility_conditions):
+            raise Continue
+        doi = entry['doi']
         try:
             _check_entry(entry, doi, self.getUUIDByIdentifier, reprocess, self.env, self.env_doi)
             url, entry, filename = self._parse_entry(entry)
@@ -128,64 +210,49 @@ class OAHarvester:
             raise
 
     def _parse_entry(self, entry):
-        """Parse entry to get url, entry, filename"""
-        latest_observation = get_latest_publication(entry)
-        if latest_observation["is_oa"]:
-            urls_for_pdf = {}
-            oa_locations = {}
-            for oa_location in latest_observation["oa_locations"]:
-                if ("url_for_pdf" in oa_location) and oa_location["url_for_pdf"]:
-                    for i, strategy in enumerate(oa_harvesting_strategy):
-                        if strategy(oa_location):
-                            update_dict(urls_for_pdf, i, oa_location["url_for_pdf"])
-                            update_dict(oa_locations, i, oa_location)
-                            break
-            urls_for_pdf = [
-                url for url_list_idx in sorted(urls_for_pdf) for url in urls_for_pdf[url_list_idx]
-            ]
-            oa_locations = [
-                oa_location
-                for oa_locations_idx in sorted(oa_locations)
-                for oa_location in oa_locations[oa_locations_idx]
-            ]
-            if urls_for_pdf and oa_locations:
-                return (
-                    urls_for_pdf,
-                    {
-                        "id": entry["id"],
-                        "doi": entry["doi"],
-                        "domain": entry["bso_classification"],
-                        "oa_locations": oa_locations,
-                    },
-                    os.path.join(DATA_PATH, entry["id"] + PUBLICATION_EXT),
-                )
-        else:  # closed access (via publishers APIs)
-            # returns urls, entry, filename to match signature even though we really only care about the doi since we use publishers APIs.
-            if entry.get("publisher_normalized") == "Wiley":
-                return (
-                    [f"https://onlinelibrary.wiley.com/doi/pdfdirect/{entry['doi']}"],
-                    {"id": entry["id"], "doi": entry["doi"], "domain": entry["bso_classification"]},
-                    os.path.join(DATA_PATH, entry["id"] + PUBLICATION_EXT),
-                )
-            elif entry.get("publisher_normalized") == "Elsevier":
-                return (
-                    [f"https://api.elsevier.com/content/article/doi/{entry['doi']}"],
-                    {"id": entry["id"], "doi": entry["doi"], "domain": entry["bso_classification"]},
-                    os.path.join(DATA_PATH, entry["id"] + PUBLICATION_EXT),
-                )
-        raise Continue
+        """Parse entry to get url, entry, filename, the urls being the ones of its work item (see get_work_item)"""
+        work_item, oa_locations = _get_work_item_and_oa_locations(entry)
+        if work_item is None:
+            raise Continue
+        local_entry = {"id": entry["id"], **work_item.to_local_entry()}
+        if oa_locations:
+            local_entry["oa_locations"] = oa_locations
+        return work_item.urls, local_entry, os.path.join(DATA_PATH, entry["id"] + PUBLICATION_EXT)
+
+    def _get_work_item_batch_generator(self, filepath, reprocess, batch_size=100):
+        """Reads a gzip file of work items (see get_work_item) and returns batches of processed entries"""
+        batch = []
+        with gzip.open(filepath, "rb") as gz:
+            for line in gz:
+                work_item = WorkItem.from_json(line)
+                entry = work_item.to_local_entry()
+                try:
+                    _check_entry(entry, work_item.doi, self.getUUIDByIdentifier, reprocess, self.env, self.env_doi)
+                except Continue:
+                    continue
+                batch.append([work_item.urls, entry, os.path.join(DATA_PATH, entry["id"] + PUBLICATION_EXT)])
+                if len(batch) % batch_size == 0:
+                    yield batch
+                    batch = []
+            yield batch
 
-    def _get_batch_generator(self, filepath, count, reprocess, batch_size=100):
-        """Reads gzip file and returns batches of processed entries"""
+    def _get_batch_generator(self, filepath, reprocess, batch_size=100):
+        """Reads gzip file and returns batches of processed entries.
+        The progress is computed on the number of compressed bytes read, which avoids a first pass on the file
+        to count its lines"""
         batch = []
-        with gzip.open(filepath, "rt", encoding="utf-8") as gz:
+        file_size = os.path.getsize(filepath)
+        with open(filepath, "rb") as compressed_file, gzip.open(compressed_file, "rb") as gz:
             curr = 0
-            for i, line in enumerate(gz):
-                if calculate_pct(i, count) != curr:
-                    curr = calculate_pct(i, count)
+            for line in gz:
+                if calculate_pct(compressed_file.tell(), file_size) != curr:
+                    curr = calculate_pct(compressed_file.tell(), file_size)
                     logger.info(f"{curr}%")
+                # Lines that cannot be eligible are skipped without being decoded
+                if self.eligibility_pre_check and self.eligibility_pre_check not in line:
+                    continue
                 try:
-                    url, entry, filename = self._process_entry(json.loads(line), reprocess)
+                    url, entry, filename = self._process_entry(loads_entry(line), reprocess)
                     if url:
                         batch.append([url, entry, filename])
                 except Continue:
@@ -198,7 +265,7 @@ class OAHarvester:
 
     def processBatch(self, urls, filenames, entries, destination_dir=""):
         logger.debug("Processing batch")
-        with ThreadPoolExecutor(max_workers=NB_THREADS) as executor:
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
             results = executor.map(
                 _download_publication,
                 urls,
@@ -206,42 +273,94 @@ class OAHarvester:
                 entries,
                 [self.wiley_client] * len(entries),
                 [self.elsevier_client] * len(entries),
+                [self.hedged_download] * len(entries),
+                [self.circuit_breaker] * len(entries),
+                [self.transfer_limits] * len(entries),
                 timeout=30,
             )
         # LMDB updates are out of the parallel process because LMDB write transaction must
         # be performed in the thread that created the transaction. It is supposed to be fast
         # but it might cause a bottleneck if the data recorded is to big
-        entries = []
-        for result, local_entry in results:
-            logger.debug(
-                f'Validating the file of the publication with doi = {local_entry["doi"]},'
-                f'result = {result}, harvester used = {local_entry["harvester_used"]}'
-            )
-            valid_file = False
-            local_filename = os.path.join(DATA_PATH, local_entry["id"])
-            # TODO: if result = 'fail' no need to do the check?
-            if _is_valid_file(local_filename + PUBLICATION_EXT, "pdf"):
-                valid_file = True
-                local_entry["valid_fulltext_pdf"] = True
-
-            # Done wether we succeed or not in biblio-glutton-harvester so we keep it that way
-            write_in_lmdb(env=self.env, key=local_entry["id"], value=_create_map_entry(local_entry))
-
-            if result == SUCCESS_DOWNLOAD and valid_file:
-                entries.append(local_entry)
-            else:
-                write_in_lmdb(
-                    env=self.env_fail,
-                    key=local_entry["id"],
-                    value={"result": result, "url": local_entry.get("url_for_pdf", "no url")},
-                )
-                clean_empty_file_if_it_exists(local_filename)
+        entries = [local_entry for result, local_entry in results if self._record_download(result, local_entry)]
 
         # LMDB update done so we parallelize the thumbnail/upload/file cleaning steps
         destination_dirs = len(entries) * [destination_dir]
         with ThreadPoolExecutor(max_workers=NB_THREADS) as executor:
             results = executor.map(self.manageFiles, entries, destination_dirs, timeout=30)
 
+    def processPipeline(self, work, destination_dir=""):
+        """Streaming alternative to processBatch (see DownloadPipeline): work is an iterable of
+        [urls, entry, filename]. The downloads are handed out by a HostScheduler, with the per host limits of the
+        host_scheduler configuration.
+        With adaptive_concurrency, the number of downloads in flight is adjusted by a ConcurrencyController
+        and published in the metadata of the current rq job.
+        With publisher_api_lane, the downloads through a publisher API have their own scheduler and
+        publisher_api_workers download workers (see _get_publisher_api_lane)"""
+        logger.debug("Processing pipeline")
+        queue_size = self.config.get("pipeline_queue_size", 2 * self.download_workers)
+        download_scheduler = HostScheduler.from_config(self.config.get("host_scheduler"), maxsize=queue_size)
+        api_scheduler, api_workers = self._get_publisher_api_lane()
+        concurrency_controller = None
+        if self.adaptive_concurrency is not None:
+            concurrency_controller = ConcurrencyController.from_config(
+                self.adaptive_concurrency, self.download_workers, _get_concurrency_publisher(get_current_job()))
+        pipeline = DownloadPipeline(self._download, self._record_download,
+                                    lambda local_entry: self.manageFiles(local_entry, destination_dir),
+                                    self._get_api_client, download_scheduler, self.download_workers, NB_THREADS,
+                                    queue_size, concurrency_controller, api_scheduler, api_workers)
+        pipeline.run(work)
+
+    def _get_publisher_api_lane(self) -> Tuple[Optional[HostScheduler], int]:
+        """Scheduler and number of download workers of the publisher API lane, None and 0 without lane.
+        The lane holds the publications the APIs can serve within the horizon, the producer waiting when it is full.
+        A client is None when it failed its health check, its publications being downloaded as the others"""
+        api_clients = [client for client in (self.wiley_client, self.elsevier_client) if client is not None]
+        if self.publisher_api_workers is None or not api_clients:
+            return None, 0
+        api_rate = sum(client.rate_limiter.rate for client in api_clients)
+        api_scheduler = HostScheduler.from_config(
+            None, maxsize=max(self.publisher_api_workers, ceil(api_rate * self.publisher_api_horizon)))
+        return api_scheduler, self.publisher_api_workers
+
+    def _download(self, urls, filename, local_entry):
+        return _download_publication(urls, filename, local_entry, self.wiley_client, self.elsevier_client,
+                                     self.hedged_download, self.circuit_breaker, self.transfer_limits)
+
+    def _get_api_client(self, urls):
+        """Publisher API client expected to download the publication, None for the other harvesters"""
+        return {WILEY_HARVESTER: self.wiley_client,
+                ELSEVIER_HARVESTER: self.elsevier_client}.get(_get_harvester(urls)) if urls else None
+
+    def _record_download(self, result, local_entry) -> bool:
+        """Validate the downloaded file and record the result in LMDB. Returns True if the file has to be uploaded.
+        The work item of a transient failure is recorded with it to be retried (see get_transient_failures)"""
+        local_entry.pop("rate_limit", None)
+        failure = local_entry.pop("failure", PERMANENT_FAILURE)
+        urls = local_entry.pop("urls", None)
+        logger.debug(
+            f'Validating the file of the publication with doi = {local_entry["doi"]},'
+            f'result = {result}, harvester used = {local_entry["harvester_used"]}'
+        )
+        valid_file = False
+        local_filename = os.path.join(DATA_PATH, local_entry["id"])
+        # TODO: if result = 'fail' no need to do the check?
+        if _is_valid_file(local_filename + PUBLICATION_EXT, "pdf"):
+            valid_file = True
+            local_entry["valid_fulltext_pdf"] = True
+
+        # Done wether we succeed or not in biblio-glutton-harvester so we keep it that way
+        write_in_lmdb(env=self.env, key=local_entry["id"], value=_create_map_entry(local_entry))
+
+        if result == SUCCESS_DOWNLOAD and valid_file:
+            return True
+        failed_entry = {"result": result, "url": local_entry.get("url_for_pdf", "no url"), "failure": failure}
+        if failure == TRANSIENT_FAILURE and urls:
+            failed_entry["work_item"] = WorkItem(local_entry["doi"], local_entry.get("domain"), urls,
+                                                 _get_harvester(urls)).to_json()
+        write_in_lmdb(env=self.env_fail, key=local_entry["id"], value=failed_entry)
+        clean_empty_file_if_it_exists(local_filename)
+        return False
+
     def getUUIDByIdentifier(self, identifier):
         with self.env_doi.begin() as txn:
             return txn.get(identifier.encode(encoding="UTF-8"))
@@ -354,6 +473,13 @@ class OAHarvester:
             )
         self._clean_up_files(**filepaths, local_entry_id=local_entry["id"])
 
+    def get_transient_failures(self) -> List[WorkItem]:
+        """Work items of the publications whose download failed for a transient reason"""
+        with self.env_fail.begin() as txn:
+            failed_entries = [pickle.loads(value) for _, value in txn.cursor()]
+        return [WorkItem.from_json(failed_entry["work_item"]) for failed_entry in failed_entries
+                if "work_item" in failed_entry]
+
     def diagnostic(self):
         """
         Log a report on failures stored during the harvesting process
@@ -363,18 +489,31 @@ class OAHarvester:
         with self.env.begin(write=True) as txn:
             nb_total = txn.stat()["entries"]
         logger.info(f"number of failed entries with OA link: {nb_fails} out of {nb_total} entries")
+        if self.transfer_limits is not None:
+            slow_hosts = {host: stats for host, stats in self.transfer_limits.get_stats().items()
+                          if stats["slow_transfers"] > 0}
+            logger.info(f"hosts with slow transfers: {slow_hosts}")
 
     def reset_lmdb(self):
         """
         Remove the local lmdb keeping track of the state of advancement of the harvesting and
-        of the failed entries as well as any local publication files
+        of the failed entries as well as any local publication files, the circuit breaker lmdb being kept
         """
         # close environments
         self.env.close()
         self.env_doi.close()
         self.env_fail.close()
-
-        shutil.rmtree(DATA_PATH)
+        self.env_circuit.close()
+
+        # The circuits of the hosts are kept for the next jobs of the worker
+        for name in os.listdir(DATA_PATH):
+            path = os.path.join(DATA_PATH, name)
+            if name == CIRCUIT_ENV:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
 
 
 def write_in_lmdb(env: lmdb.Environment, key: str, value: dict):
@@ -442,6 +581,11 @@ def _count_entries(open_fn, filepath):
         raise FileNotFoundError(f"{filepath} does not exist")
 
 
+def is_eligible(entry: dict, eligibility_conditions=harvest_eligibility_conditions) -> bool:
+    """Check if the publication has to be harvested"""
+    return all(condition(entry) for condition in eligibility_conditions)
+
+
 def get_latest_publication(publication_metadata: dict) -> dict:
     latest_publication_date_sorted_list = list(publication_metadata["oa_details"].keys())
     latest_publication_date_sorted_list.sort()
@@ -449,6 +593,77 @@ def get_latest_publication(publication_metadata: dict) -> dict:
     return publication_metadata["oa_details"][latest_publication_date]
 
 
+def _get_ordered_oa_locations(latest_observation: dict) -> Tuple[List[str], List[dict]]:
+    """Urls for pdf of the open access locations and the locations ordered by oa_harvesting_strategy"""
+    urls_for_pdf = {}
+    oa_locations = {}
+    for oa_location in latest_observation["oa_locations"]:
+        if ("url_for_pdf" in oa_location) and oa_location["url_for_pdf"]:
+            for i, strategy in enumerate(oa_harvesting_strategy):
+                if strategy(oa_location):
+                    update_dict(urls_for_pdf, i, oa_location["url_for_pdf"])
+                    update_dict(oa_locations, i, oa_location)
+                    break
+    urls_for_pdf = [url for url_list_idx in sorted(urls_for_pdf) for url in urls_for_pdf[url_list_idx]]
+    oa_locations = [
+        oa_location for oa_locations_idx in sorted(oa_locations) for oa_location in oa_locations[oa_locations_idx]
+    ]
+    return urls_for_pdf, oa_locations
+
+
+def _get_publisher_api_url(entry: dict) -> Optional[str]:
+    if entry.get("publisher_normalized") == "Wiley":
+        return f"https://onlinelibrary.wiley.com/doi/pdfdirect/{entry['doi']}"
+    elif entry.get("publisher_normalized") == "Elsevier":
+        return f"https://api.elsevier.com/content/article/doi/{entry['doi']}"
+    return None
+
+
+def get_work_item(entry: dict) -> Optional[WorkItem]:
+    """Work item of a publication of the dump, None if there is no way of downloading it"""
+    return _get_work_item_and_oa_locations(entry)[0]
+
+
+def _get_work_item_and_oa_locations(entry: dict) -> Tuple[Optional[WorkItem], List[dict]]:
+    """Work item of a publication of the dump and its open access locations, ordered as the urls of the work item.
+    The closed access publications are downloaded through the publishers APIs and have no open access location"""
+    latest_observation = get_latest_publication(entry)
+    if latest_observation["is_oa"]:
+        urls, oa_locations = _get_ordered_oa_locations(latest_observation)
+    else:
+        publisher_api_url = _get_publisher_api_url(entry)
+        urls, oa_locations = ([publisher_api_url] if publisher_api_url else []), []
+    if not urls:
+        return None, []
+    return WorkItem(entry["doi"], entry.get("bso_classification"), urls, _get_harvester(urls)), oa_locations
+
+
+def _get_concurrency_publisher(job):
+    """on_adjust callback of a ConcurrencyController publishing the concurrency in the metadata of the rq job.
+    The job is given as get_current_job only works in the thread of the job"""
+
+    def publish(concurrency: int, stats: dict):
+        logger.debug(f"Download concurrency = {concurrency}, {stats}")
+        if job is not None:
+            job.meta["download_concurrency"] = concurrency
+            job.meta["download_stats"] = stats
+            job.save_meta()
+
+    return publish
+
+
+def _get_harvester(urls: List[str]) -> str:
+    """Expected way of downloading a publication from its urls"""
+    url = urls[0].split("://")[-1]
+    if url.startswith("arxiv.org"):
+        return ARXIV_HARVESTER
+    if "wiley" in url:
+        return WILEY_HARVESTER
+    if "elsevier" in url:
+        return ELSEVIER_HARVESTER
+    return STANDARD_HARVESTER
+
+
 def _create_map_entry(local_entry):
     """
     Create a simple map JSON from the full metadata entry, to be stored locally and for the dumping the JSONL map file
@@ -0,0 +1,67 @@
+"""Batched retrieval of the arXiv publications.
+
+The arXiv PDFs are stored gzipped in the arxiv_harvesting container. Downloading them one by one with the swift CLI
+forks a shell and a Python process per publication, each one authenticating again with Keystone. The fetcher
+downloads the objects of the arXiv publications of a whole batch in a single SwiftService.download call, which is
+multi-threaded and reuses the authenticated session of the harvester, then decompresses them in a thread pool.
+The prefetched PDFs wait in ARXIV_PREFETCH_DIR until arxiv_download takes them (see take_prefetched), the swift
+CLI being only used for the publications that could not be prefetched.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from typing import List, Optional
+
+from application.server.main.logger import get_logger
+from config.logger_config import LOGGER_LEVEL
+from config.path_config import DATA_PATH
+from utils.file import decompress
+
+logger = get_logger(__name__, level=LOGGER_LEVEL)
+
+ARXIV_CONTAINER = "arxiv_harvesting"
+ARXIV_PREFETCH_DIR = os.path.join(DATA_PATH, "arxiv_prefetch")
+DEFAULT_DECOMPRESSION_WORKERS = cpu_count()
+
+
+def get_prefetched_path(object_name: str) -> str:
+    """arxiv/1501/1501.00001/1501.00001.pdf.gz -> ARXIV_PREFETCH_DIR/arxiv/1501/1501.00001/1501.00001.pdf"""
+    return os.path.splitext(os.path.join(ARXIV_PREFETCH_DIR, object_name))[0]
+
+
+def take_prefetched(object_name: str, filepath: str) -> bool:
+    """Move the prefetched PDF of the object to filepath. Returns False when it has not been prefetched"""
+    try:
+        os.replace(get_prefetched_path(object_name), filepath)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _inflate(gz_path: str) -> Optional[str]:
+    try:
+        return decompress(gz_path)
+    except (OSError, EOFError):
+        logger.exception(f"The arXiv object {gz_path} could not be decompressed")
+        return None
+    finally:
+        os.remove(gz_path)
+
+
+class ArxivFetcher:
+    def __init__(self, swift_handler, workers: int = DEFAULT_DECOMPRESSION_WORKERS):
+        self.swift_handler = swift_handler
+        self.workers = workers
+
+    def prefetch(self, object_names: List[str]) -> int:
+        """Download and decompress the objects that have not been prefetched yet.
+        Returns the number of PDFs prefetched"""
+        object_names = sorted({object_name for object_name in object_names
+                               if not os.path.exists(get_prefetched_path(object_name))})
+        if not object_names:
+            return 0
+        gz_paths = self.swift_handler.download_objects(ARXIV_CONTAINER, object_names, ARXIV_PREFETCH_DIR)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            prefetched = [path for path in executor.map(_inflate, gz_paths) if path is not None]
+        logger.debug(f"{len(prefetched)} arXiv publications prefetched out of {len(object_names)}")
+        return len(prefetched)
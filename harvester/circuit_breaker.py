@@ -0,0 +1,66 @@
+"""Circuit breaker of the hosts, shared by the harvesting jobs of a worker through LMDB.
+
+Each partition job would otherwise rediscover the same dead repositories and wait out their timeouts for each
+publication. The timeouts and connection errors of a host are counted, the count being forgotten failure_ttl
+seconds after the last failure. After failure_threshold failures the circuit of the host opens: its downloads
+are skipped for open_duration seconds. Then the next downloads are tried again (half-open), a success closing
+the circuit and a failure opening it again.
+
+key = host, value = {"failures": ..., "last_failure": timestamp, "opened_until": timestamp}
+"""
+import pickle
+from time import time
+
+import lmdb
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_DURATION = 3600
+DEFAULT_FAILURE_TTL = 600
+
+
+class CircuitBreaker:
+    def __init__(self, env: lmdb.Environment, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 open_duration: float = DEFAULT_OPEN_DURATION, failure_ttl: float = DEFAULT_FAILURE_TTL):
+        self.env = env
+        self.failure_threshold = failure_threshold
+        self.open_duration = open_duration
+        self.failure_ttl = failure_ttl
+
+    @classmethod
+    def from_config(cls, env: lmdb.Environment, circuit_breaker_config: dict) -> "CircuitBreaker":
+        return cls(env, circuit_breaker_config.get("failure_threshold", DEFAULT_FAILURE_THRESHOLD),
+                   circuit_breaker_config.get("open_duration", DEFAULT_OPEN_DURATION),
+                   circuit_breaker_config.get("failure_ttl", DEFAULT_FAILURE_TTL))
+
+    @staticmethod
+    def _get(txn, host: str) -> dict:
+        value = txn.get(host.encode(encoding="UTF-8"))
+        return pickle.loads(value) if value else {"failures": 0, "last_failure": 0, "opened_until": 0}
+
+    def is_open(self, host: str) -> bool:
+        with self.env.begin() as txn:
+            return self._get(txn, host)["opened_until"] > time()
+
+    def record_failure(self, host: str) -> bool:
+        """Count a timeout or connection error of the host. Returns True if the circuit opens"""
+        now = time()
+        with self.env.begin(write=True) as txn:
+            state = self._get(txn, host)
+            is_half_open = 0 < state["opened_until"] <= now
+            if now - state["last_failure"] > self.failure_ttl and not is_half_open:
+                state["failures"] = 0
+            state["failures"] += 1
+            state["last_failure"] = now
+            is_opening = is_half_open or (state["failures"] >= self.failure_threshold and state["opened_until"] == 0)
+            if is_opening:
+                state["opened_until"] = now + self.open_duration
+            txn.put(host.encode(encoding="UTF-8"), pickle.dumps(state))
+        return is_opening
+
+    def record_success(self, host: str) -> None:
+        key = host.encode(encoding="UTF-8")
+        with self.env.begin() as txn:
+            if txn.get(key) is None:
+                return
+        with self.env.begin(write=True) as txn:
+            txn.delete(key)
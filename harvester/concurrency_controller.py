@@ -0,0 +1,102 @@
+"""Adaptive number of downloads in flight.
+
+A fixed number of download threads is either too low to saturate the link of a large worker or too high for a
+small one. The controller lets at most "concurrency" downloads run and adjusts it every interval seconds from the
+downloads finished during the interval (hill climbing):
+- halved when the transient error rate exceeds max_error_rate or the mean latency exceeds max_latency_ratio times
+  the best mean latency seen, the link or the hosts being saturated,
+- increased by a quarter while the throughput (successful downloads per second) does not drop,
+- decreased by a quarter when the throughput drops, the last increase having been too much,
+always within [min_concurrency, max_concurrency].
+"""
+from threading import Condition
+from time import monotonic
+from typing import Callable, Optional
+
+DEFAULT_MIN_CONCURRENCY = 4
+DEFAULT_INTERVAL = 10.0
+DEFAULT_MAX_ERROR_RATE = 0.3
+DEFAULT_MAX_LATENCY_RATIO = 3.0
+STEP_RATIO = 0.25
+# Throughput drops smaller than this ratio are noise
+THROUGHPUT_TOLERANCE = 0.05
+
+
+class ConcurrencyController:
+    def __init__(self, min_concurrency: int = DEFAULT_MIN_CONCURRENCY, max_concurrency: int = 64,
+                 interval: float = DEFAULT_INTERVAL, max_error_rate: float = DEFAULT_MAX_ERROR_RATE,
+                 max_latency_ratio: float = DEFAULT_MAX_LATENCY_RATIO,
+                 on_adjust: Optional[Callable[[int, dict], None]] = None):
+        """on_adjust(concurrency, stats) is called after each adjustment"""
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(max_concurrency, min_concurrency)
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        self.max_latency_ratio = max_latency_ratio
+        self.on_adjust = on_adjust
+        self.concurrency = min_concurrency
+        self._condition = Condition()
+        self._in_flight = 0
+        self._previous_throughput = None
+        self._best_latency = None
+        self._reset_window(monotonic())
+
+    @classmethod
+    def from_config(cls, controller_config: dict, max_concurrency: int,
+                    on_adjust: Optional[Callable[[int, dict], None]] = None) -> "ConcurrencyController":
+        return cls(controller_config.get("min_concurrency", DEFAULT_MIN_CONCURRENCY),
+                   controller_config.get("max_concurrency", max_concurrency),
+                   controller_config.get("interval", DEFAULT_INTERVAL),
+                   controller_config.get("max_error_rate", DEFAULT_MAX_ERROR_RATE),
+                   controller_config.get("max_latency_ratio", DEFAULT_MAX_LATENCY_RATIO),
+                   on_adjust)
+
+    def _reset_window(self, now: float) -> None:
+        self._window_start = now
+        self._completed = 0
+        self._successes = 0
+        self._errors = 0
+        self._latency_sum = 0.0
+
+    def acquire(self) -> None:
+        """Block until a download can be started"""
+        with self._condition:
+            while self._in_flight >= self.concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency: Optional[float] = None, success: bool = False, error: bool = False) -> None:
+        """End of a download which lasted latency seconds (None when no download was made). error tells if it
+        failed for a transient reason (timeout, 5xx, 429...)"""
+        with self._condition:
+            self._in_flight -= 1
+            if latency is not None:
+                self._completed += 1
+                self._successes += success
+                self._errors += error
+                self._latency_sum += latency
+            now = monotonic()
+            stats = None
+            if now - self._window_start >= self.interval and self._completed > 0:
+                stats = self._adjust(now)
+            self._condition.notify_all()
+        if stats is not None and self.on_adjust is not None:
+            self.on_adjust(stats["concurrency"], stats)
+
+    def _adjust(self, now: float) -> dict:
+        throughput = self._successes / (now - self._window_start)
+        error_rate = self._errors / self._completed
+        latency = self._latency_sum / self._completed
+        self._best_latency = latency if self._best_latency is None else min(self._best_latency, latency)
+        step = max(1, round(self.concurrency * STEP_RATIO))
+        if error_rate > self.max_error_rate or latency > self.max_latency_ratio * self._best_latency:
+            concurrency = self.concurrency // 2
+        elif self._previous_throughput is None or throughput >= self._previous_throughput * (1 - THROUGHPUT_TOLERANCE):
+            concurrency = self.concurrency + step
+        else:
+            concurrency = self.concurrency - step
+        self.concurrency = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+        self._previous_throughput = throughput
+        self._reset_window(now)
+        return {"concurrency": self.concurrency, "throughput": round(throughput, 3),
+                "error_rate": round(error_rate, 3), "latency": round(latency, 3)}
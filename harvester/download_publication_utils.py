@@ -1,17 +1,29 @@
 import os
 import re
 import subprocess
-from time import sleep
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Event, Lock, local
+from time import monotonic, sleep
 from typing import Tuple
 
 import cloudscraper
 from bs4 import BeautifulSoup
-from requests import ConnectTimeout
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
 
 from application.server.main.logger import get_logger
 from config.logger_config import LOGGER_LEVEL
 from config.path_config import COMPRESSION_EXT, PUBLICATION_EXT
-from harvester.exception import EmptyFileContentException, PublicationDownloadFileException, FailedRequest
+from harvester.arxiv_fetcher import take_prefetched
+from harvester.circuit_breaker import CircuitBreaker
+from harvester.exception import (EmptyFileContentException, HostUnavailableException,
+                                 PublicationDownloadFileException, FailedRequest, RateLimitedException,
+                                 SlowTransferException, UnsuccessfulResponseException)
+from harvester.host_scheduler import get_host
+from harvester.pdf_stream import (CHUNK_SIZE, PDF_MAGIC, TransferBudget, TransferLimits, peek, read_stream,
+                                  write_pdf_stream)
 from utils.file import is_file_not_empty, decompress
 from harvester.base_api_client import BaseAPIClient
 
@@ -19,50 +31,214 @@ logger = get_logger(__name__, level=LOGGER_LEVEL)
 
 SUCCESS_DOWNLOAD = 'success'
 FAIL_DOWNLOAD = 'fail'
+RATE_LIMITED_DOWNLOAD = 'rate_limited'
+CIRCUIT_OPEN_DOWNLOAD = 'circuit_open'
+# A transient failure may not happen again later, unlike a permanent one
+TRANSIENT_FAILURE = 'transient'
+PERMANENT_FAILURE = 'permanent'
+TRANSIENT_STATUS_CODES = (408, 425, 429)
+RATE_LIMITED_STATUS_CODES = (429, 503)
+DEFAULT_RETRY_AFTER = 30
+MAX_RETRY_AFTER = 600
+CONNECTION_ERRORS = (Timeout, RequestsConnectionError)
 ARXIV_HARVESTER = 'arxiv'
 STANDARD_HARVESTER = 'standard'
 WILEY_HARVESTER = 'wiley'
 ELSEVIER_HARVESTER = 'elsevier'
+DEFAULT_HEDGED_URLS = 2
+DEFAULT_HEDGING_DELAY = 5
+_scrapers = local()  # cloudscraper scraper of each download thread (see _get_scraper)
 
 
-def _download_publication(urls, filename, local_entry, wiley_client, elsevier_client):
+def _download_publication(urls, filename, local_entry, wiley_client, elsevier_client, hedging=None,
+                          circuit_breaker: CircuitBreaker = None, transfer_limits: TransferLimits = None):
+    """Try the urls in order until one gives the publication. With hedging ({"max_urls": k, "delay": seconds}),
+    the first k urls are raced (see _hedged_download) before the next ones are tried in order.
+    The urls of the hosts whose circuit is open are skipped, the result being CIRCUIT_OPEN_DOWNLOAD when
+    the other urls failed so that the publication can be harvested again later.
+    When the download fails, local_entry['failure'] tells if it is transient or permanent (see classify_failure),
+    the urls being kept in local_entry['urls'] when it is transient.
+    With transfer_limits, the standard downloads of the urls share the deadline of the publication and the
+    transfers below the minimum bandwidth are aborted"""
     result = FAIL_DOWNLOAD
+    all_urls = urls
+    failures = []
+    budget = transfer_limits.new_budget() if transfer_limits is not None else None
     doi = local_entry['doi']
     logger.info(f'*** Start downloading the publication with doi = {doi}. {len(urls)} urls will be tested.')
+    rate_limit = None
+    harvester_used, url_used = '', ''
+    skipped_urls = []
+    if circuit_breaker is not None:
+        skipped_urls = [url for url in urls if circuit_breaker.is_open(get_host([url]))]
+        if skipped_urls:
+            logger.debug(f'The circuit of the hosts of {skipped_urls} is open, these urls are skipped. doi = {doi}')
+            urls = [url for url in urls if url not in skipped_urls]
+    if hedging and len(urls) > 1:
+        hedged_urls = urls[:hedging.get('max_urls', DEFAULT_HEDGED_URLS)]
+        result, harvester_used, url_used, rate_limit = _hedged_download(
+            hedged_urls, filename, doi, wiley_client, elsevier_client, hedging.get('delay', DEFAULT_HEDGING_DELAY),
+            circuit_breaker, failures, budget)
+        urls = urls[len(hedged_urls):]
     for url in urls:
+        if result == SUCCESS_DOWNLOAD:
+            break
         try:
             logger.debug(f"Doi = {doi}, Publication URL to download = {url}")
-            if url.startswith('http://arxiv.org') or url.startswith('https://arxiv.org'):
-                result, harvester_used = arxiv_download(url, filename, doi)
-                if result == SUCCESS_DOWNLOAD:
-                    break
-            elif wiley_client and 'wiley' in url:  # Wiley client can be None in case of an initialization problem
-                result, _ = publisher_api_download(doi, filename, wiley_client)
-                harvester_used = WILEY_HARVESTER
-                if result == SUCCESS_DOWNLOAD:
-                    break
-            elif elsevier_client and 'elsevier' in url:  # Elsevier client can be None in case of an initialization problem
-                result, _ = publisher_api_download(doi, filename, elsevier_client)
-                harvester_used = ELSEVIER_HARVESTER
-                if result == SUCCESS_DOWNLOAD:
-                    break
-            # standard download always done if other methods do not work
-            result, harvester_used = standard_download(url, filename, doi)
-            break
-        except (PublicationDownloadFileException, Exception):
+            result, harvester_used = _download_from_url(url, filename, doi, wiley_client, elsevier_client,
+                                                        budget=budget)
+            url_used = url
+        except RateLimitedException as e:
+            logger.warning(f'The publication with doi = {doi} download was rate limited by {e.host}. url = {url}')
+            rate_limit = {'host': e.host, 'retry_after': e.retry_after}
+            harvester_used, url_used = '', ''
+        except HostUnavailableException as e:
+            _record_host_failure(circuit_breaker, doi, url, e)
+            failures.append(TRANSIENT_FAILURE)
+            harvester_used, url_used = '', ''
+        except (PublicationDownloadFileException, Exception) as e:
             logger.exception(f'The publication with doi = {doi} download failed with url = {url}', exc_info=True)
-            harvester_used, url = '', ''
+            failures.append(classify_failure(e))
+            harvester_used, url_used = '', ''
 
+    if result == SUCCESS_DOWNLOAD and circuit_breaker is not None:
+        circuit_breaker.record_success(get_host([url_used]))
+    elif result != SUCCESS_DOWNLOAD and rate_limit:
+        # The download can be retried once the host accepts requests again
+        result = RATE_LIMITED_DOWNLOAD
+        local_entry['rate_limit'] = rate_limit
+    elif result != SUCCESS_DOWNLOAD and skipped_urls:
+        result = CIRCUIT_OPEN_DOWNLOAD
+    if result != SUCCESS_DOWNLOAD:
+        is_transient = rate_limit is not None or len(skipped_urls) > 0 or TRANSIENT_FAILURE in failures
+        local_entry['failure'] = TRANSIENT_FAILURE if is_transient else PERMANENT_FAILURE
+        if is_transient:
+            local_entry['urls'] = all_urls
     local_entry['harvester_used'] = harvester_used
-    local_entry['url_used'] = url
+    local_entry['url_used'] = url_used
     return result, local_entry
 
 
+def _download_from_url(url, filename, doi, wiley_client, elsevier_client, cancel: Event = None,
+                       budget: TransferBudget = None) -> Tuple[str, str]:
+    """Download the publication from a single url. Raises an exception when the standard download fails"""
+    if url.startswith('http://arxiv.org') or url.startswith('https://arxiv.org'):
+        result, harvester_used = arxiv_download(url, filename, doi)
+        if result == SUCCESS_DOWNLOAD:
+            return result, harvester_used
+    elif wiley_client and 'wiley' in url:  # Wiley client can be None in case of an initialization problem
+        result, _ = publisher_api_download(doi, filename, wiley_client)
+        if result == SUCCESS_DOWNLOAD:
+            return result, WILEY_HARVESTER
+    elif elsevier_client and 'elsevier' in url:  # Elsevier client can be None in case of an initialization problem
+        result, _ = publisher_api_download(doi, filename, elsevier_client)
+        if result == SUCCESS_DOWNLOAD:
+            return result, ELSEVIER_HARVESTER
+    # standard download always done if other methods do not work
+    return standard_download(url, filename, doi, cancel=cancel, budget=budget)
+
+
+def _hedged_download(urls, filename, doi, wiley_client, elsevier_client, delay, circuit_breaker: CircuitBreaker = None,
+                     failures: list = None, budget: TransferBudget = None):
+    """Race the downloads of the urls: the download of a url starts when the previous one failed or has not
+    finished after delay seconds (0 starts them all at once). Each download writes its own file, the first PDF
+    is renamed to filename and the other downloads are cancelled, their files being removed.
+    Returns result, harvester_used, url_used, rate_limit, the classification of the failures being added
+    to failures"""
+    failures = [] if failures is None else failures
+    cancel = Event()
+    lock = Lock()
+    finished_filenames = []  # files of the downloads finished before the race was won
+
+    def download(url, attempt_filename):
+        try:
+            return _download_from_url(url, attempt_filename, doi, wiley_client, elsevier_client, cancel, budget)
+        finally:
+            with lock:
+                if cancel.is_set():
+                    _remove_file(attempt_filename)
+                else:
+                    finished_filenames.append(attempt_filename)
+
+    result, harvester_used, url_used, rate_limit = FAIL_DOWNLOAD, '', '', None
+    pending = {}
+    next_url = 0
+    executor = ThreadPoolExecutor(max_workers=len(urls))
+    try:
+        while result != SUCCESS_DOWNLOAD and (pending or next_url < len(urls)):
+            timeout = None
+            if next_url < len(urls):
+                attempt_filename = f'{filename}.{next_url}'
+                pending[executor.submit(download, urls[next_url], attempt_filename)] = (urls[next_url],
+                                                                                        attempt_filename)
+                next_url += 1
+                timeout = delay if next_url < len(urls) else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, attempt_filename = pending.pop(future)
+                try:
+                    attempt_result, attempt_harvester_used = future.result()
+                except RateLimitedException as e:
+                    logger.warning(f'The publication with doi = {doi} download was rate limited by {e.host}. url = {url}')
+                    rate_limit = {'host': e.host, 'retry_after': e.retry_after}
+                    continue
+                except HostUnavailableException as e:
+                    _record_host_failure(circuit_breaker, doi, url, e)
+                    failures.append(TRANSIENT_FAILURE)
+                    continue
+                except (PublicationDownloadFileException, Exception) as e:
+                    logger.exception(f'The publication with doi = {doi} download failed with url = {url}', exc_info=True)
+                    failures.append(classify_failure(e))
+                    continue
+                if attempt_result == SUCCESS_DOWNLOAD and result != SUCCESS_DOWNLOAD:
+                    result, harvester_used, url_used = attempt_result, attempt_harvester_used, url
+                    os.replace(attempt_filename, filename)
+    finally:
+        with lock:
+            cancel.set()
+            for attempt_filename in finished_filenames:
+                _remove_file(attempt_filename)
+        # The downloads still in flight stop at their next chunk, they are not waited for
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+    if result == SUCCESS_DOWNLOAD:
+        logger.debug(f'The publication with doi = {doi} was downloaded first from url = {url_used}')
+    return result, harvester_used, url_used, rate_limit
+
+
+def classify_failure(exception: Exception) -> str:
+    """Timeouts, connection errors, 5xx and 429 answers are transient failures. The others (404, not a PDF...)
+    are permanent"""
+    if isinstance(exception, (HostUnavailableException, RateLimitedException, SlowTransferException)):
+        return TRANSIENT_FAILURE
+    if isinstance(exception, UnsuccessfulResponseException) and (
+            exception.status_code >= 500 or exception.status_code in TRANSIENT_STATUS_CODES):
+        return TRANSIENT_FAILURE
+    return PERMANENT_FAILURE
+
+
+def _record_host_failure(circuit_breaker: CircuitBreaker, doi, url, e: HostUnavailableException):
+    logger.warning(f'The publication with doi = {doi} download failed, {e.host} is unavailable. url = {url}')
+    if circuit_breaker is not None and circuit_breaker.record_failure(e.host):
+        logger.warning(f'The circuit of {e.host} is open, its downloads are skipped')
+
+
+def _remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
 def arxiv_download(url: str, filepath: str, doi: str) -> Tuple[str, str]:
+    """The PDF prefetched by the ArxivFetcher of the harvester is used when there is one,
+    otherwise it is downloaded with the swift CLI"""
     from config.swift_cli_config import init_cmd
     ovh_arxiv_file_pdf_gz = url_to_path(url)
     result, harvester_used = FAIL_DOWNLOAD, ARXIV_HARVESTER
-    if ovh_arxiv_file_pdf_gz:
+    if ovh_arxiv_file_pdf_gz and take_prefetched(ovh_arxiv_file_pdf_gz, filepath):
+        result = SUCCESS_DOWNLOAD
+        logger.debug(f'The publication with doi = {doi} was prefetched from arXiv_harvesting. url = {url}')
+    elif ovh_arxiv_file_pdf_gz:
         filepath_gz = filepath + COMPRESSION_EXT
         subprocess.check_call(f'{init_cmd} download arxiv_harvesting {ovh_arxiv_file_pdf_gz} -o {filepath_gz}',
                               shell=True)
@@ -88,45 +264,99 @@ def publisher_api_download(doi: str, filepath: str, client:BaseAPIClient) -> Tup
     return result, harvester_used
 
 
-def standard_download(url: str, filename: str, doi: str) -> Tuple[str, str]:
-    scraper = cloudscraper.create_scraper(interpreter='nodejs')
-    content = _process_request(scraper, url)
-    if not content:
+def _get_scraper():
+    """cloudscraper scraper of the calling thread, created at its first download. The connections of the scraper
+    are kept alive for the next downloads of the thread, the Cloudflare challenges being only solved when one
+    is served"""
+    scraper = getattr(_scrapers, 'scraper', None)
+    if scraper is None:
+        scraper = _scrapers.scraper = cloudscraper.create_scraper(interpreter='nodejs')
+    return scraper
+
+
+def standard_download(url: str, filename: str, doi: str, cancel: Event = None,
+                      budget: TransferBudget = None) -> Tuple[str, str]:
+    """Download with the cloudscraper scraper of the thread (see _get_scraper).
+    The download stops with a DownloadCancelledException once cancel is set and with a SlowTransferException
+    when the budget is exceeded"""
+    downloaded = _process_request(_get_scraper(), url, filename, cancel=cancel, budget=budget)
+    if not downloaded:
         logger.error(f'The publication with doi = {doi} download failed via standard request. File content is empty')
         raise EmptyFileContentException(
             f'The PDF content returned by _process_request is empty (standard download). doi = {doi}, URL = {url}')
 
     logger.debug(f'The publication with doi = {doi} was successfully downloaded via standard request')
-    with open(filename, 'wb') as f_out:
-        f_out.write(content)
     result, harvester_used = SUCCESS_DOWNLOAD, STANDARD_HARVESTER
     return result, harvester_used
 
 
-def _process_request(scraper, url, n=0, timeout_in_seconds=60):
+def _process_request(scraper, url, filename, n=0, timeout_in_seconds=60, cancel: Event = None,
+                     budget: TransferBudget = None) -> bool:
+    """Stream the response body to filename when it is a PDF. Only the first bytes are read to recognize a PDF
+    and, when it is not one, at most MAX_HTML_SIZE bytes of the page to look for a redirection.
+    Returns True when the PDF has been written"""
+    if budget is not None:
+        timeout_in_seconds = budget.get_timeout(timeout_in_seconds)
     try:
         if "cairn" in url:
             headers = {'User-Agent': 'MESRI-Barometre-de-la-Science-Ouverte'}
-            response = scraper.get(url, headers=headers, timeout=timeout_in_seconds)
-        else:
-            response = scraper.get(url, timeout=timeout_in_seconds)
-        if response.status_code == 200:
-            if response.text[:5] == '%PDF-':
-                return response.content
-            elif n < 5:
-                soup = BeautifulSoup(response.text, 'html.parser')
-                if soup.select_one('a#redirect'):
-                    redirect_url = soup.select_one('a#redirect')['href']
-                    logger.debug('Waiting 5 seconds before following redirect url')
-                    sleep(5)
-                    logger.debug(f'Retry number {n + 1}')
-                    return _process_request(scraper, redirect_url, n + 1)
+            response = scraper.get(url, headers=headers, timeout=timeout_in_seconds, stream=True)
         else:
-            logger.debug(
-                f"Response code is not successful: {response.status_code}. Response content = {response.content}")
-    except ConnectTimeout:
-        logger.exception("Connection Timeout", exc_info=True)
-        return
+            response = scraper.get(url, timeout=timeout_in_seconds, stream=True)
+        try:
+            if response.status_code == 200:
+                start = monotonic()
+                page = None
+                try:
+                    # The watchdog of the budget aborts the response when a read blocks past the budget
+                    with budget.watch(response) if budget is not None else nullcontext() as transfer:
+                        head, chunks = peek(response.iter_content(CHUNK_SIZE), len(PDF_MAGIC))
+                        if head == PDF_MAGIC:
+                            size = write_pdf_stream(chunks, filename, cancel=cancel, budget=transfer,
+                                                    content_length=response.headers.get('Content-Length'))
+                        elif n < 5:
+                            page = read_stream(chunks)
+                except SlowTransferException:
+                    budget.limits.record(get_host([url]), 0, monotonic() - start, slow=True)
+                    raise
+                if head == PDF_MAGIC:
+                    if budget is not None:
+                        budget.limits.record(get_host([url]), size, monotonic() - start)
+                    return True
+                elif page is not None:
+                    soup = BeautifulSoup(page, 'html.parser')
+                    if soup.select_one('a#redirect'):
+                        redirect_url = soup.select_one('a#redirect')['href']
+                        logger.debug('Waiting 5 seconds before following redirect url')
+                        sleep(5)
+                        logger.debug(f'Retry number {n + 1}')
+                        return _process_request(scraper, redirect_url, filename, n + 1, cancel=cancel,
+                                                budget=budget)
+            elif response.status_code in RATE_LIMITED_STATUS_CODES:
+                raise RateLimitedException(f'Response code {response.status_code}, URL = {url}', get_host([url]),
+                                           parse_retry_after(response.headers.get('Retry-After')))
+            else:
+                raise UnsuccessfulResponseException(f'Response code {response.status_code}, URL = {url}',
+                                                    response.status_code)
+        finally:
+            response.close()
+    except CONNECTION_ERRORS as e:
+        raise HostUnavailableException(f'{type(e).__name__}, URL = {url}', get_host([url]))
+    return False
+
+
+def parse_retry_after(retry_after) -> float:
+    """Retry-After header (delay in seconds or HTTP date) -> delay in seconds"""
+    if not retry_after:
+        return DEFAULT_RETRY_AFTER
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+    return min(max(delay, 0), MAX_RETRY_AFTER)
 
 
 def url_to_path(url, ext=PUBLICATION_EXT + COMPRESSION_EXT):
@@ -13,3 +13,45 @@ class EmptyFileContentException(PublicationDownloadFileException):
 class FailedRequest(PublicationDownloadFileException):
     pass
 
+
+class RateLimiterUnavailableException(FailedRequest):
+    """No slot of the rate limiter of a publisher API could be reserved in time"""
+
+
+class RateLimitedException(PublicationDownloadFileException):
+    """The host answered 429 or 503: it has to be left alone for retry_after seconds"""
+
+    def __init__(self, message: str, host: str, retry_after: float):
+        super().__init__(message)
+        self.host = host
+        self.retry_after = retry_after
+
+
+class NotAPdfException(PublicationDownloadFileException):
+    pass
+
+
+class FileTooLargeException(PublicationDownloadFileException):
+    pass
+
+
+class DownloadCancelledException(PublicationDownloadFileException):
+    pass
+
+
+class HostUnavailableException(PublicationDownloadFileException):
+    """Timeout or connection error"""
+
+    def __init__(self, message, host):
+        super().__init__(message)
+        self.host = host
+
+
+class UnsuccessfulResponseException(PublicationDownloadFileException):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SlowTransferException(PublicationDownloadFileException):
+    """Deadline exceeded or bandwidth below the minimum"""
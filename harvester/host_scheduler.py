@@ -0,0 +1,147 @@
+"""Per host politeness scheduler of the downloads.
+
+The publications of a dump come in bursts of the same repository or publisher. The scheduler keeps a queue of
+downloads per host and hands them out to the download workers round-robin across the hosts, a host being skipped
+while it has max_concurrency_per_host downloads in flight or its last request is less than min_delay_per_host
+seconds old. The host of a download is the host of its first url, the one most of the downloads end up using.
+
+The concurrency of a host adapts to its answers (AIMD): it is halved when the host pushes back (429/503) and the
+host is left alone for the advertised Retry-After delay, then it grows back by one download every "concurrency"
+successful downloads up to max_concurrency_per_host. Downloads put back with put_later wait in the scheduler,
+not in a worker.
+"""
+import heapq
+from itertools import count
+from collections import defaultdict, deque
+from threading import Condition
+from time import monotonic
+from typing import Any, List, Optional, Tuple
+from urllib.parse import urlparse
+
+DEFAULT_MAX_CONCURRENCY_PER_HOST = 4
+DEFAULT_MIN_DELAY_PER_HOST = 1.0
+
+
+def get_host(urls: List[str]) -> str:
+    return urlparse(urls[0]).netloc.lower() if urls else ''
+
+
+class HostScheduler:
+    def __init__(self, max_concurrency_per_host: int = DEFAULT_MAX_CONCURRENCY_PER_HOST,
+                 min_delay_per_host: float = DEFAULT_MIN_DELAY_PER_HOST, maxsize: int = 0):
+        """maxsize bounds the number of queued downloads (0 for no bound): put blocks until there is room"""
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.min_delay_per_host = min_delay_per_host
+        self.maxsize = maxsize
+        self._condition = Condition()
+        self._queues = {}
+        self._hosts = deque()  # round-robin order of the hosts with queued downloads
+        self._in_flight = defaultdict(int)
+        self._total_in_flight = 0
+        self._concurrency = defaultdict(lambda: float(self.max_concurrency_per_host))
+        self._next_request = defaultdict(float)
+        self._delayed = []  # heap of (ready time, sequence number, host, item) of the downloads put back
+        self._sequence = count()
+        self._size = 0
+        self._closed = False
+
+    @classmethod
+    def from_config(cls, scheduler_config: Optional[dict], maxsize: int = 0) -> "HostScheduler":
+        """Without configuration, the hosts are only interleaved"""
+        if scheduler_config is None:
+            return cls(float("inf"), 0, maxsize)
+        return cls(scheduler_config.get("max_concurrency_per_host", DEFAULT_MAX_CONCURRENCY_PER_HOST),
+                   scheduler_config.get("min_delay_per_host", DEFAULT_MIN_DELAY_PER_HOST), maxsize)
+
+    def __len__(self):
+        with self._condition:
+            return self._size
+
+    def put(self, item: Any, host: str) -> None:
+        with self._condition:
+            while self.maxsize and self._size >= self.maxsize:
+                self._condition.wait()
+            if host not in self._queues:
+                self._queues[host] = deque()
+                self._hosts.append(host)
+            self._queues[host].append(item)
+            self._size += 1
+            self._condition.notify_all()
+
+    def put_later(self, item: Any, host: str, delay: float) -> None:
+        """Put a download back, it is handed out again after delay seconds. It does not block on maxsize
+        as it is called by the download workers"""
+        with self._condition:
+            heapq.heappush(self._delayed, (monotonic() + delay, next(self._sequence), host, item))
+            self._condition.notify_all()
+
+    def _enqueue_ready_downloads(self, now: float) -> None:
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, host, item = heapq.heappop(self._delayed)
+            if host not in self._queues:
+                self._queues[host] = deque()
+                self._hosts.append(host)
+            self._queues[host].append(item)
+            self._size += 1
+
+    def close(self) -> None:
+        """No more downloads will be put: get returns None once every download has been handed out and the ones
+        in flight are over, as they can be put back"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def get(self) -> Optional[Tuple[str, Any]]:
+        """Block until a download can be started. Returns (host, item), the caller has to call done(host)
+        once the download is over"""
+        with self._condition:
+            while True:
+                if self._closed and self._size == 0 and not self._delayed and self._total_in_flight == 0:
+                    return None
+                now = monotonic()
+                self._enqueue_ready_downloads(now)
+                wait = self._delayed[0][0] - now if self._delayed else None
+                for _ in range(len(self._hosts)):
+                    host = self._hosts[0]
+                    self._hosts.rotate(-1)
+                    if self._in_flight[host] + 1 > self._concurrency[host]:
+                        continue
+                    delay = self._next_request[host] - now
+                    if delay > 0:
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                    item = self._queues[host].popleft()
+                    if not self._queues[host]:
+                        del self._queues[host]
+                        self._hosts.pop()  # the host has just been rotated to the end
+                    self._size -= 1
+                    self._in_flight[host] += 1
+                    self._total_in_flight += 1
+                    self._next_request[host] = now + self.min_delay_per_host
+                    self._condition.notify_all()
+                    return host, item
+                self._condition.wait(timeout=wait)
+
+    def done(self, host: str) -> None:
+        with self._condition:
+            self._in_flight[host] -= 1
+            self._total_in_flight -= 1
+            self._condition.notify_all()
+
+    def success(self, host: str) -> None:
+        """Additive increase of the concurrency of the host"""
+        with self._condition:
+            concurrency = self._concurrency[host]
+            self._concurrency[host] = min(concurrency + 1 / concurrency, self.max_concurrency_per_host)
+            self._condition.notify_all()
+
+    def pushback(self, host: str, retry_after: float) -> None:
+        """Multiplicative decrease of the concurrency of the host, which is left alone for retry_after seconds"""
+        with self._condition:
+            concurrency = min(self._concurrency[host], max(self._in_flight[host], 1))
+            self._concurrency[host] = max(concurrency / 2, 1.0)
+            self._next_request[host] = max(self._next_request[host], monotonic() + retry_after)
+
+    def get_concurrency(self, host: str) -> float:
+        with self._condition:
+            return self._concurrency[host]
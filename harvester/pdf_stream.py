@@ -0,0 +1,230 @@
+"""Streaming of the downloaded publications to disk.
+
+The body of a response is read by chunks: only a chunk is held in memory, the %PDF- magic bytes are checked on the
+first bytes and the download is aborted as soon as it is not a PDF or exceeds MAX_PDF_SIZE, without decoding
+the body as text.
+
+A download can also be given a TransferBudget: a deadline for the whole download of the publication (every url
+tried) and a minimum bandwidth, so that a server trickling bytes does not hold a download slot. The socket timeouts
+only bound each recv and a read only returns once a whole chunk is received: the transfers being read are watched
+by a watchdog thread of the TransferLimits which aborts the response of a transfer out of budget, its blocked read
+returning or failing right away (see TransferBudget.watch).
+"""
+import os
+import socket
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Iterable, Iterator, Optional, Tuple
+
+from harvester.exception import (DownloadCancelledException, FileTooLargeException, NotAPdfException,
+                                 SlowTransferException)
+
+PDF_MAGIC = b"%PDF-"
+CHUNK_SIZE = 64 * 1024  # memory budget of a download
+MAX_PDF_SIZE = 200 * 1024 * 1024  # byte budget of a download
+MAX_HTML_SIZE = 2 * 1024 * 1024  # size of the landing pages read to look for a redirection
+# The bandwidth of a transfer is only checked after its first seconds (TCP slow start, server latency)
+DEFAULT_GRACE_PERIOD = 10.0
+WATCHDOG_INTERVAL = 0.5  # seconds between two checks of the transfers being read
+
+
+def abort_response(response) -> None:
+    """Abort a response being read by another thread. Closing a requests response does not wake up a blocked
+    read, shutting its socket down does"""
+    # requests response -> urllib3 response -> http.client response -> socket file -> SocketIO -> socket, the
+    # connection giving its socket up to the response when the server closes the connection after it
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class TransferLimits:
+    """Limits of the downloads of a harvester: deadline seconds for the download of a publication and
+    min_bandwidth bytes per second for a transfer once its grace_period seconds are over (None for no limit).
+    The transfers are counted per host, with the slow ones"""
+
+    def __init__(self, deadline: Optional[float] = None, min_bandwidth: Optional[float] = None,
+                 grace_period: float = DEFAULT_GRACE_PERIOD):
+        self.deadline = deadline
+        self.min_bandwidth = min_bandwidth
+        self.grace_period = grace_period
+        self._lock = Lock()
+        self._stats = defaultdict(lambda: {"transfers": 0, "slow_transfers": 0, "bytes": 0, "seconds": 0.0})
+        self._transfers = {}  # watched TransferBudget -> response
+        self._watchdog = None
+
+    @classmethod
+    def from_config(cls, limits_config: dict) -> "TransferLimits":
+        return cls(limits_config.get("deadline"), limits_config.get("min_bandwidth"),
+                   limits_config.get("grace_period", DEFAULT_GRACE_PERIOD))
+
+    def new_budget(self) -> "TransferBudget":
+        """Budget of the download of a publication, its deadline starting now"""
+        return TransferBudget(self, monotonic() + self.deadline if self.deadline else None)
+
+    def record(self, host: str, size: int, seconds: float, slow: bool = False) -> None:
+        with self._lock:
+            stats = self._stats[host]
+            stats["transfers"] += 1
+            stats["slow_transfers"] += slow
+            stats["bytes"] += size
+            stats["seconds"] += seconds
+
+    def get_stats(self) -> dict:
+        """{host: {"transfers", "slow_transfers", "bytes", "seconds"}}"""
+        with self._lock:
+            return {host: dict(stats) for host, stats in self._stats.items()}
+
+    def _watch(self, transfer: "TransferBudget", response) -> None:
+        with self._lock:
+            self._transfers[transfer] = response
+            if self._watchdog is None:
+                self._watchdog = Thread(target=self._run_watchdog, name="transfer-watchdog", daemon=True)
+                self._watchdog.start()
+
+    def _unwatch(self, transfer: "TransferBudget") -> None:
+        with self._lock:
+            self._transfers.pop(transfer, None)
+
+    def _run_watchdog(self) -> None:
+        """Abort the responses of the transfers out of budget. The thread stops once no transfer is watched"""
+        while True:
+            sleep(WATCHDOG_INTERVAL)
+            with self._lock:
+                if not self._transfers:
+                    self._watchdog = None
+                    return
+                transfers = list(self._transfers.items())
+            for transfer, response in transfers:
+                if transfer.aborted is None:
+                    transfer.aborted = transfer.get_overrun()
+                    if transfer.aborted is not None:
+                        abort_response(response)
+
+
+class TransferBudget:
+    def __init__(self, limits: TransferLimits, deadline: Optional[float]):
+        self.limits = limits
+        self.deadline = deadline  # monotonic time
+        # State of a watched transfer: its start, the bytes received and why the watchdog aborted it
+        self.start = monotonic()
+        self.received = 0
+        self.aborted = None
+
+    def get_timeout(self, timeout: float) -> float:
+        """Socket timeout of a request, bounded by the time left. Raises SlowTransferException past the deadline"""
+        if self.deadline is None:
+            return timeout
+        time_left = self.deadline - monotonic()
+        if time_left <= 0:
+            raise SlowTransferException("The deadline of the download is exceeded")
+        return min(timeout, time_left)
+
+    @contextmanager
+    def watch(self, response):
+        """Budget of the transfer of the response, whose reads are given to the watchdog of the limits.
+        The errors of the read of a response aborted by the watchdog are raised as a SlowTransferException"""
+        transfer = TransferBudget(self.limits, self.deadline)
+        self.limits._watch(transfer, response)
+        try:
+            yield transfer
+        except Exception as e:
+            if transfer.aborted is not None and not isinstance(e, SlowTransferException):
+                raise SlowTransferException(transfer.aborted) from e
+            raise
+        finally:
+            self.limits._unwatch(transfer)
+        if transfer.aborted is not None:
+            raise SlowTransferException(transfer.aborted)
+
+    def get_overrun(self) -> Optional[str]:
+        """Why the watched transfer is out of budget, None if it is not. The bytes of the chunk being received
+        are not counted yet, the bandwidth is only below the minimum when a whole chunk would not make up for it"""
+        now = monotonic()
+        if self.deadline is not None and now > self.deadline:
+            return f"The deadline of the download is exceeded after {self.received} bytes"
+        elapsed = now - self.start
+        if self.limits.min_bandwidth and elapsed > self.limits.grace_period \
+                and (self.received + CHUNK_SIZE) / elapsed < self.limits.min_bandwidth:
+            return f"Bandwidth of {self.received / elapsed:.0f} B/s below {self.limits.min_bandwidth} B/s"
+        return None
+
+    def check(self, size: int, start: float) -> None:
+        """Raises SlowTransferException when the deadline is exceeded, the transfer has been aborted by the
+        watchdog or the bandwidth of a transfer started at start (monotonic time) which has received size bytes
+        is below the minimum"""
+        self.received = size
+        if self.aborted is not None:
+            raise SlowTransferException(self.aborted)
+        now = monotonic()
+        if self.deadline is not None and now > self.deadline:
+            raise SlowTransferException(f"The deadline of the download is exceeded after {size} bytes")
+        elapsed = now - start
+        if self.limits.min_bandwidth and elapsed > self.limits.grace_period \
+                and size / elapsed < self.limits.min_bandwidth:
+            raise SlowTransferException(f"Bandwidth of {size / elapsed:.0f} B/s below {self.limits.min_bandwidth} B/s")
+
+
+def peek(chunks: Iterable[bytes], size: int) -> Tuple[bytes, Iterator[bytes]]:
+    """Read the first size bytes of the chunks. Returns them and an iterator over all the chunks"""
+    chunks = iter(chunks)
+    head = []
+    head_size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        head_size += len(chunk)
+        if head_size >= size:
+            break
+    return b"".join(head)[:size], chain(head, chunks)
+
+
+def write_pdf_stream(chunks: Iterable[bytes], filepath: str, max_size: int = MAX_PDF_SIZE,
+                     content_length=None, cancel: Event = None, budget: TransferBudget = None) -> int:
+    """Write the chunks of a PDF to filepath. Raises NotAPdfException if they do not start with %PDF-,
+    FileTooLargeException if they exceed max_size bytes, DownloadCancelledException once cancel is set and
+    SlowTransferException when the budget is exceeded, nothing being left on disk. Returns the size of the file"""
+    start = monotonic()
+    if content_length is not None and int(content_length) > max_size:
+        raise FileTooLargeException(f"Content-Length {content_length} exceeds {max_size} bytes")
+    head, chunks = peek(chunks, len(PDF_MAGIC))
+    if head != PDF_MAGIC:
+        raise NotAPdfException(f"Not a PDF, first bytes = {head}")
+    size = 0
+    partial_filepath = filepath + ".part"
+    try:
+        with open(partial_filepath, "wb") as f_out:
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    raise DownloadCancelledException(f"The download of {filepath} has been cancelled")
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLargeException(f"The file exceeds {max_size} bytes")
+                if budget is not None:
+                    budget.check(size, start)
+                f_out.write(chunk)
+        if budget is not None:
+            # The read of an aborted response may end early without an error
+            budget.check(size, start)
+        os.replace(partial_filepath, filepath)
+    except BaseException:
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        raise
+    return size
+
+
+def read_stream(chunks: Iterable[bytes], max_size: int = MAX_HTML_SIZE) -> bytes:
+    """Read at most max_size bytes of the chunks"""
+    content = bytearray()
+    for chunk in chunks:
+        content += chunk
+        if len(content) >= max_size:
+            break
+    return bytes(content[:max_size])
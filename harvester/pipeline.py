@@ -0,0 +1,198 @@
+"""Streaming harvest of the publications, the alternative to the batches of processBatch ("pipeline": true).
+
+producer -> download workers -> record worker -> upload workers, the stages being connected by bounded queues so
+that a slow download only holds its own worker and the number of publications in flight is capped by the size of
+the queues:
+- the producer hands the publications out to a HostScheduler, round-robin across the hosts, the publications
+  downloaded through a publisher API going to the scheduler of their own lane when there is one,
+- the download workers put a download rate limited by its host back in the scheduler for the Retry-After delay of
+  the host, as well as a download through a publisher API until the slot reserved in the rate limiter of its
+  client, a slot being only reserved when it is at most the requests of the API workers ahead. With a
+  ConcurrencyController, they only start the downloads it lets run,
+- the record worker validates the downloads and records them in LMDB, in a single thread as each LMDB write
+  transaction has to be performed in the thread that created it,
+- the upload workers compress and upload the recorded publications.
+"""
+from collections import defaultdict
+from contextlib import nullcontext
+from queue import Queue
+from threading import Thread
+from time import monotonic
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from application.server.main.logger import get_logger
+from config.logger_config import LOGGER_LEVEL
+from harvester.concurrency_controller import ConcurrencyController
+from harvester.download_publication_utils import RATE_LIMITED_DOWNLOAD, SUCCESS_DOWNLOAD, TRANSIENT_FAILURE
+from harvester.host_scheduler import HostScheduler, get_host
+
+logger = get_logger(__name__, level=LOGGER_LEVEL)
+
+# Number of times a download rate limited by its host is put back in the scheduler
+MAX_RATE_LIMITED_RETRIES = 3
+
+
+class DownloadPipeline:
+    def __init__(self, download: Callable, record: Callable, upload: Callable, get_api_client: Callable,
+                 download_scheduler: HostScheduler, download_workers: int, upload_workers: int, queue_size: int,
+                 concurrency_controller: ConcurrencyController = None, api_scheduler: HostScheduler = None,
+                 api_workers: int = 0):
+        """download(urls, filename, local_entry) -> result, local_entry
+        record(result, local_entry) -> True when the publication has to be uploaded
+        upload(local_entry)
+        get_api_client(urls) -> client of the publisher API downloading the publication, None for the others
+        With api_scheduler, the publications downloaded through a publisher API have their own api_workers
+        download workers"""
+        self._download = download
+        self._record = record
+        self._upload = upload
+        self._get_api_client = get_api_client
+        self._download_scheduler = download_scheduler
+        self._download_workers = download_workers
+        self._upload_workers = upload_workers
+        self._concurrency_controller = concurrency_controller
+        self._api_scheduler = api_scheduler
+        self._api_workers = api_workers
+        self._record_queue = Queue(maxsize=queue_size)
+        self._upload_queue = Queue(maxsize=queue_size)
+        self._rate_limited_retries = defaultdict(int)
+        self._api_slots = {}  # slot of the request to the publisher API reserved for a publication
+        # The slots are only reserved for the next requests of the workers downloading through the publisher APIs
+        self._slot_workers = api_workers if api_scheduler is not None else download_workers
+
+    def run(self, work: Iterable) -> None:
+        """work is an iterable of [urls, entry, filename], the method returning once every publication has been
+        downloaded, recorded and uploaded"""
+        download_threads, record_thread, upload_threads = self._start()
+        try:
+            self._produce(work)
+        finally:
+            self._stop(download_threads, record_thread, upload_threads)
+
+    def _start(self) -> Tuple[List[Thread], Thread, List[Thread]]:
+        download_threads = [Thread(target=self._download_worker,
+                                   args=(self._download_scheduler, self._concurrency_controller))
+                            for _ in range(self._download_workers)]
+        if self._api_scheduler is not None:
+            download_threads += [Thread(target=self._download_worker, args=(self._api_scheduler, None))
+                                 for _ in range(self._api_workers)]
+        record_thread = Thread(target=self._record_worker)
+        upload_threads = [Thread(target=self._upload_worker) for _ in range(self._upload_workers)]
+        for thread in download_threads + [record_thread] + upload_threads:
+            thread.start()
+        return download_threads, record_thread, upload_threads
+
+    def _stop(self, download_threads: List[Thread], record_thread: Thread, upload_threads: List[Thread]) -> None:
+        # Each stage is stopped once the previous one is done
+        self._download_scheduler.close()
+        if self._api_scheduler is not None:
+            self._api_scheduler.close()
+        for thread in download_threads:
+            thread.join()
+        self._record_queue.put(None)
+        record_thread.join()
+        for _ in upload_threads:
+            self._upload_queue.put(None)
+        for thread in upload_threads:
+            thread.join()
+
+    def _produce(self, work: Iterable) -> None:
+        for item in work:
+            if self._api_scheduler is not None and self._get_api_client(item[0]) is not None:
+                self._api_scheduler.put(item, get_host(item[0]))
+            else:
+                self._download_scheduler.put(item, get_host(item[0]))
+
+    def _download_worker(self, scheduler: HostScheduler,
+                         concurrency_controller: Optional[ConcurrencyController]) -> None:
+        while True:
+            if concurrency_controller is not None:
+                concurrency_controller.acquire()
+            scheduled = scheduler.get()
+            if scheduled is None:
+                if concurrency_controller is not None:
+                    concurrency_controller.release()
+                break
+            host, item = scheduled
+            if self._defer_until_api_slot(scheduler, host, item):
+                scheduler.done(host)
+                if concurrency_controller is not None:
+                    concurrency_controller.release()
+                continue
+            start = monotonic()
+            result, local_entry = self._download_item(scheduler, host, item)
+            scheduler.done(host)
+            if concurrency_controller is not None:
+                concurrency_controller.release(
+                    monotonic() - start, success=result == SUCCESS_DOWNLOAD,
+                    error=result == RATE_LIMITED_DOWNLOAD or local_entry.get("failure") == TRANSIENT_FAILURE)
+
+    def _defer_until_api_slot(self, scheduler: HostScheduler, host: str, item: list) -> bool:
+        """Reserve the slot of the request to the publisher API of the publication. Returns True when the publication
+        has been put back in the scheduler to wait for its slot instead of holding the worker, without a token
+        when the next slot is beyond the horizon"""
+        urls, local_entry, _ = item
+        api_client = self._get_api_client(urls)
+        if api_client is None or local_entry["id"] in self._api_slots:
+            return False
+        horizon = self._slot_workers / api_client.rate_limiter.rate
+        slot = api_client.rate_limiter.try_reserve(horizon)
+        if slot is not None:
+            self._api_slots[local_entry["id"]] = slot
+            if slot <= monotonic():
+                return False
+        scheduler.put_later(item, host, slot - monotonic() if slot is not None else horizon)
+        return True
+
+    def _download_item(self, scheduler: HostScheduler, host: str, item: list) -> Tuple[Optional[str], dict]:
+        """Download the publication through the slot reserved for it, if any, and hand it to the record worker
+        unless it is put back in the scheduler"""
+        urls, local_entry, filename = item
+        api_client = self._get_api_client(urls)
+        slot = self._api_slots.pop(local_entry["id"], None)
+        result = None
+        try:
+            with api_client.rate_limiter.reserved(slot) if api_client is not None else nullcontext():
+                result, local_entry = self._download(urls, filename, local_entry)
+            if result == RATE_LIMITED_DOWNLOAD and self._put_back_rate_limited(scheduler, host, item, local_entry):
+                return result, local_entry
+            if result == SUCCESS_DOWNLOAD:
+                scheduler.success(host)
+            self._record_queue.put((result, local_entry))
+        except Exception:
+            logger.exception(f'The download of the publication with doi = {local_entry["doi"]} failed')
+        return result, local_entry
+
+    def _put_back_rate_limited(self, scheduler: HostScheduler, host: str, item: list, local_entry: dict) -> bool:
+        """Leave the host alone for its Retry-After delay and put the download back in the scheduler for this delay,
+        up to MAX_RATE_LIMITED_RETRIES times. Returns True when the download has been put back"""
+        rate_limit = local_entry.pop("rate_limit")
+        scheduler.pushback(rate_limit["host"], rate_limit["retry_after"])
+        if self._rate_limited_retries[local_entry["id"]] >= MAX_RATE_LIMITED_RETRIES:
+            return False
+        # Put back before done so that the scheduler is not seen empty in the meantime
+        self._rate_limited_retries[local_entry["id"]] += 1
+        scheduler.put_later((item[0], local_entry, item[2]), host, rate_limit["retry_after"])
+        return True
+
+    def _record_worker(self) -> None:
+        while True:
+            item = self._record_queue.get()
+            if item is None:
+                break
+            result, local_entry = item
+            try:
+                if self._record(result, local_entry):
+                    self._upload_queue.put(local_entry)
+            except Exception:
+                logger.exception(f'The record of the publication with doi = {local_entry["doi"]} failed')
+
+    def _upload_worker(self) -> None:
+        while True:
+            local_entry = self._upload_queue.get()
+            if local_entry is None:
+                break
+            try:
+                self._upload(local_entry)
+            except Exception:
+                logger.exception(f'The upload of the publication with doi = {local_entry["doi"]} failed')
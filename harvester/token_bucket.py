@@ -0,0 +1,182 @@
+"""Thread-safe token bucket rate limiter of the publisher API clients.
+
+The bucket holds up to capacity tokens and is refilled with rate tokens per second, a request taking a token.
+The requests are handed out time slots ahead (lookahead scheduling): reserve never blocks, it takes the token
+right away, the bucket going into debt when it is empty, and returns the time at which the request may be sent.
+The following callers are given the following slots, so the rate holds whatever the number of threads. The wait
+can then happen outside of the download workers: the download pipeline puts a publication back in its scheduler
+until its slot, the request of the publication using the slot reserved for it (see reserved). The pipeline only
+looks a few slots ahead (see try_reserve) so that the bucket is not committed for hours by a large batch.
+
+Each rq job unpickles its own API clients, so a TokenBucket only holds the rate of a job. A RedisTokenBucket
+holds the rate of the publisher across all the jobs of all the workers: its state is kept in Redis and updated
+by a Lua script with the clock of the Redis server, the slot being returned as a delay. Its debt is bounded
+(max_debt seconds of requests) since the slots of a job which crashes are lost for the whole fleet, and it fails
+closed: no slot is handed out while Redis cannot be reached, as the other jobs may still count on it. Its reserve
+waits for a slot at most max_wait seconds then raises a RateLimiterUnavailableException, a FailedRequest: the
+publication is then downloaded without the API instead of holding its thread while Redis is down.
+"""
+import math
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic, sleep
+from typing import Optional
+
+import redis
+from redis.exceptions import RedisError
+
+from application.server.main.logger import get_logger
+from config.logger_config import LOGGER_LEVEL
+from harvester.exception import RateLimiterUnavailableException
+
+logger = get_logger(__name__, level=LOGGER_LEVEL)
+
+THROTTLE_KEY_PREFIX = "throttle"
+DEFAULT_MAX_DEBT = 60  # seconds of requests reserved ahead in Redis
+DEFAULT_MAX_WAIT = 60  # seconds waited for a slot in Redis
+# KEYS[1]: bucket, ARGV: rate, capacity, horizon. Returns the delay of the slot in seconds, as a string to keep the
+# decimals, or -1 when the slot is more than horizon seconds ahead, no token being taken.
+# The TIME call requires the effects replication of the scripts, the default since Redis 5
+RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local horizon = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last_refill')
+local tokens = tonumber(bucket[1]) or capacity
+local last_refill = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - last_refill, 0) * rate) - 1
+if tokens < 0 and -tokens / rate > horizon then
+    return '-1'
+end
+redis.call('HMSET', KEYS[1], 'tokens', string.format('%.17g', tokens), 'last_refill', string.format('%.6f', now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+if tokens >= 0 then
+    return '0'
+end
+return string.format('%.17g', -tokens / rate)
+"""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int = 1):
+        """rate in tokens per second"""
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = Lock()
+        self._tokens = float(capacity)
+        self._last_refill = monotonic()
+        self._prepaid = []
+
+    @staticmethod
+    def from_throttle_parameters(throttle_parameters: dict, name: str) -> "TokenBucket":
+        """max_num_requests per window_size seconds, the requests of a window being allowed in a burst.
+        The bucket of the API is shared through Redis when throttle_parameters has a redis_url"""
+        max_num_requests = throttle_parameters["max_num_requests"]
+        rate = max_num_requests / throttle_parameters["window_size"]
+        if throttle_parameters.get("redis_url"):
+            return RedisTokenBucket(throttle_parameters["redis_url"], f"{THROTTLE_KEY_PREFIX}:{name}", rate,
+                                    max_num_requests, throttle_parameters.get("max_debt", DEFAULT_MAX_DEBT),
+                                    throttle_parameters.get("max_wait", DEFAULT_MAX_WAIT))
+        return TokenBucket(rate, max_num_requests)
+
+    def reserve(self) -> float:
+        """Take a token and return the monotonic time of the slot of the request"""
+        return self.try_reserve(math.inf)
+
+    def try_reserve(self, horizon: float) -> Optional[float]:
+        """Take a token when the slot of the request is at most horizon seconds ahead and return the monotonic
+        time of the slot. Returns None when it is further ahead, no token being taken"""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens < 1 and (1 - self._tokens) / self.rate > horizon:
+                return None
+            self._tokens -= 1
+            return now if self._tokens >= 0 else now - self._tokens / self.rate
+
+    def acquire(self) -> None:
+        """Wait for the slot of the request, a slot reserved beforehand being used first"""
+        with self._lock:
+            slot = self._prepaid.pop(0) if self._prepaid else None
+        if slot is None:
+            slot = self.reserve()
+        delay = slot - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    @contextmanager
+    def reserved(self, slot: float):
+        """The request made within the context uses the slot, whatever its thread (hedged downloads run in their
+        own threads). The token of a slot left unused is lost"""
+        with self._lock:
+            self._prepaid.append(slot)
+        try:
+            yield
+        finally:
+            with self._lock:
+                if slot in self._prepaid:
+                    self._prepaid.remove(slot)
+
+    def __getstate__(self):
+        """The API clients are pickled in the arguments of the rq jobs"""
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_prepaid"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+        # monotonic times are not comparable across processes: the debt is settled
+        self._tokens = max(self._tokens, 0.0)
+        self._last_refill = monotonic()
+
+
+class RedisTokenBucket(TokenBucket):
+    def __init__(self, redis_url: str, key: str, rate: float, capacity: int = 1, max_debt: float = DEFAULT_MAX_DEBT,
+                 max_wait: float = DEFAULT_MAX_WAIT):
+        """No slot is reserved more than max_debt seconds ahead, reserve giving up after max_wait seconds"""
+        super().__init__(rate, capacity)
+        self.redis_url = redis_url
+        self.key = key
+        self.max_debt = max_debt
+        self.max_wait = max_wait
+        self._script = None
+
+    def _get_script(self):
+        with self._lock:
+            if self._script is None:
+                self._script = redis.from_url(self.redis_url).register_script(RESERVE_SCRIPT)
+            return self._script
+
+    def reserve(self) -> float:
+        """Blocks while the debt of the bucket is max_debt seconds or Redis cannot be reached, up to max_wait seconds.
+        Raises a RateLimiterUnavailableException when no slot has been reserved within max_wait seconds"""
+        deadline = monotonic() + self.max_wait
+        while True:
+            slot = self.try_reserve(self.max_debt)
+            if slot is not None:
+                return slot
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise RateLimiterUnavailableException(
+                    f"No slot of the rate limiter {self.key} could be reserved within {self.max_wait}s")
+            sleep(min(1 / self.rate, remaining))
+
+    def try_reserve(self, horizon: float) -> Optional[float]:
+        """The horizon is bounded by max_debt. Returns None while Redis cannot be reached"""
+        try:
+            delay = float(self._get_script()(keys=[self.key],
+                                             args=[self.rate, self.capacity, min(horizon, self.max_debt)]))
+        except RedisError:
+            logger.warning(f"The rate limiter {self.key} cannot reach Redis, no slot is reserved", exc_info=True)
+            return None
+        return monotonic() + delay if delay >= 0 else None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_script"] = None
+        return state
@@ -1,6 +1,6 @@
 import pickle
 from datetime import datetime
-from typing import List, Tuple
+from typing import List, Set, Tuple
 
 import lmdb
 from application.server.main.logger import get_logger
@@ -29,6 +29,11 @@ class DBHandler:
         result = self.engine.execute(f'SELECT * FROM {self.table_name}')
         return [ProcessedEntry(*entry) for entry in result.fetchall()]
 
+    def fetch_all_dois(self) -> Set[str]:
+        """Return the set of the dois of the table, without loading the other columns"""
+        result = self.engine.execute(f'SELECT doi FROM {self.table_name}')
+        return {entry[0] for entry in result}
+
     def count(self):
         """Return the number of rows in the table"""
         # (X,) rows
@@ -1,5 +1,5 @@
 import shutil
-from typing import List
+from typing import List, Optional
 
 from swiftclient.service import SwiftError, SwiftService, SwiftUploadObject
 
@@ -21,6 +21,7 @@ class Swift(object):
         options = self._init_swift_options()
 
         options['object_uu_threads'] = 20
+        options['object_dd_threads'] = 20
         self.swift = SwiftService(options=options)
         container_names = []
         try:
@@ -57,15 +58,16 @@ class Swift(object):
                 options[key] = self.config["swift"][key]
         return options
 
-    def upload_files_to_swift(self, container, file_path_dest_path_tuples: List):
+    def upload_files_to_swift(self, container, file_path_dest_path_tuples: List, options=None):
         """
         Bulk upload of a list of files to current SWIFT object storage container
+        options are SwiftService upload options (e.g. segment_size for objects bigger than 5GB)
         """
         # Slightly modified to be able to upload to more than one dest_path
         objs = [SwiftUploadObject(file_path, object_name=str(dest_path)) for file_path, dest_path in
                 file_path_dest_path_tuples if isinstance(dest_path, OvhPath)]
         try:
-            for result in self.swift.upload(container, objs):
+            for result in self.swift.upload(container, objs, options=options):
                 if not result['success']:
                     error = result['error']
                     if result['action'] == "upload_object":
@@ -98,6 +100,50 @@ class Swift(object):
         except SwiftError:
             logger.exception("error downloading file from SWIFT container")
 
+    def download_objects(self, container, objects: List[str], out_directory) -> List[str]:
+        """
+        Multi-threaded download of objects in a single call, each object being written to out_directory/object name.
+        Returns the local paths of the downloaded objects.
+        """
+        local_paths = []
+        try:
+            for down_res in self.swift.download(container=container, objects=objects,
+                                                options={"out_directory": out_directory}):
+                if down_res['success']:
+                    local_paths.append(down_res['path'])
+                else:
+                    logger.error("'%s' download failed" % down_res['object'])
+        except SwiftError:
+            logger.exception("error downloading files from SWIFT container")
+        return local_paths
+
+    def download_object_range(self, container, object_name, dest_path, first_byte, last_byte):
+        """
+        Download the bytes [first_byte, last_byte] of an object to dest_path using an HTTP Range request.
+        """
+        options = {"out_file": dest_path, "header": [f"Range: bytes={first_byte}-{last_byte}"]}
+        try:
+            for down_res in self.swift.download(container=container, objects=[object_name], options=options):
+                if not down_res['success']:
+                    logger.error("'%s' range download failed" % down_res['object'])
+        except SwiftError:
+            logger.exception("error downloading object range from SWIFT container")
+
+    def get_object_stat(self, container, object_name) -> Optional[dict]:
+        """
+        Return the etag and the size of an object, None if it cannot be read.
+        """
+        try:
+            for stat_res in self.swift.stat(container=container, objects=[object_name]):
+                if stat_res['success']:
+                    headers = stat_res['headers']
+                    return {"etag": headers.get('etag', '').strip('"'),
+                            "size": int(headers.get('content-length', 0))}
+                logger.error("'%s' stat failed" % stat_res['object'])
+        except SwiftError:
+            logger.exception("error reading object stat from SWIFT container")
+        return None
+
     def get_swift_list(self, container, dir_name=None):
         """
         Return all contents of a given dir in SWIFT object storage.
@@ -1,7 +1,14 @@
 import os
 
+from application.server.main.logger import get_logger
+from config.harvest_strategy_config import harvest_eligibility_vectorized
 from config.harvester_config import config_harvester
+from config.logger_config import LOGGER_LEVEL
 from infrastructure.storage.swift import Swift
+from utils.columnar_cache import get_columnar_cache_name, is_columnar_cache_available
+from utils.seekable_gzip import get_index_name, get_partial_index, is_index_of, load_index
+
+logger = get_logger(__name__, level=LOGGER_LEVEL)
 
 
 def load_metadata(metadata_container, metadata_file, destination_dir, subfolder_name=''):
@@ -25,3 +32,64 @@ def load_metadata(metadata_container, metadata_file, destination_dir, subfolder_
     if not os.path.exists(local_file_destination):
         swift_handler.download_files(metadata_container, metadata_file, destination_dir_structure)
     return local_file_destination
+
+
+def load_metadata_index(metadata_container, metadata_file, destination_dir):
+    """
+    Download the index of the seekable version of the metadata file if the metadata file has been indexed.
+    Returns the index or None, as well when the index has been built from another version of the metadata file
+    """
+    index_file = get_index_name(metadata_file)
+    local_index_destination = os.path.normpath(os.path.join(f'{destination_dir}', f'{index_file}'))
+    swift_handler = Swift(config_harvester)
+    source = swift_handler.get_object_stat(metadata_container, metadata_file)
+    if os.path.exists(local_index_destination) and not is_index_of(load_index(local_index_destination), source):
+        # Local copy of the index of a previous version of the metadata file
+        os.remove(local_index_destination)
+    if not os.path.exists(local_index_destination):
+        if index_file not in swift_handler.get_swift_list(metadata_container, dir_name=index_file):
+            return None
+    index = load_index(load_metadata(metadata_container, index_file, destination_dir))
+    if not is_index_of(index, source):
+        logger.warning(f'{index_file} has not been built from the current {metadata_file}, it is not used')
+        return None
+    return index
+
+
+def load_metadata_columnar_cache(metadata_container, metadata_file, destination_dir):
+    """
+    Download the columnar cache of the metadata file if it has been built, pyarrow is installed and the eligibility
+    conditions have a vectorized version (see harvest_eligibility_vectorized).
+    Returns the path of the cache once downloaded or None
+    """
+    if not is_columnar_cache_available() or not harvest_eligibility_vectorized:
+        return None
+    columnar_cache = get_columnar_cache_name(metadata_file)
+    local_cache_destination = os.path.normpath(os.path.join(f'{destination_dir}', f'{columnar_cache}'))
+    if not os.path.exists(local_cache_destination):
+        swift_handler = Swift(config_harvester)
+        if columnar_cache not in swift_handler.get_swift_list(metadata_container, dir_name=columnar_cache):
+            return None
+    return load_metadata(metadata_container, columnar_cache, destination_dir)
+
+
+def load_metadata_range(metadata_container, metadata_file, destination_dir, index, start, stop):
+    """
+    Download only the part of a seekable metadata file covering the lines [start, stop[ using an HTTP Range request.
+    Returns the path of the part once downloaded and its index
+    """
+    partial_index = get_partial_index(index, start, stop)
+    first_byte, last_byte = partial_index['byte_range']
+    # The etag of the dump tells apart the same range of the seekable files of two versions of the dump
+    etag = (index.get('source') or {}).get('etag', '')
+    local_file_destination = os.path.normpath(
+        os.path.join(f'{destination_dir}', f'{etag}_{first_byte}-{last_byte}_{os.path.basename(metadata_file)}'))
+
+    if not os.path.isdir(destination_dir):
+        os.makedirs(destination_dir)
+
+    if not os.path.exists(local_file_destination):
+        swift_handler = Swift(config_harvester)
+        swift_handler.download_object_range(metadata_container, metadata_file, local_file_destination,
+                                            first_byte, last_byte)
+    return local_file_destination, partial_index
@@ -14,7 +14,8 @@ def run_worker():
     redis_connection = redis.from_url(redis_url)
     with Connection(redis_connection):
         worker = Worker(app.config['QUEUES'])
-        worker.work()
+        # The scheduler enqueues the retry jobs when their delay is over
+        worker.work(with_scheduler=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,9 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# The lmdb and the publications of the tested harvesters are kept out of the data directory of the project
+if "DATA_PATH" not in os.environ:
+    os.environ["DATA_PATH"] = tempfile.mkdtemp(prefix="harvester_data_")
+    atexit.register(shutil.rmtree, os.environ["DATA_PATH"], ignore_errors=True)
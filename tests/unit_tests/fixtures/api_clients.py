@@ -1,5 +1,9 @@
+from harvester.token_bucket import TokenBucket
+
+
 class WileyClientMock:
     name = "wiley"
+    rate_limiter = TokenBucket(rate=100)
 
     def download_publication(self, doi: str, filepath: str) -> (str, str):
         return "fail", "wiley"
@@ -7,6 +11,7 @@ class WileyClientMock:
 
 class ElsevierClientMock:
     name = "elsevier"
+    rate_limiter = TokenBucket(rate=100)
 
     def download_publication(self, doi: str, filepath: str) -> (str, str):
         return "fail", "elsevier"
@@ -10,6 +10,20 @@ FIXTURES_PATH = os.path.dirname(__file__)
 
 source_metadata_file = os.path.join(FIXTURES_PATH, 'bso-publications-10.jsonl.gz')
 filtered_metadata_filename = os.path.join(FIXTURES_PATH, 'filtered_' + os.path.basename(source_metadata_file))
+partitioned_metadata_filename = os.path.join(FIXTURES_PATH, 'partitioned_' + os.path.basename(source_metadata_file))
+seekable_metadata_file = os.path.join(FIXTURES_PATH, 'seekable_' + os.path.basename(source_metadata_file))
+index_file = seekable_metadata_file + '.index.json'
+split_metadata_file = os.path.join(FIXTURES_PATH, 'split_' + os.path.basename(source_metadata_file))
+split_columnar_cache = split_metadata_file + '.columns.parquet'
+split_partition_files = [os.path.join(FIXTURES_PATH, 'split', f'partition_{i}.work_items.jsonl.gz') for i in range(3)]
+# 12 publications: every third one is not french and the last ones have no doi
+split_entries = [
+    {
+        "doi": f"doi_{i}" if i < 10 else None,
+        "bso_country_corrected": ["fr"] if i % 3 else ["us"],
+        "oa_details": {"2022Q3": {"is_oa": True, "oa_locations": [{"url_for_pdf": f"https://fake.org/{i}.pdf"}]}},
+    } for i in range(12)
+]
 doi_list = ["10.1158/1538-7445.sabcs21-p1-17-07"]
 expected_doi_filtered_content = [
     '{"affiliations": [{"detected_countries": ["fr"]}, {"detected_countries": ["fr"]}, {"detected_countries": ["fr"]}], "all_ids": ["doi10.1158/1538-7445.sabcs21-p1-17-07"], "bso_classification": "Medical research", "bso_country": ["fr"], "datasource": "crossref_fr", "detected_countries": ["fr"], "doi": "10.1158/1538-7445.sabcs21-p1-17-07", "external_ids": [{"crossref": "10.1158/1538-7445.sabcs21-p1-17-07"}], "genre": "journal-article", "genre_raw": "journal-article", "id": "doi10.1158/1538-7445.sabcs21-p1-17-07", "id_type": "doi", "is_paratext": false, "journal_issn_l": "0008-5472", "journal_issns": "0008-5472,1538-7445", "journal_name": "Cancer Research", "natural_id": null, "published_date": "2022-02-15T00:00:00", "publisher": "American Association for Cancer Research (AACR)", "publisher_dissemination": "American Association for Cancer Research", "publisher_group": "American Association for Cancer Research", "publisher_normalized": "American Association for Cancer Research", "sources": ["json"], "title": "Abstract P1-17-07: Consequences of stopping a 4/6 cyclin D-dependent kinase Inhibitor in metastatic breast cancer patients with clinical benefit on endocrine treatment, in the context of the COVID-19 outbreak", "url": "http://doi.org/10.1158/1538-7445.sabcs21-p1-17-07", "year": 2022, "has_apc": false, "lang": "en", "publisher_in_bealls_list": false, "journal_or_publisher_in_bealls_list": false, "observation_dates": ["2022Q3"], "oa_details": {"2022Q3": {"snapshot_date": "20220823", "observation_date": "2022Q3", "is_oa": false, "journal_is_in_doaj": false, "journal_is_oa": false, "oa_host_type": ["closed"], "oa_colors": ["closed"], "oa_colors_with_priority_to_publisher": ["closed"]}}, "amount_apc_doaj": null, "amount_apc_doaj_EUR": null, "amount_apc_EUR": null, "has_coi": null, "has_grant": null, "pmid": null, "publication_year": null, "french_affiliations_types": ["hospital"], "author_useful_rank_fr": false, "author_useful_rank_countries": []}'
@@ -0,0 +1,89 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from harvester.arxiv_fetcher import ARXIV_CONTAINER, ArxivFetcher, get_prefetched_path, take_prefetched
+
+TESTED_MODULE = 'harvester.arxiv_fetcher'
+PDF_CONTENT = b'%PDF-1.4 fake pdf'
+OBJECT_NAMES = ["arxiv/1501/1501.00001/1501.00001.pdf.gz", "arxiv/1501/1501.00002/1501.00002.pdf.gz"]
+
+
+class ArxivFetcherTest(TestCase):
+    def setUp(self):
+        self.prefetch_dir = tempfile.mkdtemp()
+        self.prefetch_dir_patcher = patch(f"{TESTED_MODULE}.ARXIV_PREFETCH_DIR", self.prefetch_dir)
+        self.prefetch_dir_patcher.start()
+        self.swift_handler = MagicMock()
+        self.swift_handler.download_objects.side_effect = self.download_objects
+        self.arxiv_fetcher = ArxivFetcher(self.swift_handler, workers=2)
+
+    def tearDown(self):
+        self.prefetch_dir_patcher.stop()
+        shutil.rmtree(self.prefetch_dir)
+
+    @staticmethod
+    def download_objects(container, object_names, out_directory):
+        local_paths = []
+        for object_name in object_names:
+            local_path = os.path.join(out_directory, object_name)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with gzip.open(local_path, "wb") as f:
+                f.write(PDF_CONTENT)
+            local_paths.append(local_path)
+        return local_paths
+
+    def test_the_objects_of_a_batch_are_downloaded_in_a_single_call(self):
+        # When
+        prefetched = self.arxiv_fetcher.prefetch(OBJECT_NAMES + OBJECT_NAMES[:1])
+        # Then
+        self.assertEqual(prefetched, 2)
+        self.swift_handler.download_objects.assert_called_once_with(ARXIV_CONTAINER, OBJECT_NAMES, self.prefetch_dir)
+        for object_name in OBJECT_NAMES:
+            with open(get_prefetched_path(object_name), "rb") as f:
+                self.assertEqual(f.read(), PDF_CONTENT)
+            self.assertFalse(os.path.exists(os.path.join(self.prefetch_dir, object_name)))
+
+    def test_the_prefetched_objects_are_not_downloaded_again(self):
+        # Given
+        self.arxiv_fetcher.prefetch(OBJECT_NAMES[:1])
+        # When
+        self.arxiv_fetcher.prefetch(OBJECT_NAMES)
+        # Then
+        self.assertEqual(self.swift_handler.download_objects.call_args.args[1], OBJECT_NAMES[1:])
+
+    def test_nothing_is_downloaded_without_arxiv_publications(self):
+        # When
+        prefetched = self.arxiv_fetcher.prefetch([])
+        # Then
+        self.assertEqual(prefetched, 0)
+        self.swift_handler.download_objects.assert_not_called()
+
+    def test_a_corrupted_object_is_skipped(self):
+        # Given
+        def download_objects(container, object_names, out_directory):
+            local_paths = self.download_objects(container, object_names, out_directory)
+            with open(local_paths[0], "wb") as f:
+                f.write(b"not gzipped")
+            return local_paths
+
+        self.swift_handler.download_objects.side_effect = download_objects
+        # When
+        prefetched = self.arxiv_fetcher.prefetch(OBJECT_NAMES)
+        # Then
+        self.assertEqual(prefetched, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.prefetch_dir, OBJECT_NAMES[0])))
+
+    def test_take_prefetched(self):
+        # Given
+        self.arxiv_fetcher.prefetch(OBJECT_NAMES[:1])
+        filepath = os.path.join(self.prefetch_dir, "publication.pdf")
+        # When
+        taken = [take_prefetched(object_name, filepath) for object_name in OBJECT_NAMES + OBJECT_NAMES[:1]]
+        # Then
+        self.assertEqual(taken, [True, False, False])
+        with open(filepath, "rb") as f:
+            self.assertEqual(f.read(), PDF_CONTENT)
@@ -0,0 +1,74 @@
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import lmdb
+
+from harvester.circuit_breaker import CircuitBreaker
+
+TESTED_MODULE = 'harvester.circuit_breaker'
+
+
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        self.lmdb_dir = tempfile.mkdtemp()
+        self.env = lmdb.open(self.lmdb_dir, map_size=10 * 1024 * 1024)
+        self.circuit_breaker = CircuitBreaker(self.env, failure_threshold=3, open_duration=100, failure_ttl=10)
+
+    def tearDown(self):
+        self.env.close()
+        shutil.rmtree(self.lmdb_dir)
+
+    @patch(f"{TESTED_MODULE}.time")
+    def test_the_circuit_opens_after_failure_threshold_failures(self, mock_time):
+        # Given
+        mock_time.return_value = 1000
+        # When
+        opened = [self.circuit_breaker.record_failure("dead.org") for _ in range(3)]
+        # Then
+        self.assertEqual(opened, [False, False, True])
+        self.assertTrue(self.circuit_breaker.is_open("dead.org"))
+        self.assertFalse(self.circuit_breaker.is_open("alive.org"))
+        mock_time.return_value = 1101
+        self.assertFalse(self.circuit_breaker.is_open("dead.org"))
+
+    @patch(f"{TESTED_MODULE}.time")
+    def test_the_failures_expire_after_failure_ttl(self, mock_time):
+        # When
+        for now in [1000, 1005, 1020]:
+            mock_time.return_value = now
+            self.circuit_breaker.record_failure("slow.org")
+        # Then
+        self.assertFalse(self.circuit_breaker.is_open("slow.org"))
+
+    @patch(f"{TESTED_MODULE}.time")
+    def test_a_failure_after_the_open_duration_opens_the_circuit_again(self, mock_time):
+        # Given
+        mock_time.return_value = 1000
+        for _ in range(3):
+            self.circuit_breaker.record_failure("dead.org")
+        mock_time.return_value = 1101
+        # When
+        opened = self.circuit_breaker.record_failure("dead.org")
+        # Then
+        self.assertTrue(opened)
+        self.assertTrue(self.circuit_breaker.is_open("dead.org"))
+
+    def test_a_success_closes_the_circuit(self):
+        # Given
+        for _ in range(3):
+            self.circuit_breaker.record_failure("dead.org")
+        # When
+        self.circuit_breaker.record_success("dead.org")
+        # Then
+        self.assertFalse(self.circuit_breaker.is_open("dead.org"))
+
+    def test_the_circuits_are_shared_through_lmdb(self):
+        # Given
+        for _ in range(3):
+            self.circuit_breaker.record_failure("dead.org")
+        # When
+        other_circuit_breaker = CircuitBreaker(self.env)
+        # Then
+        self.assertTrue(other_circuit_breaker.is_open("dead.org"))
@@ -0,0 +1,82 @@
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from harvester.concurrency_controller import ConcurrencyController
+
+TESTED_MODULE = 'harvester.concurrency_controller'
+
+
+@patch(f"{TESTED_MODULE}.monotonic")
+class ConcurrencyControllerTest(TestCase):
+    def run_window(self, controller, mock_monotonic, successes, errors=0, latency=1.0):
+        """Finish successes + errors downloads during an interval"""
+        for i in range(successes + errors):
+            controller.acquire()
+            controller.release(latency, success=i < successes, error=i >= successes)
+        mock_monotonic.return_value += controller.interval
+        controller.acquire()
+        controller.release()
+
+    def test_acquire_blocks_at_the_concurrency(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        controller = ConcurrencyController(min_concurrency=2, max_concurrency=8)
+        controller.acquire()
+        controller.acquire()
+        thread = Thread(target=controller.acquire)
+        # When
+        thread.start()
+        thread.join(timeout=0.1)
+        # Then
+        self.assertTrue(thread.is_alive())
+        controller.release()
+        thread.join(timeout=1)
+        self.assertFalse(thread.is_alive())
+
+    def test_the_concurrency_increases_while_the_throughput_does_not_drop(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        on_adjust = MagicMock()
+        controller = ConcurrencyController(min_concurrency=4, max_concurrency=6, on_adjust=on_adjust)
+        # When
+        self.run_window(controller, mock_monotonic, successes=10)
+        self.run_window(controller, mock_monotonic, successes=12)
+        # Then
+        self.assertEqual(controller.concurrency, 6)
+        self.assertEqual(on_adjust.call_count, 2)
+        concurrency, stats = on_adjust.call_args.args
+        self.assertEqual(concurrency, 6)
+        self.assertEqual(stats["throughput"], 1.2)
+
+    def test_the_concurrency_decreases_when_the_throughput_drops(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        controller = ConcurrencyController(min_concurrency=4, max_concurrency=64)
+        self.run_window(controller, mock_monotonic, successes=20)
+        self.run_window(controller, mock_monotonic, successes=20)
+        # When
+        self.run_window(controller, mock_monotonic, successes=10)
+        # Then
+        self.assertEqual(controller.concurrency, 6 - 2)
+
+    def test_the_concurrency_is_halved_on_errors(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        controller = ConcurrencyController(min_concurrency=1, max_concurrency=64)
+        controller.concurrency = 32
+        # When
+        self.run_window(controller, mock_monotonic, successes=5, errors=5)
+        # Then
+        self.assertEqual(controller.concurrency, 16)
+
+    def test_the_concurrency_is_halved_when_the_latency_rises(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        controller = ConcurrencyController(min_concurrency=1, max_concurrency=64)
+        controller.concurrency = 32
+        self.run_window(controller, mock_monotonic, successes=10, latency=1.0)
+        # When
+        self.run_window(controller, mock_monotonic, successes=10, latency=5.0)
+        # Then
+        self.assertEqual(controller.concurrency, 20)
@@ -233,3 +233,19 @@ class UpdateDatabase(TestCase):
         assert mock_swift_handler.get_swift_list.call_count == expected_nb_calls_get_swift_list
         assert mock_processed_entry.call_count == expected_nb_calls_processed_entry
         assert mock_write_entity_batch.call_count == expected_nb_calls_write_entity_batch
+
+
+class FetchAllDois(TestCase):
+
+    def test_fetch_all_dois_only_selects_the_doi_column_and_returns_a_set(self):
+        # Given
+        mock_engine: Engine = MagicMock()
+        mock_engine.execute.return_value = iter([('doi_1',), ('doi_2',), ('doi_1',)])
+        db_handler: DBHandler = DBHandler(mock_engine, 'false_table', MagicMock())
+
+        # When
+        dois = db_handler.fetch_all_dois()
+
+        # Then
+        mock_engine.execute.assert_called_once_with('SELECT doi FROM false_table')
+        assert dois == {'doi_1', 'doi_2'}
@@ -1,6 +1,12 @@
 import abc
 import os
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic, sleep
 from unittest import TestCase
 from unittest.mock import patch, MagicMock, Mock
 
@@ -9,8 +15,14 @@ import cloudscraper
 from config import WILEY
 from config.harvester_config import config_harvester
 from config.path_config import COMPRESSION_EXT, PUBLICATION_EXT
-from harvester.download_publication_utils import _process_request, _download_publication, url_to_path, publisher_api_download
-from harvester.exception import FailedRequest
+from harvester.download_publication_utils import _process_request, _download_publication, url_to_path, publisher_api_download, \
+    parse_retry_after, DEFAULT_RETRY_AFTER, MAX_RETRY_AFTER, RATE_LIMITED_DOWNLOAD, CIRCUIT_OPEN_DOWNLOAD, \
+    classify_failure, PERMANENT_FAILURE, TRANSIENT_FAILURE, arxiv_download, standard_download
+from harvester.exception import DownloadCancelledException, EmptyFileContentException, FailedRequest, \
+    HostUnavailableException, NotAPdfException, RateLimitedException, SlowTransferException, \
+    UnsuccessfulResponseException
+from harvester.host_scheduler import get_host
+from harvester.pdf_stream import TransferLimits
 from harvester.wiley_client import WileyClient
 from tests.unit_tests.fixtures.api_clients import wiley_client_mock, elsevier_client_mock
 from tests.unit_tests.fixtures.harvester import timeout_url, wiley_parsed_entry, arXiv_parsed_entry
@@ -43,7 +55,7 @@ class Download(TestCase):
         # Then
         mock_arxiv_download.assert_not_called()
         mock_publisher_api_download.assert_not_called()
-        mock_standard_download.assert_called_once_with(fake_url, fake_filename, fake_doi)
+        mock_standard_download.assert_called_once_with(fake_url, fake_filename, fake_doi, cancel=None, budget=None)
 
     @unittest.skip("No config on github")
     def test_wiley_download(self):
@@ -87,6 +99,19 @@ class Download(TestCase):
         self.assertEqual(post_07_arXiv_path, expected_post_07_arXiv_path)
         self.assertEqual(pre_07_arXiv_path, expected_pre_07_arXiv_path)
 
+    @patch(f'{TESTED_MODULE}.subprocess.check_call')
+    @patch(f'{TESTED_MODULE}.take_prefetched')
+    def test_arxiv_download_uses_the_prefetched_publication(self, mock_take_prefetched, mock_check_call):
+        # Given
+        mock_take_prefetched.return_value = True
+        # When
+        result, harvester_used = arxiv_download("http://arxiv.org/pdf/1501.00001", "publication.pdf", "fake/doi")
+        # Then
+        self.assertEqual((result, harvester_used), ("success", "arxiv"))
+        mock_take_prefetched.assert_called_once_with(
+            "arxiv/1501/1501.00001/1501.00001" + PUBLICATION_EXT + COMPRESSION_EXT, "publication.pdf")
+        mock_check_call.assert_not_called()
+
     @patch("os.path.getsize")
     @patch(f'{TESTED_MODULE}._process_request')
     @patch(f'{TESTED_MODULE}.arxiv_download')
@@ -103,7 +128,6 @@ class Download(TestCase):
         result, _ = _download_publication(urls, filename, local_entry, wiley_client_mock, elsevier_client_mock)
         # Then
         mock_process_request.assert_called()
-        os.remove(filename)
 
     @patch('os.path.getsize')
     @patch(f'{TESTED_MODULE}._process_request')
@@ -119,7 +143,6 @@ class Download(TestCase):
         result, _ = _download_publication(urls, filename, local_entry, wiley_client_mock, elsevier_client_mock)
         # Then
         mock_process_request.assert_called()
-        os.remove(filename)
 
     @unittest.skip("No config on github")
     def test_arXiv_download_a_gz_file_and_decompress_it(self):
@@ -145,27 +168,291 @@ class Download(TestCase):
         os.remove(filename)
 
 
+class RateLimit(TestCase):
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after(None), DEFAULT_RETRY_AFTER)
+        self.assertEqual(parse_retry_after("not a date"), DEFAULT_RETRY_AFTER)
+        self.assertEqual(parse_retry_after("100000"), MAX_RETRY_AFTER)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        in_a_minute = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(in_a_minute), 60, delta=2)
+
+    def test_process_request_429(self):
+        # Given
+        scraper = MagicMock()
+        scraper.get.return_value = MagicMock(status_code=429, headers={"Retry-After": "12"})
+        # When
+        with self.assertRaises(RateLimitedException) as context:
+            _process_request(scraper, "https://hal.science/hal-1/document", "fake_filename")
+        # Then
+        self.assertEqual(context.exception.host, "hal.science")
+        self.assertEqual(context.exception.retry_after, 12)
+
+    @patch(f"{TESTED_MODULE}.standard_download")
+    def test_download_publication_rate_limited(self, mock_standard_download):
+        # Given
+        mock_standard_download.side_effect = RateLimitedException("", "hal.science", 12)
+        # When
+        result, local_entry = _download_publication(["https://hal.science/hal-1/document"], "fake_filename",
+                                                    {"doi": "fake_doi"}, None, None)
+        # Then
+        self.assertEqual(result, RATE_LIMITED_DOWNLOAD)
+        self.assertEqual(local_entry["rate_limit"], {"host": "hal.science", "retry_after": 12})
+
+
+class HedgedDownload(TestCase):
+    def setUp(self):
+        self.filename = "hedged_download_test.pdf"
+        self.urls = ["https://slow.org/publication.pdf", "https://fast.org/publication.pdf"]
+
+    def tearDown(self):
+        for filename in [self.filename, self.filename + ".0", self.filename + ".1"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    @staticmethod
+    def fake_download(url, filename, doi, wiley_client, elsevier_client, cancel=None, budget=None):
+        if "slow" in url:
+            cancel.wait(5)
+            raise DownloadCancelledException(url)
+        with open(filename, "wb") as f_out:
+            f_out.write(b"%PDF-")
+        return "success", "standard"
+
+    @patch(f"{TESTED_MODULE}.standard_download")
+    def test_the_next_url_is_tried_when_the_standard_download_fails(self, mock_standard_download):
+        # Given
+        mock_standard_download.side_effect = [EmptyFileContentException(""), ("success", "standard")]
+        # When
+        result, local_entry = _download_publication(self.urls, self.filename, {"doi": "fake_doi"}, None, None)
+        # Then
+        self.assertEqual(result, "success")
+        self.assertEqual(local_entry["url_used"], self.urls[1])
+
+    @patch(f"{TESTED_MODULE}.ThreadPoolExecutor")
+    @patch(f"{TESTED_MODULE}._download_from_url")
+    def test_hedged_download_shuts_the_executor_down_as_python_3_8_does(self, mock_download_from_url,
+                                                                        mock_executor):
+        # Given
+        class Python38Executor(ThreadPoolExecutor):
+            def shutdown(self, wait=True):
+                super().shutdown(wait)
+
+        mock_download_from_url.side_effect = self.fake_download
+        mock_executor.side_effect = Python38Executor
+        # When
+        result, local_entry = _download_publication(self.urls, self.filename, {"doi": "fake_doi"}, None, None,
+                                                    hedging={"max_urls": 2, "delay": 0})
+        # Then
+        self.assertEqual(result, "success")
+        self.assertEqual(local_entry["url_used"], self.urls[1])
+
+    @patch(f"{TESTED_MODULE}._download_from_url")
+    def test_hedged_download_the_first_pdf_wins(self, mock_download_from_url):
+        # Given
+        mock_download_from_url.side_effect = self.fake_download
+        # When
+        result, local_entry = _download_publication(self.urls, self.filename, {"doi": "fake_doi"}, None, None,
+                                                    hedging={"max_urls": 2, "delay": 0})
+        # Then
+        self.assertEqual(result, "success")
+        self.assertEqual(local_entry["url_used"], self.urls[1])
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), b"%PDF-")
+        slow_cancel = mock_download_from_url.call_args_list[0].args[5]
+        self.assertTrue(slow_cancel.is_set())
+        self.assertFalse(os.path.exists(self.filename + ".1"))
+
+    @patch(f"{TESTED_MODULE}._download_from_url")
+    def test_hedged_download_the_next_url_is_not_started_before_the_delay(self, mock_download_from_url):
+        # Given
+        mock_download_from_url.side_effect = self.fake_download
+        urls = list(reversed(self.urls))
+        # When
+        result, local_entry = _download_publication(urls, self.filename, {"doi": "fake_doi"}, None, None,
+                                                    hedging={"max_urls": 2, "delay": 5})
+        # Then
+        self.assertEqual(result, "success")
+        self.assertEqual(local_entry["url_used"], urls[0])
+        self.assertEqual(mock_download_from_url.call_count, 1)
+
+    @patch(f"{TESTED_MODULE}._download_from_url")
+    def test_hedged_download_failed(self, mock_download_from_url):
+        # Given
+        mock_download_from_url.side_effect = EmptyFileContentException("")
+        # When
+        result, local_entry = _download_publication(self.urls, self.filename, {"doi": "fake_doi"}, None, None,
+                                                    hedging={"max_urls": 2, "delay": 0})
+        # Then
+        self.assertEqual(result, "fail")
+        self.assertEqual(mock_download_from_url.call_count, 2)
+        self.assertFalse(os.path.exists(self.filename))
+
+
+class ClassifyFailure(TestCase):
+    def test_classify_failure(self):
+        self.assertEqual(classify_failure(HostUnavailableException("", "hal.science")), TRANSIENT_FAILURE)
+        self.assertEqual(classify_failure(UnsuccessfulResponseException("", 502)), TRANSIENT_FAILURE)
+        self.assertEqual(classify_failure(UnsuccessfulResponseException("", 429)), TRANSIENT_FAILURE)
+        self.assertEqual(classify_failure(SlowTransferException("")), TRANSIENT_FAILURE)
+        self.assertEqual(classify_failure(UnsuccessfulResponseException("", 404)), PERMANENT_FAILURE)
+        self.assertEqual(classify_failure(NotAPdfException("")), PERMANENT_FAILURE)
+        self.assertEqual(classify_failure(EmptyFileContentException("")), PERMANENT_FAILURE)
+
+    @patch(f"{TESTED_MODULE}.standard_download")
+    def test_a_transient_failure_keeps_the_urls(self, mock_standard_download):
+        # Given
+        urls = ["https://hal.science/1", "https://zenodo.org/1"]
+        mock_standard_download.side_effect = [UnsuccessfulResponseException("", 404),
+                                              UnsuccessfulResponseException("", 503)]
+        # When
+        result, local_entry = _download_publication(urls, "fake_filename", {"doi": "fake_doi"}, None, None)
+        # Then
+        self.assertEqual(result, "fail")
+        self.assertEqual(local_entry["failure"], TRANSIENT_FAILURE)
+        self.assertEqual(local_entry["urls"], urls)
+
+    @patch(f"{TESTED_MODULE}.standard_download")
+    def test_a_permanent_failure(self, mock_standard_download):
+        # Given
+        mock_standard_download.side_effect = UnsuccessfulResponseException("", 404)
+        # When
+        result, local_entry = _download_publication(["https://hal.science/1"], "fake_filename", {"doi": "fake_doi"},
+                                                    None, None)
+        # Then
+        self.assertEqual(local_entry["failure"], PERMANENT_FAILURE)
+        self.assertNotIn("urls", local_entry)
+
+
+class CircuitBreaker(TestCase):
+    @patch(f"{TESTED_MODULE}.standard_download")
+    def test_the_urls_of_the_open_circuits_are_skipped(self, mock_standard_download):
+        # Given
+        circuit_breaker = MagicMock()
+        circuit_breaker.is_open.side_effect = lambda host: host == "dead.org"
+        mock_standard_download.side_effect = EmptyFileContentException("")
+        # When
+        result, _ = _download_publication(["https://dead.org/1", "https://alive.org/1"], "fake_filename",
+                                          {"doi": "fake_doi"}, None, None, None, circuit_breaker)
+        # Then
+        self.assertEqual(result, CIRCUIT_OPEN_DOWNLOAD)
+        mock_standard_download.assert_called_once_with("https://alive.org/1", "fake_filename", "fake_doi",
+                                                       cancel=None, budget=None)
+
+    @patch(f"{TESTED_MODULE}.standard_download")
+    def test_host_failures_and_successes_are_recorded(self, mock_standard_download):
+        # Given
+        circuit_breaker = MagicMock()
+        circuit_breaker.is_open.return_value = False
+        mock_standard_download.side_effect = [HostUnavailableException("", "dead.org"), ("success", "standard")]
+        # When
+        result, _ = _download_publication(["https://dead.org/1", "https://alive.org/1"], "fake_filename",
+                                          {"doi": "fake_doi"}, None, None, None, circuit_breaker)
+        # Then
+        self.assertEqual(result, "success")
+        circuit_breaker.record_failure.assert_called_once_with("dead.org")
+        circuit_breaker.record_success.assert_called_once_with("alive.org")
+
+
+class Scraper(TestCase):
+    @patch(f"{TESTED_MODULE}._process_request")
+    @patch(f"{TESTED_MODULE}.cloudscraper")
+    def test_each_download_thread_keeps_its_scraper(self, mock_cloudscraper, mock_process_request):
+        # Given
+        mock_cloudscraper.create_scraper.side_effect = lambda interpreter: MagicMock()
+        mock_process_request.return_value = True
+
+        def download_twice():
+            for _ in range(2):
+                standard_download("https://hal.science/1", "fake_filename", "fake_doi")
+
+        # When
+        for _ in range(2):
+            thread = Thread(target=download_twice)
+            thread.start()
+            thread.join()
+        # Then
+        scrapers = [call.args[0] for call in mock_process_request.call_args_list]
+        self.assertEqual(mock_cloudscraper.create_scraper.call_count, 2)
+        self.assertIs(scrapers[0], scrapers[1])
+        self.assertIs(scrapers[2], scrapers[3])
+        self.assertIsNot(scrapers[0], scrapers[2])
+
+
+class TricklingHandler(BaseHTTPRequestHandler):
+    """Sends a PDF one byte every half second"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", "100000")
+        self.end_headers()
+        try:
+            self.wfile.write(b"%PDF-")
+            for _ in range(60):
+                self.wfile.flush()
+                sleep(0.5)
+                self.wfile.write(b"x")
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TricklingServer(TestCase):
+    def setUp(self):
+        self.filepath = "trickling_server_test.pdf"
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), TricklingHandler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/document.pdf"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def assert_aborted_at_the_deadline(self, scraper):
+        # Given
+        budget = TransferLimits(deadline=3, min_bandwidth=1000).new_budget()
+        start = monotonic()
+        # Then
+        with self.assertRaises(SlowTransferException):
+            # When
+            _process_request(scraper, self.url, self.filepath, budget=budget)
+        self.assertLess(monotonic() - start, 5)
+        self.assertFalse(os.path.exists(self.filepath))
+        self.assertFalse(os.path.exists(self.filepath + ".part"))
+        self.assertEqual(budget.limits.get_stats()[get_host([self.url])]["slow_transfers"], 1)
+
+    def test_a_blocked_read_is_aborted_at_the_deadline(self):
+        self.assert_aborted_at_the_deadline(cloudscraper.create_scraper(interpreter="nodejs"))
+
+
 class ProcessRequest(TestCase):
     def test_process_request_cairn_in_url(self):
         # Given
         url = "a_cairn_url"
         expected_headers = {"User-Agent": "MESRI-Barometre-de-la-Science-Ouverte"}
         scraper = abc
-        scraper.get = MagicMock()
+        scraper.get = MagicMock(return_value=MagicMock(status_code=404))
         # When
-        _process_request(scraper, url)
+        with self.assertRaises(UnsuccessfulResponseException):
+            _process_request(scraper, url, "fake_filename")
         # Then
-        scraper.get.assert_called_with(url, headers=expected_headers, timeout=60)
+        scraper.get.assert_called_with(url, headers=expected_headers, timeout=60, stream=True)
 
     def test_process_request_standard_url_no_specific_header(self):
         # Given
         url = ""
         scraper = abc
-        scraper.get = MagicMock()
+        scraper.get = MagicMock(return_value=MagicMock(status_code=404))
         # When
-        _process_request(scraper, url)
+        with self.assertRaises(UnsuccessfulResponseException):
+            _process_request(scraper, url, "fake_filename")
         # Then
-        scraper.get.assert_called_with(url, timeout=60)
+        scraper.get.assert_called_with(url, timeout=60, stream=True)
 
     def test_process_request_not_200(self):
         # Given
@@ -178,11 +465,13 @@ class ProcessRequest(TestCase):
 
         scraper.get.return_value = expected_response
         # When
-        content = _process_request(scraper, url)
+        with self.assertRaises(UnsuccessfulResponseException) as context:
+            _process_request(scraper, url, "fake_filename")
         # Then
-        self.assertIsNone(content)
+        self.assertEqual(context.exception.status_code, 400)
 
-    def test_process_request_200_pdf(self):
+    @patch(f"{TESTED_MODULE}.write_pdf_stream")
+    def test_process_request_200_pdf(self, mock_write_pdf_stream):
         # Given
         url = ""
         scraper = abc
@@ -190,15 +479,19 @@ class ProcessRequest(TestCase):
 
         expected_response = MagicMock()
         expected_response.status_code = 200
-        expected_response.text = "%PDF-"
-        expected_content = "expected_content"
-        expected_response.content = expected_content
+        expected_response.headers = {"Content-Length": "16"}
+        expected_response.iter_content.return_value = iter([b"%PDF", b"-expected_content"])
 
         scraper.get.return_value = expected_response
         # When
-        content = _process_request(scraper, url)
+        downloaded = _process_request(scraper, url, "fake_filename")
         # Then
-        self.assertEqual(content, expected_content)
+        self.assertTrue(downloaded)
+        chunks, filename = mock_write_pdf_stream.call_args.args
+        self.assertEqual(b"".join(chunks), b"%PDF-expected_content")
+        self.assertEqual(filename, "fake_filename")
+        self.assertEqual(mock_write_pdf_stream.call_args.kwargs, {"content_length": "16", "cancel": None, "budget": None})
+        expected_response.close.assert_called_once()
 
     @patch("harvester.download_publication_utils.BeautifulSoup")
     def test_process_request_200_not_pdf(self, mock_BeautifulSoup):
@@ -209,7 +502,7 @@ class ProcessRequest(TestCase):
 
         expected_response = MagicMock()
         expected_response.status_code = 200
-        expected_response.text = "html_content"
+        expected_response.iter_content.return_value = iter([b"html_content"])
 
         scraper.get.return_value = expected_response
         soup_mock = MagicMock()
@@ -220,15 +513,15 @@ class ProcessRequest(TestCase):
         original_function = _process_request
         with patch("harvester.download_publication_utils._process_request") as mock_process_request:
             # When
-            original_function(scraper, url)
+            original_function(scraper, url, "fake_filename")
             # Then
             redirect_n = 1
-            mock_process_request.assert_called_with(scraper, redirect_url, redirect_n)
+            mock_process_request.assert_called_with(scraper, redirect_url, "fake_filename", redirect_n, cancel=None,
+                                                    budget=None)
 
     def test_cloudscrapper_download_timeout(self):
         # Given
         scraper = cloudscraper.create_scraper(interpreter="nodejs")
         # When
-        content = _process_request(scraper, timeout_url, n=0, timeout_in_seconds=10)
-        # Then
-        self.assertIsNone(content)
+        with self.assertRaises(HostUnavailableException):
+            _process_request(scraper, timeout_url, "fake_filename", n=0, timeout_in_seconds=10)
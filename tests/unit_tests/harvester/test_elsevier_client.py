@@ -1,7 +1,7 @@
 from unittest import TestCase
 from unittest.mock import patch
 
-from harvester.exception import FailedRequest
+from harvester.exception import FailedRequest, NotAPdfException
 from harvester.elsevier_client import ElsevierClient
 from tests.unit_tests.fixtures.harvester_constants import fake_doi, elsevier_fake_config, \
     fake_filepath, fake_file_content
@@ -26,7 +26,7 @@ class ElsevierClientConstructor(TestCase):
         mock_init_session.assert_called_once_with(elsevier_fake_config)
 
 
-@patch(f'harvester.base_api_client.write_to_file')
+@patch(f'harvester.base_api_client.write_pdf_stream')
 class ElsevierClientTest(TestCase):
 
     @patch.object(ElsevierClient, '_init_session')
@@ -39,7 +39,7 @@ class ElsevierClientTest(TestCase):
         ElsevierClient.clear_instance()
 
     def test_get_publication_base_url_should_correctly_form_the_url_from_wiley_configuration_dict(
-            self, mock_write_to_file):
+            self, mock_write_pdf_stream):
         # given
         expected_publication_base_url = 'https://elsevier-publication-url/'
 
@@ -50,7 +50,7 @@ class ElsevierClientTest(TestCase):
         self.assertEqual(expected_publication_base_url, actual_publication_base_url)
 
     def test_get_publication_url_should_format_doi_and_add_it_to_base_url(
-            self, mock_write_to_file):
+            self, mock_write_pdf_stream):
         # given
         expected_publication_url = 'https://elsevier-publication-url/fake/doi'
 
@@ -61,7 +61,7 @@ class ElsevierClientTest(TestCase):
         self.assertEqual(expected_publication_url, actual_publication_url)
 
     def test_validate_downloaded_content_and_write_it_response_ok_behavior(
-            self, mock_write_to_file):
+            self, mock_write_pdf_stream):
         # given
         response = ResponseMock(200, fake_file_content)
 
@@ -69,10 +69,24 @@ class ElsevierClientTest(TestCase):
         self.wiley_client._validate_downloaded_content_and_write_it(response, fake_doi, fake_filepath)
 
         # then
-        mock_write_to_file.assert_called_once_with(fake_file_content, fake_filepath)
+        mock_write_pdf_stream.assert_called_once()
+        chunks, filepath = mock_write_pdf_stream.call_args.args
+        self.assertEqual(b''.join(chunks), fake_file_content.encode())
+        self.assertEqual(filepath, fake_filepath)
+
+    def test_validate_downloaded_content_and_write_it_should_raise_a_failed_request_exception_when_not_a_pdf(
+            self, mock_write_pdf_stream):
+        # given
+        response = ResponseMock(200, '<html></html>')
+        mock_write_pdf_stream.side_effect = NotAPdfException('Not a PDF')
+
+        # then
+        with self.assertRaises(FailedRequest):
+            # when
+            self.wiley_client._validate_downloaded_content_and_write_it(response, fake_doi, fake_filepath)
 
     def test_validate_downloaded_content_and_write_it_should_raise_a_failed_request_exception_when_response_is_not_ok(
-            self, mock_write_to_file):
+            self, mock_write_pdf_stream):
         # given
         status_code = 500
         response = ResponseMock(status_code, fake_file_content)
@@ -85,4 +99,4 @@ class ElsevierClientTest(TestCase):
         exception_message = cm.exception.args[0]
         assert 'status code = 500' in exception_message
         assert f'doi = {fake_doi}' in exception_message
-        mock_write_to_file.assert_not_called()
+        mock_write_pdf_stream.assert_not_called()
@@ -1,8 +1,11 @@
 import abc
 import gzip
 import json
+import math
 import os
 import unittest
+from threading import Event
+from time import monotonic
 from unittest import TestCase, mock
 
 from config.path_config import (COMPRESSION_EXT, DATA_PATH, METADATA_EXT,
@@ -11,7 +14,10 @@ from harvester.OAHarvester import (METADATA_PREFIX, PUBLICATION_PREFIX,
                                    Continue, OAHarvester, OvhPath,
                                    _check_entry, _count_entries,
                                    generateStoragePath, get_latest_publication,
+                                   get_work_item, is_eligible, loads_entry,
                                    update_dict, uuid)
+from harvester.host_scheduler import HostScheduler
+from harvester.token_bucket import TokenBucket
 from tests.unit_tests.fixtures.api_clients import (elsevier_client_mock,
                                                    wiley_client_mock)
 from tests.unit_tests.fixtures.harvester import (FIXTURES_PATH,
@@ -25,6 +31,7 @@ from tests.unit_tests.fixtures.harvester import (FIXTURES_PATH,
                                                  sample_filenames,
                                                  sample_urls_lists,
                                                  sample_uuids)
+from domain.work_item import WORK_ITEMS_EXT, WorkItem
 from utils.file import compress, decompress
 
 
@@ -42,6 +49,39 @@ class CountEntries(TestCase):
 
         self.assertEqual(nb_publications, 2)
 
+class IsEligible(TestCase):
+    def setUp(self):
+        self.entry = {
+            "doi": "fake_doi",
+            "bso_country_corrected": ["fr", "us"],
+            "publisher_normalized": "Unknown",
+            "oa_details": {"2020Q1": {"is_oa": False}, "2022Q3": {"is_oa": True}},
+        }
+
+    def test_french_oa_publication_with_doi_is_eligible(self):
+        self.assertTrue(is_eligible(self.entry))
+
+    def test_publication_without_doi_is_not_eligible(self):
+        self.entry["doi"] = None
+        self.assertFalse(is_eligible(self.entry))
+
+    def test_publication_without_french_affiliation_is_not_eligible(self):
+        self.entry["bso_country_corrected"] = ["us"]
+        self.assertFalse(is_eligible(self.entry))
+        del self.entry["bso_country_corrected"]
+        self.assertFalse(is_eligible(self.entry))
+
+    def test_closed_access_publication_is_only_eligible_through_publishers_apis(self):
+        self.entry["oa_details"]["2022Q3"]["is_oa"] = False
+        self.assertFalse(is_eligible(self.entry))
+        self.entry["publisher_normalized"] = "Wiley"
+        self.assertTrue(is_eligible(self.entry))
+
+    def test_custom_eligibility_conditions(self):
+        self.entry["bso_country_corrected"] = ["us"]
+        self.assertTrue(is_eligible(self.entry, [lambda entry: "us" in entry["bso_country_corrected"]]))
+
+
 class HarvestUnpaywall(TestCase):
     def test_when_wrong_filepath_raise_FileNotFoundError_exception(self):
         wrong_filepath = "wrong_filepath"
@@ -76,7 +116,6 @@ class HarvestUnpaywall(TestCase):
     def test__get_batch_generator_last_batch(self, mock_getUUIDByIdentifier, mock_uuid4):
         # Given
         filepath = os.path.join(FIXTURES_PATH, "dump_2_publications.jsonl.gz.test")
-        count = _count_entries(gzip.open, filepath)
         reprocess = False
         batch_size = 100
         expected_urls = sample_urls_lists
@@ -86,7 +125,7 @@ class HarvestUnpaywall(TestCase):
         mock_uuid4.side_effect = sample_uuids
         # When
         batch_gen = harvester_2_publications._get_batch_generator(
-            filepath, count, reprocess, batch_size
+            filepath, reprocess, batch_size
         )
         # Then
         for i, batch in enumerate(batch_gen):
@@ -102,7 +141,6 @@ class HarvestUnpaywall(TestCase):
     def test__get_batch_generator(self, mock_getUUIDByIdentifier, mock_uuid4):
         # Given
         filepath = os.path.join(FIXTURES_PATH, "dump_2_publications.jsonl.gz.test")
-        count = _count_entries(gzip.open, filepath)
         reprocess = False
         batch_size = 1
         expected_urls = sample_urls_lists
@@ -112,7 +150,7 @@ class HarvestUnpaywall(TestCase):
         mock_uuid4.side_effect = sample_uuids
         # When
         batch_gen = harvester_2_publications._get_batch_generator(
-            filepath, count, reprocess, batch_size
+            filepath, reprocess, batch_size
         )
         # Then
         for i, batch in enumerate(batch_gen):
@@ -129,19 +167,40 @@ class HarvestUnpaywall(TestCase):
     def test__get_batch_generator_Continue(self, mock_getUUIDByIdentifier, mock_uuid4):
         # Given
         filepath = os.path.join(FIXTURES_PATH, "dump_2_publications.jsonl.gz.test")
-        count = _count_entries(gzip.open, filepath)
         reprocess = False
         batch_size = 1
         mock_getUUIDByIdentifier.return_value = None
         mock_uuid4.side_effect = sample_uuids
         # When
         batch_gen = harvester_2_publications._get_batch_generator(
-            filepath, count, reprocess, batch_size
+            filepath, reprocess, batch_size
         )
         # Then
         for i, batch in enumerate(batch_gen):
             self.assertEqual(batch, [])
 
+    @mock.patch("harvester.OAHarvester.loads_entry")
+    @mock.patch.object(OAHarvester, "_process_entry")
+    def test__get_batch_generator_lines_without_pre_check_pattern_are_not_decoded(
+        self, mock_process_entry, mock_loads_entry
+    ):
+        # Given
+        filepath = os.path.join(FIXTURES_PATH, "dump_2_publications.jsonl.gz.test")
+        harvester_2_publications.eligibility_pre_check = b'"zz"'
+        # When
+        batches = list(harvester_2_publications._get_batch_generator(filepath, False, 1))
+        harvester_2_publications.eligibility_pre_check = b'"fr"'
+        # Then
+        self.assertEqual([entry for batch in batches for entry in batch], [])
+        mock_loads_entry.assert_not_called()
+        mock_process_entry.assert_not_called()
+
+    def test_loads_entry(self):
+        self.assertEqual(loads_entry(b'{"doi": "fake_doi", "bso_country_corrected": ["fr"]}\n'),
+                         {"doi": "fake_doi", "bso_country_corrected": ["fr"]})
+        # NaN is decoded by json
+        self.assertTrue(math.isnan(loads_entry(b'{"amount_apc_EUR": NaN}')["amount_apc_EUR"]))
+
     @mock.patch.object(OAHarvester, "getUUIDByIdentifier")
     def test__process_entry_when_entry_already_processed(self, mock_getUUIDByIdentifier):
         # Given
@@ -271,6 +330,367 @@ class HarvestUnpaywall(TestCase):
         self.assertEqual(entry["id"], expected_id)
 
 
+class WorkItems(TestCase):
+    def setUp(self):
+        with gzip.open(os.path.join(FIXTURES_PATH, "dump_2_publications.jsonl.gz.test"), "rt") as f_in:
+            self.entries = [json.loads(line) for line in f_in]
+        self.work_items_file = os.path.join(FIXTURES_PATH, "dump_2_publications" + WORK_ITEMS_EXT)
+
+    def tearDown(self):
+        if os.path.exists(self.work_items_file):
+            os.remove(self.work_items_file)
+
+    def test_get_work_item(self):
+        # When
+        work_items = [get_work_item(entry) for entry in self.entries]
+        # Then
+        self.assertEqual([work_item.doi for work_item in work_items], [entry["doi"] for entry in sample_entries])
+        self.assertEqual([work_item.urls for work_item in work_items], sample_urls_lists)
+        self.assertEqual([work_item.harvester for work_item in work_items], ["standard", "standard"])
+        self.assertEqual(WorkItem.from_json(work_items[0].to_json()), work_items[0])
+
+    def test_get_work_item_of_closed_access_publication(self):
+        # Given
+        entry = self.entries[0]
+        entry["oa_details"][max(entry["oa_details"])]["is_oa"] = False
+        entry["publisher_normalized"] = "Unknown"
+        # When
+        work_item = get_work_item(entry)
+        entry["publisher_normalized"] = "Elsevier"
+        elsevier_work_item = get_work_item(entry)
+        # Then
+        self.assertIsNone(work_item)
+        self.assertEqual(elsevier_work_item.urls, [f"https://api.elsevier.com/content/article/doi/{entry['doi']}"])
+        self.assertEqual(elsevier_work_item.harvester, "elsevier")
+
+    def test_the_work_item_and_the_parsed_entry_have_the_same_urls_and_harvester(self):
+        # Given an open access publication hosted by Wiley
+        entry = self.entries[0]
+        entry["id"] = sample_uuids[0]
+        for oa_location in entry["oa_details"][max(entry["oa_details"])]["oa_locations"]:
+            oa_location["url_for_pdf"] = f"https://onlinelibrary.wiley.com/doi/pdf/{entry['doi']}"
+        # When
+        work_item = get_work_item(entry)
+        urls, local_entry, _ = harvester_2_publications._parse_entry(entry)
+        # Then
+        self.assertEqual(work_item.harvester, "wiley")
+        self.assertEqual(urls, work_item.urls)
+        self.assertEqual(local_entry["doi"], work_item.doi)
+        self.assertTrue(local_entry["oa_locations"])
+
+    @mock.patch.object(uuid, "uuid4")
+    @mock.patch.object(OAHarvester, "processBatch")
+    @mock.patch.object(OAHarvester, "getUUIDByIdentifier")
+    def test_harvestUnpaywall_consumes_work_items(self, mock_getUUIDByIdentifier, mock_processBatch, mock_uuid4):
+        # Given
+        with gzip.open(self.work_items_file, "wt") as f_out:
+            f_out.write("".join(f"{get_work_item(entry).to_json()}\n" for entry in self.entries))
+        mock_uuid4.side_effect = sample_uuids
+        mock_getUUIDByIdentifier.return_value = None
+        expected_entries = [{"doi": entry["doi"], "domain": entry["domain"], "id": entry["id"]}
+                            for entry in sample_entries]
+        # When
+        harvester_2_publications.harvestUnpaywall(self.work_items_file)
+        # Then
+        mock_processBatch.assert_called_with(sample_urls_lists, sample_filenames, expected_entries, "")
+
+
+class ProcessPipeline(TestCase):
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_only_recorded_downloads_are_uploaded(self, mock_download_publication, mock_record_download,
+                                                  mock_manageFiles):
+        # Given
+        work = [[urls, {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"]
+                for i, urls in enumerate([["url_0"], ["url_1"], ["url_2"]])]
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: ("success", local_entry)
+        mock_record_download.side_effect = lambda result, local_entry: local_entry["doi"] != "doi_1"
+        # When
+        harvester_2_publications.processPipeline(iter(work), "dest")
+        # Then
+        self.assertEqual(mock_download_publication.call_count, 3)
+        self.assertEqual(mock_record_download.call_count, 3)
+        self.assertEqual(sorted(call.args[0]["doi"] for call in mock_manageFiles.call_args_list), ["doi_0", "doi_2"])
+        mock_manageFiles.assert_called_with(mock.ANY, "dest")
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    @mock.patch.object(OAHarvester, "processPipeline")
+    def test_processBatch_with_host_scheduler_does_not_use_the_pipeline(
+            self, mock_processPipeline, mock_download_publication, mock_record_download, mock_manageFiles):
+        # Given
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: ("success", local_entry)
+        mock_record_download.return_value = False
+        # When
+        with mock.patch.dict(harvester_2_publications.config, {"host_scheduler": {"min_delay_per_host": 1}}):
+            harvester_2_publications.processBatch(sample_urls_lists, sample_filenames, sample_entries, "dest")
+        # Then
+        mock_processPipeline.assert_not_called()
+        self.assertEqual(mock_download_publication.call_count, len(sample_entries))
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_rate_limited_downloads_are_put_back(self, mock_download_publication, mock_record_download,
+                                                 mock_manageFiles):
+        # Given
+        rate_limited = {"id": "id_0", "doi": "doi_0", "rate_limit": {"host": "hal.science", "retry_after": 0}}
+        mock_download_publication.side_effect = [("rate_limited", rate_limited),
+                                                 ("success", {"id": "id_0", "doi": "doi_0"})]
+        mock_record_download.return_value = True
+        # When
+        harvester_2_publications.processPipeline(
+            iter([[["https://hal.science/0"], {"id": "id_0", "doi": "doi_0"}, "file_0"]]))
+        # Then
+        self.assertEqual(mock_download_publication.call_count, 2)
+        mock_record_download.assert_called_once_with("success", {"id": "id_0", "doi": "doi_0"})
+
+    @mock.patch.object(uuid, "uuid4")
+    @mock.patch.object(OAHarvester, "processPipeline")
+    @mock.patch.object(OAHarvester, "processBatch")
+    @mock.patch.object(OAHarvester, "getUUIDByIdentifier")
+    def test_harvestUnpaywall_in_pipeline_mode(self, mock_getUUIDByIdentifier, mock_processBatch,
+                                               mock_processPipeline, mock_uuid4):
+        # Given
+        filepath = os.path.join(FIXTURES_PATH, "dump_2_publications.jsonl.gz.test")
+        mock_getUUIDByIdentifier.return_value = None
+        mock_uuid4.side_effect = sample_uuids
+        mock_processPipeline.side_effect = lambda work, destination_dir: self.assertEqual(
+            list(work), [list(e) for e in zip(sample_urls_lists, sample_entries, sample_filenames)])
+        # When
+        with mock.patch.dict(harvester_2_publications.config, {"pipeline": True}):
+            harvester_2_publications.harvestUnpaywall(filepath)
+        # Then
+        mock_processPipeline.assert_called_once()
+        mock_processBatch.assert_not_called()
+
+    @mock.patch("harvester.OAHarvester.get_current_job")
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_adaptive_concurrency_is_published_in_the_job_meta(self, mock_download_publication, mock_record_download,
+                                                               mock_manageFiles, mock_get_current_job):
+        # Given
+        work = [[[f"https://host{i}.org/{i}"], {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"] for i in range(4)]
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: ("success", local_entry)
+        mock_record_download.return_value = False
+        job = mock_get_current_job.return_value
+        job.meta = {}
+        adaptive_concurrency = {"min_concurrency": 2, "max_concurrency": 2, "interval": 0}
+        # When
+        with mock.patch.object(harvester_2_publications, "adaptive_concurrency", adaptive_concurrency):
+            harvester_2_publications.processPipeline(iter(work))
+        # Then
+        self.assertEqual(mock_download_publication.call_count, 4)
+        self.assertEqual(job.meta["download_concurrency"], 2)
+        self.assertEqual(job.meta["download_stats"]["error_rate"], 0)
+        job.save_meta.assert_called()
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_the_publisher_api_downloads_wait_for_their_slot_in_the_scheduler(
+            self, mock_download_publication, mock_record_download, mock_manageFiles):
+        # Given
+        work = [[[f"https://onlinelibrary.wiley.com/doi/pdf/{i}"], {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"]
+                for i in range(3)]
+        download_times = []
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: (
+            download_times.append(monotonic()) or ("success", local_entry))
+        mock_record_download.return_value = False
+        rate_limiter = TokenBucket(rate=20, capacity=1)
+        slots = []
+        try_reserve = rate_limiter.try_reserve
+
+        def reserve(horizon):
+            slot = try_reserve(horizon)
+            if slot is not None:
+                slots.append(slot)
+            return slot
+
+        # When
+        with mock.patch.object(wiley_client_mock, "rate_limiter", rate_limiter, create=True), \
+                mock.patch.object(rate_limiter, "try_reserve", side_effect=reserve):
+            harvester_2_publications.processPipeline(iter(work))
+        # Then
+        self.assertEqual(len(slots), 3)
+        self.assertEqual(mock_download_publication.call_count, 3)
+        for download_time, slot in zip(sorted(download_times), sorted(slots)):
+            self.assertGreaterEqual(download_time, slot)
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_the_publisher_api_slots_are_only_reserved_for_the_next_requests(
+            self, mock_download_publication, mock_record_download, mock_manageFiles):
+        # Given
+        work = [[[f"https://onlinelibrary.wiley.com/doi/pdf/{i}"], {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"]
+                for i in range(10)]
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: ("success", local_entry)
+        mock_record_download.return_value = False
+        rate_limiter = TokenBucket(rate=20, capacity=1)
+        lookaheads = []
+        try_reserve = rate_limiter.try_reserve
+
+        def reserve(horizon):
+            now = monotonic()
+            slot = try_reserve(horizon)
+            if slot is not None:
+                lookaheads.append(slot - now)
+            return slot
+
+        # When
+        with mock.patch.object(wiley_client_mock, "rate_limiter", rate_limiter, create=True), \
+                mock.patch.object(rate_limiter, "try_reserve", side_effect=reserve), \
+                mock.patch.object(harvester_2_publications, "download_workers", 2):
+            harvester_2_publications.processPipeline(iter(work))
+        # Then
+        self.assertEqual(mock_download_publication.call_count, 10)
+        self.assertEqual(len(lookaheads), 10)
+        self.assertLessEqual(max(lookaheads), 2 / 20)
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_the_publisher_api_downloads_do_not_hold_the_open_access_downloads(
+            self, mock_download_publication, mock_record_download, mock_manageFiles):
+        # Given
+        work = [[["https://onlinelibrary.wiley.com/doi/pdf/0"], {"id": "id_0", "doi": "doi_0"}, "file_0"]]
+        work += [[[f"https://host{i}.org/{i}"], {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"] for i in range(1, 4)]
+        open_access_done = Event()
+        downloaded = []
+
+        def download_publication(urls, filename, local_entry, *args):
+            if "wiley" in urls[0]:
+                open_access_done.wait(timeout=5)
+            downloaded.append(local_entry["doi"])
+            if len(downloaded) == 3:
+                open_access_done.set()
+            return "success", local_entry
+
+        mock_download_publication.side_effect = download_publication
+        mock_record_download.return_value = False
+        # When
+        with mock.patch.object(wiley_client_mock, "rate_limiter", TokenBucket(rate=100, capacity=1), create=True), \
+                mock.patch.object(harvester_2_publications, "download_workers", 1), \
+                mock.patch.object(harvester_2_publications, "publisher_api_workers", 1):
+            harvester_2_publications.processPipeline(iter(work))
+        # Then
+        self.assertEqual(downloaded, ["doi_1", "doi_2", "doi_3", "doi_0"])
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_the_publisher_api_lane_holds_the_downloads_of_the_horizon(
+            self, mock_download_publication, mock_record_download, mock_manageFiles):
+        # Given
+        work = [[[f"https://onlinelibrary.wiley.com/doi/pdf/{i}"], {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"]
+                for i in range(6)]
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: ("success", local_entry)
+        mock_record_download.return_value = False
+        schedulers = []
+        from_config = HostScheduler.from_config
+
+        def create_scheduler(*args, **kwargs):
+            schedulers.append(from_config(*args, **kwargs))
+            return schedulers[-1]
+
+        # When
+        with mock.patch.object(HostScheduler, "from_config", side_effect=create_scheduler), \
+                mock.patch.object(wiley_client_mock, "rate_limiter", TokenBucket(rate=20)), \
+                mock.patch.object(elsevier_client_mock, "rate_limiter", TokenBucket(rate=1)), \
+                mock.patch.object(harvester_2_publications, "publisher_api_workers", 1), \
+                mock.patch.object(harvester_2_publications, "publisher_api_horizon", 0.1):
+            harvester_2_publications.processPipeline(iter(work))
+        # Then
+        self.assertEqual(schedulers[1].maxsize, 3)
+        self.assertEqual(mock_download_publication.call_count, 6)
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_the_publisher_api_lane_only_counts_the_available_clients(
+            self, mock_download_publication, mock_record_download, mock_manageFiles):
+        # Given
+        work = [[[f"https://onlinelibrary.wiley.com/doi/pdf/{i}"], {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"]
+                for i in range(3)]
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: ("success", local_entry)
+        mock_record_download.return_value = False
+        schedulers = []
+        from_config = HostScheduler.from_config
+
+        def create_scheduler(*args, **kwargs):
+            schedulers.append(from_config(*args, **kwargs))
+            return schedulers[-1]
+
+        # When
+        with mock.patch.object(HostScheduler, "from_config", side_effect=create_scheduler), \
+                mock.patch.object(wiley_client_mock, "rate_limiter", TokenBucket(rate=20)), \
+                mock.patch.object(harvester_2_publications, "elsevier_client", None), \
+                mock.patch.object(harvester_2_publications, "publisher_api_workers", 1), \
+                mock.patch.object(harvester_2_publications, "publisher_api_horizon", 0.1):
+            harvester_2_publications.processPipeline(iter(work))
+        # Then
+        self.assertEqual(schedulers[1].maxsize, 2)
+        self.assertEqual(mock_download_publication.call_count, 3)
+
+    @mock.patch.object(OAHarvester, "manageFiles")
+    @mock.patch.object(OAHarvester, "_record_download")
+    @mock.patch("harvester.OAHarvester._download_publication")
+    def test_no_publisher_api_lane_without_available_clients(
+            self, mock_download_publication, mock_record_download, mock_manageFiles):
+        # Given
+        work = [[[f"https://onlinelibrary.wiley.com/doi/pdf/{i}"], {"id": f"id_{i}", "doi": f"doi_{i}"}, f"file_{i}"]
+                for i in range(3)]
+        mock_download_publication.side_effect = lambda urls, filename, local_entry, *args: ("success", local_entry)
+        mock_record_download.return_value = False
+        # When
+        with mock.patch.object(HostScheduler, "from_config", wraps=HostScheduler.from_config) as mock_from_config, \
+                mock.patch.object(harvester_2_publications, "wiley_client", None), \
+                mock.patch.object(harvester_2_publications, "elsevier_client", None), \
+                mock.patch.object(harvester_2_publications, "publisher_api_workers", 1):
+            harvester_2_publications.processPipeline(iter(work))
+        # Then
+        mock_from_config.assert_called_once()
+        self.assertEqual(mock_download_publication.call_count, 3)
+
+    def test_the_arxiv_publications_of_a_batch_are_prefetched(self):
+        # Given
+        batch = [[["https://arxiv.org/pdf/1501.00001", "https://hal.science/1"], {"id": "id_0"}, "file_0"],
+                 [["https://hal.science/2", "https://arxiv.org/pdf/1501.00002"], {"id": "id_1"}, "file_1"]]
+        # When
+        with mock.patch.object(harvester_2_publications, "arxiv_fetcher") as mock_arxiv_fetcher:
+            batches = list(harvester_2_publications._prefetch_arxiv(iter([batch])))
+        # Then
+        self.assertEqual(batches, [batch])
+        mock_arxiv_fetcher.prefetch.assert_called_once_with(
+            ["arxiv/1501/1501.00001/1501.00001" + PUBLICATION_EXT + COMPRESSION_EXT])
+
+
+class TransientFailures(TestCase):
+    def tearDown(self):
+        for env in [harvester_2_publications.env, harvester_2_publications.env_fail]:
+            with env.begin(write=True) as txn:
+                for key in [b"transient_id", b"permanent_id"]:
+                    txn.delete(key)
+
+    def test_the_work_items_of_the_transient_failures_are_recorded(self):
+        # Given
+        urls = ["https://arxiv.org/pdf/1", "https://hal.science/1"]
+        transient = {"id": "transient_id", "doi": "doi_0", "domain": "domain", "harvester_used": "",
+                     "url_used": "", "failure": "transient", "urls": urls}
+        permanent = {"id": "permanent_id", "doi": "doi_1", "domain": "domain", "harvester_used": "",
+                     "url_used": "", "failure": "permanent"}
+        # When
+        harvester_2_publications._record_download("fail", transient)
+        harvester_2_publications._record_download("fail", permanent)
+        # Then
+        self.assertEqual(harvester_2_publications.get_transient_failures(),
+                         [WorkItem("doi_0", "domain", urls, "arxiv")])
+
+
 class ManageFiles(TestCase):
     def setUp(self):
         self.entry = local_entry = sample_entries[0]
@@ -467,6 +887,18 @@ class HarvesterInit(TestCase):
         # Then
         mock_Swift.assert_called_with(config_with_swift)
 
+    @mock.patch("harvester.OAHarvester.logger")
+    @mock.patch.object(OAHarvester, "_init_lmdb")
+    def test_the_pipeline_options_are_ignored_without_the_pipeline(self, mock_init_lmdb, mock_logger):
+        # Given
+        config = {**config_harvester, "host_scheduler": {"min_delay_per_host": 1}}
+        # When
+        _ = OAHarvester(config, wiley_client_mock, elsevier_client_mock)
+        _ = OAHarvester({**config, "pipeline": True}, wiley_client_mock, elsevier_client_mock)
+        # Then
+        mock_logger.warning.assert_called_once_with(
+            "['host_scheduler'] are only used by the pipeline, they are ignored without \"pipeline\": true")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,111 @@
+from threading import Thread
+from time import monotonic
+from unittest import TestCase
+
+from harvester.host_scheduler import HostScheduler, get_host
+
+
+class HostSchedulerTest(TestCase):
+    def test_get_host(self):
+        self.assertEqual(get_host(["https://HAL.science/hal-1/document", "https://other.org"]), "hal.science")
+        self.assertEqual(get_host([]), "")
+
+    def test_downloads_are_interleaved_across_hosts(self):
+        # Given
+        scheduler = HostScheduler(max_concurrency_per_host=10, min_delay_per_host=0)
+        for i in range(3):
+            scheduler.put(f"hal_{i}", "hal.science")
+        scheduler.put("arxiv_0", "arxiv.org")
+        scheduler.put("wiley_0", "wiley.com")
+        scheduler.close()
+        # When
+        items = []
+        while True:
+            scheduled = scheduler.get()
+            if scheduled is None:
+                break
+            items.append(scheduled[1])
+            scheduler.done(scheduled[0])
+        # Then
+        self.assertEqual(items, ["hal_0", "arxiv_0", "wiley_0", "hal_1", "hal_2"])
+
+    def test_a_host_at_max_concurrency_is_skipped(self):
+        # Given
+        scheduler = HostScheduler(max_concurrency_per_host=1, min_delay_per_host=0)
+        scheduler.put("hal_0", "hal.science")
+        scheduler.put("hal_1", "hal.science")
+        scheduler.put("arxiv_0", "arxiv.org")
+        # When
+        first, second = scheduler.get(), scheduler.get()
+        scheduler.done(first[0])
+        third = scheduler.get()
+        # Then
+        self.assertEqual([first[1], second[1], third[1]], ["hal_0", "arxiv_0", "hal_1"])
+
+    def test_min_delay_between_requests_to_a_host(self):
+        # Given
+        scheduler = HostScheduler(max_concurrency_per_host=10, min_delay_per_host=0.2)
+        scheduler.put("hal_0", "hal.science")
+        scheduler.put("hal_1", "hal.science")
+        # When
+        start = monotonic()
+        scheduler.get()
+        scheduler.get()
+        # Then
+        self.assertGreaterEqual(monotonic() - start, 0.2)
+
+    def test_put_blocks_when_the_scheduler_is_full(self):
+        # Given
+        scheduler = HostScheduler(max_concurrency_per_host=10, min_delay_per_host=0, maxsize=1)
+        scheduler.put("hal_0", "hal.science")
+        producer = Thread(target=scheduler.put, args=("hal_1", "hal.science"))
+        # When
+        producer.start()
+        producer.join(timeout=0.1)
+        # Then
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(scheduler.get()[1], "hal_0")
+        producer.join(timeout=1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(len(scheduler), 1)
+
+    def test_pushback_halves_the_concurrency_and_delays_the_host(self):
+        # Given
+        scheduler = HostScheduler(max_concurrency_per_host=8, min_delay_per_host=0)
+        for i in range(4):
+            scheduler.put(f"hal_{i}", "hal.science")
+        host, _ = scheduler.get()
+        # When
+        scheduler.pushback(host, 0.2)
+        scheduler.done(host)
+        start = monotonic()
+        scheduler.get()
+        # Then
+        self.assertEqual(scheduler.get_concurrency("hal.science"), 1)
+        self.assertGreaterEqual(monotonic() - start, 0.2)
+
+    def test_concurrency_grows_back_on_success(self):
+        # Given
+        scheduler = HostScheduler(max_concurrency_per_host=2, min_delay_per_host=0)
+        scheduler.pushback("hal.science", 0)
+        # When
+        scheduler.success("hal.science")
+        scheduler.success("hal.science")
+        # Then
+        self.assertEqual(scheduler.get_concurrency("hal.science"), 2)
+
+    def test_put_later(self):
+        # Given
+        scheduler = HostScheduler(max_concurrency_per_host=10, min_delay_per_host=0)
+        scheduler.put("hal_0", "hal.science")
+        host, item = scheduler.get()
+        scheduler.close()
+        # When
+        scheduler.put_later(item, host, 0.2)
+        scheduler.done(host)
+        start = monotonic()
+        # Then
+        self.assertEqual(scheduler.get(), ("hal.science", "hal_0"))
+        self.assertGreaterEqual(monotonic() - start, 0.2)
+        scheduler.done(host)
+        self.assertIsNone(scheduler.get())
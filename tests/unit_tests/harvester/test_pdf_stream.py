@@ -0,0 +1,134 @@
+import os
+from threading import Event
+from unittest import TestCase
+from unittest.mock import patch
+
+from harvester.exception import DownloadCancelledException, FileTooLargeException, NotAPdfException, \
+    SlowTransferException
+from harvester.pdf_stream import TransferLimits, peek, read_stream, write_pdf_stream
+
+TESTED_MODULE = 'harvester.pdf_stream'
+PDF_CHUNKS = [b"%P", b"DF-1.4", b" fake", b" pdf"]
+
+
+class PdfStream(TestCase):
+    def setUp(self):
+        self.filepath = "pdf_stream_test.pdf"
+
+    def tearDown(self):
+        for filepath in [self.filepath, self.filepath + ".part"]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def test_peek(self):
+        # When
+        head, chunks = peek(iter(PDF_CHUNKS), 5)
+        # Then
+        self.assertEqual(head, b"%PDF-")
+        self.assertEqual(b"".join(chunks), b"".join(PDF_CHUNKS))
+
+    def test_write_pdf_stream(self):
+        # When
+        size = write_pdf_stream(iter(PDF_CHUNKS), self.filepath)
+        # Then
+        self.assertEqual(size, len(b"".join(PDF_CHUNKS)))
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), b"".join(PDF_CHUNKS))
+
+    def test_write_pdf_stream_not_a_pdf(self):
+        # Given
+        def chunks():
+            yield b"<html>"
+            self.fail("The body should not be read after the first bytes")
+        # Then
+        with self.assertRaises(NotAPdfException):
+            # When
+            write_pdf_stream(chunks(), self.filepath)
+        self.assertFalse(os.path.exists(self.filepath))
+
+    def test_write_pdf_stream_too_large(self):
+        # Then
+        with self.assertRaises(FileTooLargeException):
+            # When
+            write_pdf_stream(iter(PDF_CHUNKS), self.filepath, max_size=10)
+        self.assertFalse(os.path.exists(self.filepath))
+        self.assertFalse(os.path.exists(self.filepath + ".part"))
+
+    def test_write_pdf_stream_too_large_content_length(self):
+        # Then
+        with self.assertRaises(FileTooLargeException):
+            # When
+            write_pdf_stream(iter(PDF_CHUNKS), self.filepath, max_size=10, content_length="1000")
+
+    def test_write_pdf_stream_cancelled(self):
+        # Given
+        cancel = Event()
+        cancel.set()
+        # Then
+        with self.assertRaises(DownloadCancelledException):
+            # When
+            write_pdf_stream(iter(PDF_CHUNKS), self.filepath, cancel=cancel)
+        self.assertFalse(os.path.exists(self.filepath + ".part"))
+
+    def test_read_stream(self):
+        self.assertEqual(read_stream(iter([b"<html>", b"<body>"]), max_size=8), b"<html><b")
+
+
+@patch(f"{TESTED_MODULE}.monotonic")
+class TransferBudget(TestCase):
+    def setUp(self):
+        self.filepath = "transfer_budget_test.pdf"
+
+    def tearDown(self):
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    @staticmethod
+    def trickle(mock_monotonic, chunks, seconds_per_chunk):
+        for chunk in chunks:
+            mock_monotonic.return_value += seconds_per_chunk
+            yield chunk
+
+    def test_a_transfer_below_the_minimum_bandwidth_is_aborted(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        budget = TransferLimits(min_bandwidth=100, grace_period=10).new_budget()
+        chunks = self.trickle(mock_monotonic, [b"%PDF-"] + [b"x" * 10] * 10, 1)
+        # Then
+        with self.assertRaises(SlowTransferException):
+            # When
+            write_pdf_stream(chunks, self.filepath, budget=budget)
+        self.assertFalse(os.path.exists(self.filepath))
+
+    def test_a_transfer_above_the_minimum_bandwidth(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        budget = TransferLimits(min_bandwidth=100, grace_period=10).new_budget()
+        chunks = self.trickle(mock_monotonic, [b"%PDF-"] + [b"x" * 1000] * 20, 1)
+        # When
+        size = write_pdf_stream(chunks, self.filepath, budget=budget)
+        # Then
+        self.assertEqual(size, 20005)
+
+    def test_the_deadline_is_shared_by_the_transfers(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 0
+        budget = TransferLimits(deadline=30).new_budget()
+        self.assertEqual(budget.get_timeout(60), 30)
+        chunks = self.trickle(mock_monotonic, [b"%PDF-"] + [b"x" * 1000] * 20, 2)
+        # Then
+        with self.assertRaises(SlowTransferException):
+            # When
+            write_pdf_stream(chunks, self.filepath, budget=budget)
+        with self.assertRaises(SlowTransferException):
+            budget.get_timeout(60)
+
+    def test_the_transfers_are_counted_per_host(self, mock_monotonic):
+        # Given
+        limits = TransferLimits()
+        # When
+        limits.record("hal.science", 1000, 2.0)
+        limits.record("hal.science", 0, 30.0, slow=True)
+        # Then
+        self.assertEqual(limits.get_stats(), {"hal.science": {"transfers": 2, "slow_transfers": 1, "bytes": 1000,
+                                                              "seconds": 32.0}})
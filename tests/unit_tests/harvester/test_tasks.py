@@ -1,30 +1,195 @@
 import gzip
 import json
-from unittest import TestCase
+import shutil
+from datetime import timedelta
+from unittest import TestCase, skipUnless
 from unittest.mock import Mock, patch, MagicMock
 
 from application.server.main.tasks import (
     create_task_harvest_partition,
+    create_task_harvest_split_partition,
     create_task_process,
+    create_task_split_metadata,
+    get_retry_name,
+    MAX_RETRY_ATTEMPTS,
+    RETRY_BASE_DELAY,
+    schedule_retry,
+    CONTIGUOUS_PARTITIONING,
+    DOI_HASH_PARTITIONING,
+    get_doi_partition_index,
+    get_partition_name,
+    get_partition_size,
     write_partitioned_filtered_metadata_file,
+    write_doi_hash_partitioned_metadata_file,
+    write_partitioned_metadata_file,
+    write_split_metadata_files,
 )
 from config.processing_service_namespaces import grobid_ns
+from domain.work_item import WorkItem
 from infrastructure.database.db_handler import DBHandler
 from infrastructure.storage.swift import Swift
 from tests.unit_tests.fixtures.tasks import *
 
 from harvester.OAHarvester import OAHarvester
+from utils.columnar_cache import build_columnar_cache, is_columnar_cache_available
+from utils.seekable_gzip import build_seekable_gzip
 
 TESTED_MODULE = "application.server.main.tasks"
 
 
+class WritePartitionedMetadataFile(TestCase):
+    def tearDown(self):
+        if os.path.exists(partitioned_metadata_filename):
+            os.remove(partitioned_metadata_filename)
+
+    def test_get_partition_size(self):
+        # Given a dump of 10 publications
+        # When
+        partition_size = get_partition_size(source_metadata_file, 3)
+        # Then
+        self.assertEqual(partition_size, 3)
+
+    def test_partitions_cover_the_whole_dump_in_order(self):
+        # Given
+        with gzip.open(source_metadata_file, "rt") as f_in:
+            expected_content = f_in.readlines()
+        total_partition_number = 3
+        partition_size = get_partition_size(source_metadata_file, total_partition_number)
+        content = []
+        # When
+        for partition_index in range(total_partition_number + 1):
+            write_partitioned_metadata_file(
+                source_metadata_file, partitioned_metadata_filename, partition_size, partition_index
+            )
+            with gzip.open(partitioned_metadata_filename, "rt") as f_in:
+                content += f_in.readlines()
+        # Then
+        self.assertEqual(content, expected_content)
+
+    def test_partitions_read_from_the_index_of_a_seekable_dump(self):
+        # Given
+        with gzip.open(source_metadata_file, "rt") as f_in:
+            expected_content = f_in.readlines()
+        index = build_seekable_gzip(source_metadata_file, seekable_metadata_file, index_file, lines_per_seek_point=2)
+        total_partition_number = 3
+        partition_size = get_partition_size(seekable_metadata_file, total_partition_number, index)
+        content = []
+        # When
+        for partition_index in range(total_partition_number + 1):
+            write_partitioned_metadata_file(
+                seekable_metadata_file, partitioned_metadata_filename, partition_size, partition_index, index
+            )
+            with gzip.open(partitioned_metadata_filename, "rt") as f_in:
+                content += f_in.readlines()
+        # Then
+        self.assertEqual(content, expected_content)
+        os.remove(seekable_metadata_file)
+        os.remove(index_file)
+
+    def test_doi_hash_partitions_cover_the_whole_dump(self):
+        # Given
+        with gzip.open(source_metadata_file, "rt") as f_in:
+            expected_dois = sorted(json.loads(line).get("doi") for line in f_in if json.loads(line).get("doi"))
+        total_partition_number = 3
+        dois = []
+        # When
+        for partition_index in range(total_partition_number + 1):
+            write_doi_hash_partitioned_metadata_file(
+                source_metadata_file, partitioned_metadata_filename, total_partition_number, partition_index
+            )
+            with gzip.open(partitioned_metadata_filename, "rt") as f_in:
+                partition_dois = [json.loads(line)["doi"] for line in f_in]
+            # Then
+            for doi in partition_dois:
+                self.assertEqual(get_doi_partition_index(doi, total_partition_number + 1), partition_index)
+            dois += partition_dois
+        self.assertEqual(sorted(dois), expected_dois)
+
+    def test_doi_partition_index_is_stable_and_case_insensitive(self):
+        self.assertEqual(get_doi_partition_index("10.1000/ABC", 7), get_doi_partition_index("10.1000/abc", 7))
+        self.assertEqual(get_doi_partition_index("10.1000/abc", 7), 5)
+
+
+class WriteSplitMetadataFiles(TestCase):
+    @patch.object(DBHandler, "__init__")
+    def setUp(self, mock_db_handler_init):
+        mock_db_handler_init.return_value = None
+        self.mock_db_handler = DBHandler()
+        self.mock_db_handler.fetch_all_dois = Mock()
+        self.mock_db_handler.fetch_all_dois.return_value = {"doi_4"}
+        with gzip.open(split_metadata_file, "wt") as f_out:
+            f_out.write("\n".join(json.dumps(entry) for entry in split_entries))
+
+    def tearDown(self):
+        os.remove(split_metadata_file)
+        shutil.rmtree(os.path.dirname(split_partition_files[0]), ignore_errors=True)
+
+    def _read_partitions(self):
+        partitions = []
+        for partition_file in split_partition_files:
+            with gzip.open(partition_file, "rt") as f_in:
+                partitions.append([json.loads(line)["doi"] for line in f_in])
+        return partitions
+
+    def test_get_partition_name(self):
+        self.assertEqual(get_partition_name("bso-publications-10.jsonl.gz", "job_id", 3),
+                         "partitions/bso-publications-10/job_id/partition_3.work_items.jsonl.gz")
+
+    def test_partitions_are_balanced_and_only_hold_publications_to_harvest(self):
+        # When
+        write_split_metadata_files(self.mock_db_handler, split_metadata_file, split_partition_files, [])
+        # Then
+        self.assertEqual(self._read_partitions(), [["doi_1", "doi_2"], ["doi_5", "doi_7"], ["doi_8"]])
+
+    def test_partitions_with_doi_list(self):
+        # When
+        write_split_metadata_files(self.mock_db_handler, split_metadata_file, split_partition_files,
+                                   ["doi_2", "doi_4", "doi_6", "doi_8"])
+        # Then
+        self.assertEqual(self._read_partitions(), [["doi_2"], ["doi_8"], []])
+
+    def test_doi_hash_partitions_only_hold_publications_to_harvest(self):
+        # When
+        write_split_metadata_files(self.mock_db_handler, split_metadata_file, split_partition_files, [],
+                                   DOI_HASH_PARTITIONING)
+        # Then
+        partitions = self._read_partitions()
+        self.assertEqual(sorted(doi for partition in partitions for doi in partition),
+                         ["doi_1", "doi_2", "doi_5", "doi_7", "doi_8"])
+        for partition_index, partition in enumerate(partitions):
+            for doi in partition:
+                self.assertEqual(get_doi_partition_index(doi, len(split_partition_files)), partition_index)
+
+    @skipUnless(is_columnar_cache_available(), "pyarrow is not installed")
+    def test_partitions_are_the_same_with_the_columnar_cache(self):
+        for partitioning_mode in [CONTIGUOUS_PARTITIONING, DOI_HASH_PARTITIONING]:
+            for doi_list in [[], ["doi_2", "doi_4", "doi_6", "doi_8"]]:
+                # Given
+                write_split_metadata_files(self.mock_db_handler, split_metadata_file, split_partition_files,
+                                           doi_list, partitioning_mode)
+                expected_partitions = self._read_partitions()
+                build_columnar_cache(split_metadata_file, split_columnar_cache)
+                # When
+                write_split_metadata_files(self.mock_db_handler, split_metadata_file, split_partition_files,
+                                           doi_list, partitioning_mode, split_columnar_cache)
+                # Then
+                self.assertEqual(self._read_partitions(), expected_partitions)
+                os.remove(split_columnar_cache)
+
+    def test_no_publication_to_harvest(self):
+        # When
+        write_split_metadata_files(self.mock_db_handler, split_metadata_file, split_partition_files, ["doi_0"])
+        # Then
+        self.assertEqual(self._read_partitions(), [[], [], []])
+
+
 class WritePartitionedFilteredMetadataFile(TestCase):
     @patch.object(DBHandler, "__init__")
     def setUp(self, mock_db_handler_init):
         mock_db_handler_init.return_value = None
         self.mock_db_handler = DBHandler()
-        self.mock_db_handler.fetch_all = Mock()
-        self.mock_db_handler.fetch_all.return_value = []
+        self.mock_db_handler.fetch_all_dois = Mock()
+        self.mock_db_handler.fetch_all_dois.return_value = set()
 
     def tearDown(self):
         try:
@@ -73,6 +238,7 @@ class WritePartitionedFilteredMetadataFile(TestCase):
 class CreateTaskHarvestPartition(TestCase):
     @patch.object(Swift, "__init__")
     @patch.object(DBHandler, "__init__")
+    @patch(f"{TESTED_MODULE}.load_metadata_index")
     @patch(f"{TESTED_MODULE}.load_metadata")
     @patch(f"{TESTED_MODULE}.get_partition_size")
     @patch(f"{TESTED_MODULE}.os.path.join")
@@ -85,8 +251,12 @@ class CreateTaskHarvestPartition(TestCase):
     @patch.object(DBHandler, "count")
     @patch.object(DBHandler, "update_database")
     @patch.object(OAHarvester, "reset_lmdb")
+    @patch.object(OAHarvester, "get_transient_failures")
+    @patch(f"{TESTED_MODULE}.schedule_retry")
     def test_all_called_the_number_of_times_expected_when_executed(
         self,
+        mock_schedule_retry,
+        mock_get_transient_failures,
         mock_reset_lmdb,
         mock_db_update_database,
         mock_db_count,
@@ -99,12 +269,14 @@ class CreateTaskHarvestPartition(TestCase):
         mock_join,
         mock_get_partition_size,
         mock_load_metadata,
+        mock_load_metadata_index,
         mock_db_handler_init,
         mock_swift_init,
     ):
         # Given
         mock_swift_init.return_value = None
         mock_db_handler_init.return_value = None
+        mock_load_metadata_index.return_value = None
         mock_load_metadata.return_value = ""
         mock_get_partition_size.return_value = 1
         mock_join.return_value = ""
@@ -124,6 +296,7 @@ class CreateTaskHarvestPartition(TestCase):
         # Then
         mock_swift_init.assert_called_once()
         mock_db_handler_init.assert_called_once()
+        mock_load_metadata_index.assert_called_once()
         mock_load_metadata.assert_called_once()
         mock_get_partition_size.assert_called_once()
         mock_join.assert_called_once()
@@ -135,9 +308,106 @@ class CreateTaskHarvestPartition(TestCase):
         assert mock_log_debug.call_count == 2
         assert mock_db_count.call_count == 2
         mock_db_update_database.assert_called_once()
+        mock_schedule_retry.assert_called_once_with(mock_get_transient_failures(), "", "", 0)
         mock_reset_lmdb.assert_called_once()
 
 
+class CreateTaskSplitMetadata(TestCase):
+    @patch(f"{TESTED_MODULE}.DESTINATION_DIR_METADATA", FIXTURES_PATH)
+    @patch(f"{TESTED_MODULE}.Queue")
+    @patch(f"{TESTED_MODULE}.get_current_job")
+    @patch(f"{TESTED_MODULE}.write_split_metadata_files")
+    @patch(f"{TESTED_MODULE}.load_metadata_columnar_cache")
+    @patch(f"{TESTED_MODULE}.load_metadata")
+    @patch(f"{TESTED_MODULE}.DBHandler")
+    @patch(f"{TESTED_MODULE}.Swift")
+    def test_one_harvest_job_is_enqueued_per_partition(
+        self, mock_swift, mock_db_handler, mock_load_metadata, mock_load_metadata_columnar_cache,
+        mock_write_split_metadata_files, mock_get_current_job, mock_queue
+    ):
+        # Given
+        mock_load_metadata.return_value = source_metadata_file
+        mock_load_metadata_columnar_cache.return_value = None
+        mock_get_current_job.return_value = MagicMock(id="job_id")
+        mock_write_split_metadata_files.side_effect = lambda db_handler, metadata_file, partition_files, *args: (
+            write_split_metadata_files(MagicMock(), split_metadata_file, partition_files, []))
+        with gzip.open(split_metadata_file, "wt") as f_out:
+            f_out.write("\n".join(json.dumps(entry) for entry in split_entries))
+        self.addCleanup(os.remove, split_metadata_file)
+        total_partition_number = 2
+        # When
+        task_ids = create_task_split_metadata("bso-publications-10.jsonl.gz", total_partition_number, [], None, None,
+                                              60)
+        # Then
+        mock_write_split_metadata_files.assert_called_once()
+        mock_swift().upload_files_to_swift.assert_called_once()
+        self.assertEqual(mock_queue().enqueue.call_count, total_partition_number + 1)
+        mock_queue().enqueue.assert_called_with(
+            create_task_harvest_split_partition,
+            partition_file=get_partition_name("bso-publications-10.jsonl.gz", "job_id", total_partition_number),
+            wiley_client=None, elsevier_client=None, job_timeout=60,
+        )
+        self.assertEqual(len(task_ids), total_partition_number + 1)
+        self.assertFalse(os.path.exists(os.path.join(FIXTURES_PATH, "partitions", "bso-publications-10", "job_id")))
+        os.removedirs(os.path.join(FIXTURES_PATH, "partitions", "bso-publications-10"))
+
+
+class CreateTaskHarvestSplitPartition(TestCase):
+    @patch(f"{TESTED_MODULE}.harvest_metadata_file")
+    @patch(f"{TESTED_MODULE}.load_metadata")
+    @patch(f"{TESTED_MODULE}.DBHandler")
+    @patch(f"{TESTED_MODULE}.Swift")
+    def test_the_local_partition_is_removed_once_harvested(self, mock_swift, mock_db_handler, mock_load_metadata,
+                                                           mock_harvest_metadata_file):
+        # Given
+        partition_file = get_partition_name("bso-publications-10.jsonl.gz", "job_id", 0)
+        local_partition_file = split_partition_files[0]
+        os.makedirs(os.path.dirname(local_partition_file), exist_ok=True)
+        self.addCleanup(shutil.rmtree, os.path.dirname(local_partition_file), ignore_errors=True)
+        with gzip.open(local_partition_file, "wt"):
+            pass
+        mock_load_metadata.return_value = local_partition_file
+        # When
+        create_task_harvest_split_partition(partition_file, None, None)
+        # Then
+        mock_harvest_metadata_file.assert_called_once_with(mock_db_handler(), local_partition_file, None, None, 0)
+        self.assertFalse(os.path.exists(local_partition_file))
+
+
+class ScheduleRetry(TestCase):
+    work_items = [WorkItem("doi_0", "domain", ["https://hal.science/0"], "standard")]
+
+    @patch(f"{TESTED_MODULE}.Queue")
+    @patch(f"{TESTED_MODULE}.get_current_job")
+    @patch(f"{TESTED_MODULE}.Swift")
+    def test_the_transient_failures_are_retried_with_exponential_backoff(self, mock_swift, mock_get_current_job,
+                                                                         mock_queue):
+        # Given
+        mock_get_current_job.return_value = MagicMock(id="job_id", timeout=60)
+        uploaded_work_items = []
+        mock_swift().upload_files_to_swift.side_effect = lambda container, files: uploaded_work_items.extend(
+            WorkItem.from_json(line) for line in gzip.open(files[0][0], "rt"))
+        # When
+        schedule_retry(self.work_items, None, None, 1)
+        # Then
+        self.assertEqual(uploaded_work_items, self.work_items)
+        mock_queue().enqueue_in.assert_called_once_with(
+            timedelta(seconds=2 * RETRY_BASE_DELAY), create_task_harvest_split_partition,
+            partition_file=get_retry_name("job_id", 2), wiley_client=None, elsevier_client=None,
+            retry_attempt=2, job_timeout=60,
+        )
+
+    @patch(f"{TESTED_MODULE}.Queue")
+    @patch(f"{TESTED_MODULE}.get_current_job")
+    @patch(f"{TESTED_MODULE}.Swift")
+    def test_no_retry_after_max_retry_attempts(self, mock_swift, mock_get_current_job, mock_queue):
+        # When
+        task_id = schedule_retry(self.work_items, None, None, MAX_RETRY_ATTEMPTS)
+        # Then
+        self.assertIsNone(task_id)
+        mock_queue().enqueue_in.assert_not_called()
+
+
 class CreateTaskProcess(TestCase):
     @patch(f"{TESTED_MODULE}.logger_console")
     @patch(f"{TESTED_MODULE}.Swift")
@@ -0,0 +1,211 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from harvester.exception import FailedRequest
+from harvester.token_bucket import RedisTokenBucket, TokenBucket
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+TESTED_MODULE = 'harvester.token_bucket'
+
+
+@patch(f"{TESTED_MODULE}.monotonic")
+class TokenBucketTest(TestCase):
+    def test_the_slots_follow_the_rate_once_the_burst_is_over(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket.from_throttle_parameters({"max_num_requests": 2, "window_size": 10}, "wiley")
+        # When
+        slots = [token_bucket.reserve() for _ in range(5)]
+        # Then
+        self.assertEqual(slots, [100, 100, 105, 110, 115])
+
+    def test_the_bucket_is_refilled_over_time(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket(rate=0.1, capacity=1)
+        token_bucket.reserve()
+        # When
+        mock_monotonic.return_value = 104
+        first_slot = token_bucket.reserve()
+        mock_monotonic.return_value = 1000
+        second_slot = token_bucket.reserve()
+        # Then
+        self.assertEqual(first_slot, 110)
+        self.assertEqual(second_slot, 1000)
+
+    def test_the_slots_are_exact_under_concurrency(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket(rate=1, capacity=1)
+        # When
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            slots = list(executor.map(lambda _: token_bucket.reserve(), range(100)))
+        # Then
+        self.assertEqual(sorted(slots), list(range(100, 200)))
+
+    def test_no_token_is_taken_for_a_slot_beyond_the_horizon(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket(rate=0.1, capacity=1)
+        # When
+        slots = [token_bucket.try_reserve(15) for _ in range(3)]
+        # Then
+        self.assertEqual(slots, [100, 110, None])
+        self.assertEqual(token_bucket.reserve(), 120)
+
+    @patch(f"{TESTED_MODULE}.sleep")
+    def test_acquire_waits_for_its_slot(self, mock_sleep, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket(rate=0.5, capacity=1)
+        # When
+        token_bucket.acquire()
+        token_bucket.acquire()
+        # Then
+        mock_sleep.assert_called_once_with(2)
+
+    @patch(f"{TESTED_MODULE}.sleep")
+    def test_acquire_uses_the_slot_reserved_beforehand(self, mock_sleep, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket(rate=0.5, capacity=1)
+        token_bucket.reserve()
+        slot = token_bucket.reserve()
+        mock_monotonic.return_value = slot
+        # When
+        with token_bucket.reserved(slot):
+            token_bucket.acquire()
+        # Then
+        mock_sleep.assert_not_called()
+        self.assertEqual(token_bucket.reserve(), slot + 2)
+
+    def test_an_unused_reserved_slot_is_dropped(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket(rate=0.5, capacity=1)
+        # When
+        with token_bucket.reserved(token_bucket.reserve()):
+            pass
+        # Then
+        self.assertEqual(token_bucket._prepaid, [])
+        self.assertEqual(token_bucket.reserve(), 102)
+
+    def test_the_bucket_can_be_pickled(self, mock_monotonic):
+        # Given
+        mock_monotonic.return_value = 100
+        token_bucket = TokenBucket(rate=0.5, capacity=1)
+        token_bucket.reserve()
+        token_bucket.reserve()
+        # When
+        mock_monotonic.return_value = 5
+        unpickled_token_bucket = pickle.loads(pickle.dumps(token_bucket))
+        # Then
+        self.assertEqual(unpickled_token_bucket.reserve(), 7)
+        self.assertEqual(unpickled_token_bucket.reserve(), 9)
+
+
+@skipUnless(fakeredis is not None, "fakeredis is not installed")
+@patch(f"{TESTED_MODULE}.monotonic")
+@patch(f"{TESTED_MODULE}.redis.from_url")
+class RedisTokenBucketTest(TestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+    def test_the_rate_is_shared_by_the_workers(self, mock_from_url, mock_monotonic):
+        # Given
+        mock_from_url.side_effect = lambda url: fakeredis.FakeRedis(server=self.server)
+        mock_monotonic.return_value = 100
+        throttle_parameters = {"max_num_requests": 1, "window_size": 10, "redis_url": "redis://redis:6379/0"}
+        workers = [TokenBucket.from_throttle_parameters(throttle_parameters, "wiley") for _ in range(2)]
+        # When
+        slots = [workers[i % 2].reserve() for i in range(4)]
+        # Then
+        self.assertIsInstance(workers[0], RedisTokenBucket)
+        for slot, expected_slot in zip(slots, [100, 110, 120, 130]):
+            self.assertAlmostEqual(slot, expected_slot, delta=0.5)
+        self.assertEqual(mock_from_url.call_count, 2)
+
+    def test_the_buckets_of_the_apis_are_independent(self, mock_from_url, mock_monotonic):
+        # Given
+        mock_from_url.side_effect = lambda url: fakeredis.FakeRedis(server=self.server)
+        mock_monotonic.return_value = 100
+        wiley = RedisTokenBucket("redis://redis:6379/0", "throttle:wiley", rate=0.1)
+        elsevier = RedisTokenBucket("redis://redis:6379/0", "throttle:elsevier", rate=0.1)
+        # When
+        wiley.reserve()
+        slot = elsevier.reserve()
+        # Then
+        self.assertAlmostEqual(slot, 100, delta=0.5)
+
+    def test_no_token_is_taken_for_a_slot_beyond_the_horizon(self, mock_from_url, mock_monotonic):
+        # Given
+        mock_from_url.side_effect = lambda url: fakeredis.FakeRedis(server=self.server)
+        mock_monotonic.return_value = 100
+        token_bucket = RedisTokenBucket("redis://redis:6379/0", "throttle:wiley", rate=0.1)
+        # When
+        slots = [token_bucket.try_reserve(15) for _ in range(3)]
+        # Then
+        self.assertAlmostEqual(slots[0], 100, delta=0.5)
+        self.assertAlmostEqual(slots[1], 110, delta=0.5)
+        self.assertIsNone(slots[2])
+        self.assertAlmostEqual(token_bucket.reserve(), 120, delta=0.5)
+
+    def test_the_debt_is_bounded(self, mock_from_url, mock_monotonic):
+        # Given
+        mock_from_url.side_effect = lambda url: fakeredis.FakeRedis(server=self.server)
+        mock_monotonic.return_value = 100
+        token_bucket = RedisTokenBucket("redis://redis:6379/0", "throttle:wiley", rate=0.1, max_debt=20)
+        # When
+        slots = [token_bucket.try_reserve(float("inf")) for _ in range(4)]
+        # Then
+        self.assertIsNone(slots[3])
+        self.assertAlmostEqual(slots[2], 120, delta=0.5)
+
+    @patch(f"{TESTED_MODULE}.sleep")
+    def test_no_slot_is_reserved_when_redis_cannot_be_reached(self, mock_sleep, mock_from_url, mock_monotonic):
+        # Given
+        self.server.connected = False
+        mock_from_url.side_effect = lambda url: fakeredis.FakeRedis(server=self.server)
+        mock_monotonic.return_value = 100
+        token_bucket = RedisTokenBucket("redis://redis:6379/0", "throttle:wiley", rate=0.1)
+        mock_sleep.side_effect = lambda delay: setattr(self.server, "connected", True)
+        # When
+        slot = token_bucket.try_reserve(15)
+        reserved_slot = token_bucket.reserve()
+        # Then
+        self.assertIsNone(slot)
+        mock_sleep.assert_called_once_with(10)
+        self.assertAlmostEqual(reserved_slot, 100, delta=0.5)
+
+    @patch(f"{TESTED_MODULE}.sleep")
+    def test_the_wait_for_a_slot_is_bounded(self, mock_sleep, mock_from_url, mock_monotonic):
+        # Given Redis down for good
+        self.server.connected = False
+        mock_from_url.side_effect = lambda url: fakeredis.FakeRedis(server=self.server)
+        mock_monotonic.return_value = 100
+        throttle_parameters = {"max_num_requests": 1, "window_size": 15, "redis_url": "redis://redis:6379/0",
+                               "max_wait": 40}
+        token_bucket = TokenBucket.from_throttle_parameters(throttle_parameters, "wiley")
+        mock_sleep.side_effect = lambda delay: setattr(mock_monotonic, "return_value", mock_monotonic() + delay)
+        # Then the publication is downloaded without the API
+        with self.assertRaises(FailedRequest):
+            # When
+            token_bucket.acquire()
+        self.assertEqual([call.args[0] for call in mock_sleep.call_args_list], [15, 15, 10])
+
+    def test_the_bucket_can_be_pickled(self, mock_from_url, mock_monotonic):
+        # Given
+        mock_from_url.side_effect = lambda url: fakeredis.FakeRedis(server=self.server)
+        mock_monotonic.return_value = 100
+        token_bucket = RedisTokenBucket("redis://redis:6379/0", "throttle:wiley", rate=0.1)
+        token_bucket.reserve()
+        # When
+        unpickled_token_bucket = pickle.loads(pickle.dumps(token_bucket))
+        # Then
+        self.assertAlmostEqual(unpickled_token_bucket.reserve(), 110, delta=0.5)
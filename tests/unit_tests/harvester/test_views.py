@@ -2,8 +2,11 @@ from typing import Callable
 from unittest import TestCase
 from unittest.mock import Mock, patch, MagicMock
 
+from flask import Flask
+
 from config.processing_service_namespaces import grobid_ns, softcite_ns, datastet_ns
-from application.server.main.views import filter_publications, get_files_to_process, prepare_process_task_arguments
+from application.server.main.views import filter_publications, get_files_to_process, prepare_process_task_arguments, \
+    run_task_harvest_partitions
 from tests.unit_tests.fixtures.views import *
 
 
@@ -85,4 +88,21 @@ class PrepareProcessTaskArguments(TestCase):
         # Then
         self.assertEqual(grobid_ns.partitions, [[], [], [], [], []])
         self.assertEqual(softcite_ns.partitions, expected_partitions)
-        self.assertEqual(datastet_ns.partitions, [[], [], [], [], []])
\ No newline at end of file
+        self.assertEqual(datastet_ns.partitions, [[], [], [], [], []])
+
+
+class RunTaskHarvestPartitions(TestCase):
+    @patch(f"{TESTED_MODULE}.Queue")
+    @patch(f"{TESTED_MODULE}.safe_instanciation_client")
+    def test_an_unknown_partitioning_mode_is_rejected(self, mock_safe_instanciation_client, mock_queue):
+        # Given
+        args = {"metadata_file": "bso-publications.jsonl.gz", "total_partition_number": 1,
+                "partitioning_mode": "doi-hash"}
+        # When
+        with Flask(__name__).test_request_context("/harvest_partitions", method="POST", json=args):
+            response, status_code = run_task_harvest_partitions()
+        # Then
+        self.assertEqual(status_code, 400)
+        self.assertEqual(response.get_json()["status"], "error")
+        mock_safe_instanciation_client.assert_not_called()
+        mock_queue.assert_not_called()
@@ -0,0 +1,79 @@
+import gzip
+import json
+import os
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from harvester.OAHarvester import is_eligible
+from load_metadata import load_metadata_columnar_cache
+from tests.unit_tests.fixtures.tasks import split_columnar_cache, split_entries, split_metadata_file
+from utils.columnar_cache import (build_columnar_cache, get_columnar_cache_name, is_columnar_cache_available,
+                                  select_publications_to_harvest)
+
+
+@skipUnless(is_columnar_cache_available(), "pyarrow is not installed")
+class ColumnarCache(TestCase):
+    def setUp(self):
+        self.entries = split_entries + [
+            {"doi": "doi_wiley", "bso_country_corrected": ["fr"], "publisher_normalized": "Wiley",
+             "oa_details": {"2021Q4": {"is_oa": True}, "2022Q3": {"is_oa": False}}},
+            {"doi": "doi_closed", "bso_country_corrected": ["us", "fr"],
+             "oa_details": {"2021Q4": {"is_oa": True}, "2022Q3": {"is_oa": False}}},
+            {"doi": "doi_no_country", "oa_details": {"2022Q3": {"is_oa": True}}},
+            {"doi": "", "bso_country_corrected": ["fr"], "oa_details": {"2022Q3": {"is_oa": True}}},
+        ]
+        with gzip.open(split_metadata_file, "wt") as f_out:
+            f_out.write("\n".join(json.dumps(entry) for entry in self.entries))
+        self.number_of_lines = build_columnar_cache(split_metadata_file, split_columnar_cache, rows_per_row_group=5)
+
+    def tearDown(self):
+        os.remove(split_metadata_file)
+        os.remove(split_columnar_cache)
+
+    def _expected(self, doi_set, doi_already_harvested):
+        return {line_number: entry["doi"] for line_number, entry in enumerate(self.entries)
+                if is_eligible(entry) and entry["doi"] not in doi_already_harvested
+                and (not doi_set or entry["doi"] in doi_set)}
+
+    def test_get_columnar_cache_name(self):
+        self.assertEqual(get_columnar_cache_name("dir/dump.jsonl.gz"), "dir/dump.jsonl.gz.columns.parquet")
+
+    def test_build_columnar_cache(self):
+        self.assertEqual(self.number_of_lines, len(self.entries))
+
+    def test_select_publications_to_harvest_is_the_eligibility_of_the_entries(self):
+        # When
+        publications_to_harvest = select_publications_to_harvest(split_columnar_cache, set(), set())
+        # Then
+        self.assertEqual(publications_to_harvest, self._expected(set(), set()))
+        self.assertIn("doi_wiley", publications_to_harvest.values())
+        self.assertNotIn("doi_closed", publications_to_harvest.values())
+
+    def test_select_publications_to_harvest_with_doi_list_and_already_harvested(self):
+        # Given
+        doi_set, doi_already_harvested = {"doi_1", "doi_2", "doi_3", "doi_wiley"}, {"doi_2"}
+        # When
+        publications_to_harvest = select_publications_to_harvest(split_columnar_cache, doi_set,
+                                                                 doi_already_harvested)
+        # Then
+        self.assertEqual(publications_to_harvest, {1: "doi_1", 12: "doi_wiley"})
+        self.assertEqual(publications_to_harvest, self._expected(doi_set, doi_already_harvested))
+
+    def test_select_publications_to_harvest_follows_the_api_publishers_of_the_config(self):
+        # When
+        with patch("config.harvest_strategy_config.harvest_api_publishers", ["Elsevier"]), \
+                patch("utils.columnar_cache.harvest_api_publishers", ["Elsevier"]):
+            publications_to_harvest = select_publications_to_harvest(split_columnar_cache, set(), set())
+            expected = self._expected(set(), set())
+        # Then
+        self.assertEqual(publications_to_harvest, expected)
+        self.assertNotIn("doi_wiley", publications_to_harvest.values())
+
+    @patch("load_metadata.Swift")
+    def test_the_cache_is_not_used_without_the_vectorized_eligibility(self, mock_swift):
+        # When
+        with patch("load_metadata.harvest_eligibility_vectorized", False):
+            columnar_cache = load_metadata_columnar_cache("bso_dump", split_metadata_file, "tmp")
+        # Then
+        self.assertIsNone(columnar_cache)
+        mock_swift.assert_not_called()
@@ -0,0 +1,131 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from load_metadata import load_metadata_index
+from tests.unit_tests.fixtures.tasks import index_file, seekable_metadata_file, source_metadata_file
+from utils.seekable_gzip import (build_seekable_gzip, get_index_name, get_partial_index, get_seek_point,
+                                 get_seekable_name, is_index_of, load_index, read_lines)
+
+
+class SeekableGzip(TestCase):
+    def setUp(self):
+        self.index = build_seekable_gzip(source_metadata_file, seekable_metadata_file, index_file,
+                                         lines_per_seek_point=3)
+        with gzip.open(source_metadata_file, "rb") as f_in:
+            self.lines = f_in.readlines()
+
+    def tearDown(self):
+        os.remove(seekable_metadata_file)
+        os.remove(index_file)
+
+    def test_names(self):
+        self.assertEqual(get_seekable_name("dump.jsonl.gz"), "seekable_dump.jsonl.gz")
+        self.assertEqual(get_index_name("dir/dump.jsonl.gz"), "dir/seekable_dump.jsonl.gz.index.json")
+
+    def test_seekable_file_is_a_valid_gzip_with_the_same_content(self):
+        with gzip.open(seekable_metadata_file, "rb") as f_in:
+            self.assertEqual(f_in.readlines(), self.lines)
+
+    def test_index(self):
+        self.assertEqual(load_index(index_file), self.index)
+        self.assertEqual(self.index["number_of_lines"], 10)
+        self.assertEqual([first_line for first_line, _ in self.index["seek_points"]], [0, 3, 6, 9])
+        self.assertEqual(self.index["compressed_size"], os.path.getsize(seekable_metadata_file))
+
+    def test_index_of_the_version_of_the_dump(self):
+        # Given
+        source = {"etag": "etag_1", "size": os.path.getsize(source_metadata_file)}
+        # When
+        index = build_seekable_gzip(source_metadata_file, seekable_metadata_file, index_file,
+                                    lines_per_seek_point=3, source=source)
+        # Then
+        self.assertEqual(load_index(index_file)["source"], source)
+        self.assertTrue(is_index_of(index, dict(source)))
+        self.assertFalse(is_index_of(index, {"etag": "etag_2", "size": source["size"]}))
+        self.assertFalse(is_index_of(index, None))
+        self.assertFalse(is_index_of(self.index, source))
+
+    def test_get_seek_point(self):
+        self.assertEqual(get_seek_point(self.index, 0), self.index["seek_points"][0])
+        self.assertEqual(get_seek_point(self.index, 5), self.index["seek_points"][1])
+        self.assertEqual(get_seek_point(self.index, 6), self.index["seek_points"][2])
+
+    def test_read_lines(self):
+        for start, stop in [(0, 10), (4, 8), (6, 7), (9, 20)]:
+            self.assertEqual(list(read_lines(seekable_metadata_file, self.index, start, stop)), self.lines[start:stop])
+
+    def test_read_lines_from_a_byte_range(self):
+        # Given the part of the file downloaded with a range request
+        partial_seekable_metadata_file = seekable_metadata_file + ".part"
+        for start, stop in [(0, 3), (4, 8), (6, 7), (9, 10)]:
+            partial_index = get_partial_index(self.index, start, stop)
+            first_byte, last_byte = partial_index["byte_range"]
+            with open(seekable_metadata_file, "rb") as f_in, open(partial_seekable_metadata_file, "wb") as f_out:
+                f_in.seek(first_byte)
+                f_out.write(f_in.read(last_byte - first_byte + 1))
+            # When
+            lines = list(read_lines(partial_seekable_metadata_file, partial_index, start, stop))
+            # Then
+            self.assertEqual(lines, self.lines[start:stop])
+        os.remove(partial_seekable_metadata_file)
+
+    def test_partial_index_only_covers_the_members_of_the_lines(self):
+        partial_index = get_partial_index(self.index, 4, 8)
+        self.assertEqual([first_line for first_line, _ in partial_index["seek_points"]], [3, 6])
+        self.assertEqual(partial_index["seek_points"][0][1], 0)
+        self.assertEqual(partial_index["byte_range"],
+                         [self.index["seek_points"][1][1], self.index["seek_points"][3][1] - 1])
+
+
+class LoadMetadataIndex(TestCase):
+    def setUp(self):
+        self.destination_dir = tempfile.mkdtemp()
+        self.remote_index = {"number_of_lines": 10, "compressed_size": 100, "seek_points": [[0, 0]],
+                             "source": {"etag": "etag_2", "size": 200}}
+
+    def tearDown(self):
+        shutil.rmtree(self.destination_dir)
+
+    def _mock_swift(self, mock_swift, source):
+        def download_files(container, file_path, dest_path):
+            with open(os.path.join(dest_path, file_path), "w") as f_out:
+                json.dump(self.remote_index, f_out)
+
+        mock_swift.return_value.get_object_stat.return_value = source
+        mock_swift.return_value.get_swift_list.return_value = [get_index_name("dump.jsonl.gz")]
+        mock_swift.return_value.download_files.side_effect = download_files
+
+    @patch("load_metadata.Swift")
+    def test_the_index_of_the_dump_is_used(self, mock_swift):
+        # Given
+        self._mock_swift(mock_swift, {"etag": "etag_2", "size": 200})
+        # When
+        index = load_metadata_index("bso_dump", "dump.jsonl.gz", self.destination_dir)
+        # Then
+        self.assertEqual(index, self.remote_index)
+
+    @patch("load_metadata.Swift")
+    def test_the_index_of_another_version_of_the_dump_is_not_used(self, mock_swift):
+        # Given a dump uploaded again after it has been indexed
+        self._mock_swift(mock_swift, {"etag": "etag_3", "size": 300})
+        # When
+        index = load_metadata_index("bso_dump", "dump.jsonl.gz", self.destination_dir)
+        # Then
+        self.assertIsNone(index)
+
+    @patch("load_metadata.Swift")
+    def test_a_local_copy_of_a_previous_index_is_downloaded_again(self, mock_swift):
+        # Given the local copy of the index of the previous version of the dump
+        self._mock_swift(mock_swift, {"etag": "etag_2", "size": 200})
+        with open(os.path.join(self.destination_dir, get_index_name("dump.jsonl.gz")), "w") as f_out:
+            json.dump(dict(self.remote_index, source={"etag": "etag_1", "size": 100}), f_out)
+        # When
+        index = load_metadata_index("bso_dump", "dump.jsonl.gz", self.destination_dir)
+        # Then
+        self.assertEqual(index, self.remote_index)
+        mock_swift.return_value.download_files.assert_called_once()
@@ -8,3 +8,12 @@ class ResponseMock:
         self.ok = True if status_code == 200 else False
         self.content = content
         self.text = content
+        self.headers = {}
+
+    def iter_content(self, chunk_size):
+        content = self.content.encode() if isinstance(self.content, str) else self.content
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def close(self):
+        pass
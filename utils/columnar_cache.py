@@ -0,0 +1,113 @@
+"""Columnar cache of the metadata dumps.
+
+Selecting the publications to harvest only needs a handful of fields of each publication but requires to parse
+every line of the dump. The columnar cache is a Parquet file holding these fields, the line number of each
+publication in the dump being the key back to its full metadata:
+
+line | doi | bso_country_corrected | is_oa | publisher_normalized | bso_classification
+
+is_oa is the value of the latest observation of oa_details. The eligibility (see harvest_eligibility_conditions),
+doi_list and already harvested filters are evaluated as vectorized operations over the columns they use, one
+row group at a time. The vectorized eligibility has to follow harvest_eligibility_conditions: the cache is not used
+when harvest_eligibility_vectorized is False. pyarrow is optional: without it the dumps are filtered line by line.
+"""
+import gzip
+import json
+import posixpath
+from typing import Dict, Iterator, Set
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from config.harvest_strategy_config import harvest_api_publishers
+
+COLUMNAR_CACHE_EXT = ".columns.parquet"
+ROWS_PER_ROW_GROUP = 100_000
+
+
+def is_columnar_cache_available() -> bool:
+    return pa is not None
+
+
+def get_columnar_cache_name(metadata_file: str) -> str:
+    """bso-publications.jsonl.gz -> bso-publications.jsonl.gz.columns.parquet"""
+    return posixpath.join(posixpath.dirname(metadata_file), posixpath.basename(metadata_file) + COLUMNAR_CACHE_EXT)
+
+
+def _get_schema():
+    return pa.schema([
+        ("line", pa.int64()),
+        ("doi", pa.string()),
+        ("bso_country_corrected", pa.list_(pa.string())),
+        ("is_oa", pa.bool_()),
+        ("publisher_normalized", pa.string()),
+        ("bso_classification", pa.string()),
+    ])
+
+
+def _get_columns(line_number: int, entry: dict) -> dict:
+    oa_details = entry.get("oa_details")
+    bso_country_corrected = entry.get("bso_country_corrected")
+    return {
+        "line": line_number,
+        "doi": entry.get("doi") or None,
+        "bso_country_corrected": bso_country_corrected if isinstance(bso_country_corrected, list) else None,
+        "is_oa": bool(oa_details[max(oa_details)].get("is_oa")) if oa_details else False,
+        "publisher_normalized": entry.get("publisher_normalized"),
+        "bso_classification": entry.get("bso_classification"),
+    }
+
+
+def build_columnar_cache(source_file: str, cache_file: str, rows_per_row_group: int = ROWS_PER_ROW_GROUP) -> int:
+    """Write the columnar cache of source_file, a row group at a time. Returns the number of publications"""
+    schema = _get_schema()
+    number_of_lines = 0
+    rows = []
+    with gzip.open(source_file, "rt") as f_in, pq.ParquetWriter(cache_file, schema) as writer:
+        for line in f_in:
+            rows.append(_get_columns(number_of_lines, json.loads(line)))
+            number_of_lines += 1
+            if len(rows) == rows_per_row_group:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                rows = []
+        if rows or number_of_lines == 0:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+    return number_of_lines
+
+
+def eligibility_mask(batch):
+    """Vectorized version of harvest_eligibility_conditions, to be updated with them"""
+    has_doi = pc.fill_null(pc.not_equal(batch["doi"], ""), False)
+    countries = batch["bso_country_corrected"]
+    french_rows = pc.filter(pc.list_parent_indices(countries), pc.equal(pc.list_flatten(countries), "fr"))
+    is_french = pc.is_in(pa.array(range(batch.num_rows), pa.int64()), value_set=pc.cast(french_rows, pa.int64()))
+    is_accessible = pc.or_(pc.fill_null(batch["is_oa"], False),
+                           pc.is_in(batch["publisher_normalized"], value_set=pa.array(harvest_api_publishers)))
+    return pc.and_(pc.and_(has_doi, is_french), is_accessible)
+
+
+def _iter_batches(cache_file: str, columns: list) -> Iterator:
+    parquet_file = pq.ParquetFile(cache_file)
+    for row_group in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(row_group, columns=columns)
+
+
+def select_publications_to_harvest(cache_file: str, doi_set: Set[str], doi_already_harvested: Set[str]) -> Dict[int, str]:
+    """Return {line number in the dump: doi} of the eligible publications of doi_set (every publications
+    when empty) that have not been harvested yet"""
+    doi_set_array = pa.array(list(doi_set), pa.string())
+    doi_already_harvested_array = pa.array(list(doi_already_harvested), pa.string())
+    publications_to_harvest = {}
+    columns = ["line", "doi", "bso_country_corrected", "is_oa", "publisher_normalized"]
+    for batch in _iter_batches(cache_file, columns):
+        mask = pc.and_(eligibility_mask(batch),
+                       pc.invert(pc.is_in(batch["doi"], value_set=doi_already_harvested_array)))
+        if len(doi_set) > 0:
+            mask = pc.and_(mask, pc.is_in(batch["doi"], value_set=doi_set_array))
+        selected = batch.filter(mask)
+        publications_to_harvest.update(zip(selected["line"].to_pylist(), selected["doi"].to_pylist()))
+    return publications_to_harvest
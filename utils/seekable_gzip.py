@@ -0,0 +1,109 @@
+"""Seekable gzip files for the metadata dumps.
+
+A gzip file can only be read from its beginning, so reaching the last partition of a dump requires to inflate
+the whole file. Python zlib cannot restart the inflation in the middle of a deflate stream (zran style access
+needs to prime the inflater with bits which is not exposed), so the dump is rewritten as a multi-member gzip:
+each member is an independent gzip stream holding a fixed number of lines. The resulting file is still a
+valid gzip file. The offset of each member is a seek point recorded in a sidecar index with the number of the
+first line of the member. The index also records the etag and the size of the object of the dump it has been built
+from, a new dump uploaded under the same name making the index and the seekable file stale:
+
+{"number_of_lines": 250000, "compressed_size": 123456, "seek_points": [[0, 0], [100000, 43210], ...],
+ "source": {"etag": "d41d8cd98f00b204e9800998ecf8427e", "size": 234567}}
+"""
+import gzip
+import json
+import os
+import posixpath
+from bisect import bisect_right
+from itertools import islice
+from typing import Iterator, Optional
+
+SEEKABLE_PREFIX = "seekable_"
+INDEX_EXT = ".index.json"
+LINES_PER_SEEK_POINT = 100_000
+
+
+def get_seekable_name(metadata_file: str) -> str:
+    """bso-publications.jsonl.gz -> seekable_bso-publications.jsonl.gz"""
+    return posixpath.join(posixpath.dirname(metadata_file), SEEKABLE_PREFIX + posixpath.basename(metadata_file))
+
+
+def get_index_name(metadata_file: str) -> str:
+    """bso-publications.jsonl.gz -> seekable_bso-publications.jsonl.gz.index.json"""
+    return get_seekable_name(metadata_file) + INDEX_EXT
+
+
+def build_seekable_gzip(source_file: str, seekable_file: str, index_file: str,
+                        lines_per_seek_point: int = LINES_PER_SEEK_POINT, source: Optional[dict] = None) -> dict:
+    """Rewrite source_file as a multi-member gzip with a member every lines_per_seek_point lines
+    and write the corresponding index, source being the etag and the size of the object of the dump.
+    Returns the index"""
+    seek_points = []
+    number_of_lines = 0
+    with gzip.open(source_file, "rb") as f_in, open(seekable_file, "wb") as f_out:
+        member = None
+        for line in f_in:
+            if number_of_lines % lines_per_seek_point == 0:
+                if member:
+                    member.close()
+                seek_points.append([number_of_lines, f_out.tell()])
+                member = gzip.GzipFile(fileobj=f_out, mode="wb", mtime=0)
+            member.write(line)
+            number_of_lines += 1
+        if member:
+            member.close()
+        compressed_size = f_out.tell()
+    index = {
+        "number_of_lines": number_of_lines,
+        "compressed_size": compressed_size,
+        "seek_points": seek_points,
+        "source": source,
+    }
+    with open(index_file, "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def load_index(index_file: str) -> Optional[dict]:
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def is_index_of(index: dict, source: Optional[dict]) -> bool:
+    """Check that the index has been built from the object of the dump whose etag and size are source"""
+    return source is not None and index.get("source") == source
+
+
+def get_seek_point(index: dict, line_number: int) -> list:
+    """Return the last [first_line, offset] seek point before line_number"""
+    first_lines = [first_line for first_line, _ in index["seek_points"]]
+    return index["seek_points"][max(bisect_right(first_lines, line_number) - 1, 0)]
+
+
+def get_partial_index(index: dict, start: int, stop: int) -> dict:
+    """Return the index of the part of the seekable file made of the members covering the lines [start, stop[.
+    Line numbers are kept as in the whole file and offsets are shifted to the start of the part.
+    byte_range is the inclusive range of bytes of the part in the whole file"""
+    first_line, first_byte = get_seek_point(index, start)
+    last_line, _ = get_seek_point(index, max(stop - 1, start))
+    seek_points = [[line, offset - first_byte] for line, offset in index["seek_points"] if line >= first_line]
+    next_seek_points = [offset for line, offset in index["seek_points"] if line > last_line]
+    last_byte = (next_seek_points[0] if next_seek_points else index["compressed_size"]) - 1
+    return {
+        "number_of_lines": index["number_of_lines"],
+        "compressed_size": last_byte - first_byte + 1,
+        "seek_points": [seek_point for seek_point in seek_points if seek_point[0] <= last_line],
+        "byte_range": [first_byte, last_byte],
+    }
+
+
+def read_lines(seekable_file: str, index: dict, start: int, stop: int) -> Iterator[bytes]:
+    """Yield the lines [start, stop[ of a seekable gzip file. Only the members covering these lines are inflated"""
+    seek_line, seek_offset = get_seek_point(index, start)
+    with open(seekable_file, "rb") as raw:
+        raw.seek(seek_offset)
+        with gzip.GzipFile(fileobj=raw, mode="rb") as f_in:
+            yield from islice(f_in, start - seek_line, stop - seek_line)
@@ -9,7 +9,6 @@ class Singleton(type):
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
-    @classmethod
     def clear_instance(cls):
         try:
             del Singleton._instances[cls]
@@ -25,7 +24,6 @@ class SingletonABCMeta(ABCMeta):
             cls._instances[cls] = super(SingletonABCMeta, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
-    @classmethod
     def clear_instance(cls):
         try:
             del SingletonABCMeta._instances[cls]